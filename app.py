@@ -1,35 +1,60 @@
 import os
+import csv
+import io
+import asyncio
+import functools
+import itertools
+import hmac
+import hashlib
+import multiprocessing
+import contextvars
 import uuid
 import json
-import sqlite3
 import math
-from datetime import datetime, timedelta
+import bisect
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import logging
-from pydantic import BaseModel, validator
-from typing import Union, Tuple, List
+from pydantic import AfterValidator, BaseModel, BeforeValidator, Field, StringConstraints, model_validator
+from typing import Annotated, List, Literal, Optional
 import re
 import random
-import string
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import numpy as np
+try:
+    import orjson
+except ImportError:  # sérialisation de secours par json (cf. FastJSONResponse)
+    orjson = None
+from storage import (DatabaseError, IntegrityError, LockTimeout, PoolTimeout, PostgresStorage, SQLiteStorage,
+                     db_helper, db_round_trips, record_checkout)
+from metrics import registry
+from migrations import SCHEMA_VERSION
+from passwords import hash_password, is_hashed, needs_rehash, verify_password
 
 
 # Configuration du logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
 
-# Configuration CORS : autorise toutes les origines (à restreindre en production)
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["GET", "POST"],
-    allow_headers=["*"],
-)
+@asynccontextmanager
+async def lifespan(app):
+    # Cycle de vie du worker : cf. start_worker / stop_worker (tâches de fond)
+    await start_worker()
+    try:
+        yield
+    finally:
+        await stop_worker()
+
+
+app = FastAPI(lifespan=lifespan)
 
 #####################################
 # Fonctions de génération
@@ -45,276 +70,1133 @@ def generate_token():
 #####################################
 # Fonctions de validation
 #####################################
+# Utilisées comme validateurs pydantic (cf. InscriptionRequest) : ValueError devient une 422
 def validate_password(pass_word: str):
     # Minimum 6 caractères
     if len(pass_word) < 6:
-        raise HTTPException(status_code=400, detail="Le mot de passe doit contenir au moins 6 caractères")
+        raise ValueError("Le mot de passe doit contenir au moins 6 caractères")
     # Refuser certaines suites ou répétitions triviales
     if pass_word in ["123456", "000000", "111111"]:
-        raise HTTPException(status_code=400, detail="Mot de passe trop simple")
+        raise ValueError("Mot de passe trop simple")
     # Vous pouvez ajouter d'autres vérifications (majuscules, chiffres, symboles…)
-    return True
+    return pass_word
 
 def validate_phone(numero: str):
     # Vérifie que le numéro comporte exactement 10 chiffres
     if not re.fullmatch(r"\d{10}", numero):
-        raise HTTPException(status_code=400, detail="Le numéro doit comporter exactement 10 chiffres")
-    return True
+        raise ValueError("Le numéro doit comporter exactement 10 chiffres")
+    return numero
+
+def parse_confirmation(value):
+    # "yes" (quelle que soit la casse) ou un booléen
+    if isinstance(value, str):
+        return value.lower() == "yes"
+    return value
 
 #####################################
-# Base de données SQLite et initialisation
+# Base de données : PostgreSQL (pool de connexions) ou SQLite embarqué
 #####################################
 
-def get_db_connection():
+# DB_BACKEND=sqlite pour une borne mono-nœud ou un test de charge local, sans serveur de base de données
+DB_BACKEND = os.environ.get("DB_BACKEND", "postgres")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "mopatas_local.sqlite3")
+SQLITE_READERS = int(os.environ.get("SQLITE_READERS", "4"))
+
+# Configuration du pool (par worker gunicorn/uvicorn), surchargeable par l'environnement.
+# DATABASE_URL n'a pas de défaut : sans elle, le backend postgres refuse de démarrer plutôt que de
+# viser une base par accident.
+DATABASE_URL = os.environ.get("DATABASE_URL")
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))
+# Au-delà de cette durée d'inactivité, une connexion est testée (SELECT 1) avant d'être prêtée
+DB_POOL_CHECK_IDLE = float(os.environ.get("DB_POOL_CHECK_IDLE", "30"))
+# Attente maximum (s) d'un verrou de ligne PostgreSQL (lock_timeout de session, 0 = illimitée)
+DB_LOCK_TIMEOUT = float(os.environ.get("DB_LOCK_TIMEOUT", "5"))
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    # Création paresseuse : un stockage (et donc un pool) par processus worker
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if DB_BACKEND == "sqlite":
+                    _storage = SQLiteStorage(SQLITE_PATH, SQLITE_READERS, DB_POOL_TIMEOUT)
+                else:
+                    if not DATABASE_URL:
+                        raise RuntimeError("DATABASE_URL n'est pas défini (ou DB_BACKEND=sqlite pour une base locale)")
+                    _storage = PostgresStorage(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                               DB_POOL_CHECK_IDLE, DB_LOCK_TIMEOUT)
+    return _storage
+
+
+@contextmanager
+def db_connection(write=True):
+    # Emprunte une connexion : commit en sortie, rollback sur exception.
+    # write=False pour les lectures seules (servies en parallèle par les lecteurs SQLite).
     try:
-        conn = psycopg2.connect(
-            host="dpg-d0nitoumcj7s73e2giag-a.oregon-postgres.render.com",
-            database="kelasi_db",
-            user="kelasi_db_user",
-            password="gTBHYLXoOf5F5iCQvIzAmL1CCJYMpHCd",
-            port=5432,
-            cursor_factory=RealDictCursor  # Permet de retourner les résultats comme un dictionnaire
-        )
-        return conn
-    except psycopg2.Error as e:
-        logger.error(f"Erreur PostgreSQL: {e}")
+        storage = get_storage()
+        conn = storage.getconn(write)
+    except PoolTimeout as e:
+        logger.error(f"Pool de connexions saturé: {e}")
+        raise HTTPException(status_code=503, detail="Base de données surchargée, réessayez plus tard")
+    except DatabaseError as e:
+        logger.error(f"Erreur de base de données: {e}")
         raise HTTPException(status_code=500, detail="Connexion à la base de données échouée")
+    record_checkout()
+    try:
+        with conn:
+            yield conn
+    except LockTimeout as e:
+        # Un autre worker tient la ligne au-delà de DB_LOCK_TIMEOUT : le client peut réessayer
+        DB_LOCK_TIMEOUTS.inc(db_helper.get())
+        logger.warning(f"Verrou de ligne non obtenu: {e}")
+        raise HTTPException(status_code=409, detail="Compte occupé par une autre opération, réessayez")
+    finally:
+        storage.putconn(conn, write)
+
+
+# Les helpers SQL sont bloquants : les endpoints async les exécutent dans un pool de threads
+# borné, dimensionné comme le pool de connexions pour qu'aucun thread n'attende une connexion.
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX)))
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="mopatas-db")
 
-def get_company_account():
-    conn = get_db_connection()
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM company_account WHERE id = 1")
-        company = cursor.fetchone()
-    return company
+
+def _call_helper(func, *args, **kwargs):
+    # Les métriques SQL sont étiquetées du nom du helper (dans le contexte copié par run_db)
+    helper = func.func if isinstance(func, functools.partial) else func
+    db_helper.set(getattr(helper, "__qualname__", "other"))
+    return func(*args, **kwargs)
+
+
+async def run_db(func, *args, **kwargs):
+    # Exécute un helper bloquant hors de la boucle d'événements, dans le contexte de la requête
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, functools.partial(ctx.run, _call_helper, func, *args, **kwargs))
+
+
+#####################################
+# Métriques (/metrics)
+#####################################
+# Agrégées par worker (cf. metrics.py) : chaque worker gunicorn expose les siennes.
+PER_REQUEST_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32, 64)
+
+HTTP_REQUESTS = registry.counter("mopatas_http_requests_total",
+                                 "Requêtes HTTP traitées, par route, méthode et statut", ["route", "method", "status"])
+HTTP_SECONDS = registry.histogram("mopatas_http_request_duration_seconds",
+                                  "Latence des requêtes HTTP, par route", ["route", "method"])
+HTTP_DB_QUERIES = registry.histogram("mopatas_http_db_queries_per_request",
+                                     "Instructions SQL par requête HTTP, par route", ["route"], PER_REQUEST_BUCKETS)
+HTTP_DB_CHECKOUTS = registry.histogram("mopatas_http_db_checkouts_per_request",
+                                       "Connexions empruntées par requête HTTP, par route", ["route"], PER_REQUEST_BUCKETS)
+DB_LOCK_TIMEOUTS = registry.counter("mopatas_db_lock_timeouts_total",
+                                    "Verrous de ligne non obtenus avant DB_LOCK_TIMEOUT, par helper", ["helper"])
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Les exports en flux sont mesurés à l'envoi des en-têtes, avant leur corps
+    counter = {"queries": 0, "transactions": 0}
+    token = db_round_trips.set(counter)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        db_round_trips.reset(token)
+        elapsed = time.perf_counter() - started
+        # Gabarit de la route (et non le chemin brut) pour borner le nombre de séries
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        HTTP_REQUESTS.inc(path, request.method, str(status))
+        HTTP_SECONDS.observe(elapsed, path, request.method)
+        HTTP_DB_QUERIES.observe(counter["queries"], path)
+        HTTP_DB_CHECKOUTS.observe(counter["transactions"], path)
+    # Instructions SQL et transactions de la requête, lues par bench.py
+    response.headers["X-DB-Queries"] = str(counter["queries"])
+    response.headers["X-DB-Transactions"] = str(counter["transactions"])
+    return response
+
+
+# Les workers n'exécutent aucune DDL : `python bootstrap.py` crée et migre le schéma avant leur
+# démarrage, et chaque worker vérifie seulement la version au démarrage (une requête).
+# DB_AUTO_MIGRATE=1 migre au démarrage du worker (développement, borne SQLite).
+DB_AUTO_MIGRATE = os.environ.get("DB_AUTO_MIGRATE", "0") == "1"
+
+
+def check_schema():
+    version = get_storage().schema_version()
+    if version >= SCHEMA_VERSION:
+        return version
+    if DB_AUTO_MIGRATE:
+        init_db()
+        return SCHEMA_VERSION
+    raise RuntimeError(f"Schéma en version {version}, {SCHEMA_VERSION} attendue : "
+                       "lancez `python bootstrap.py` avant de démarrer les workers")
 
 def init_db():
-    conn = get_db_connection()
-    with conn:
-        cursor = conn.cursor()
-        # Table des utilisateurs
-        cursor.execute('''
-          CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            nom TEXT NOT NULL,
-            numero TEXT UNIQUE NOT NULL,
-            pass_word TEXT NOT NULL,
-            solde REAL NOT NULL,
-            type_compte TEXT NOT NULL DEFAULT 'standard',
-            codeCompte TEXT
-          )
-        ''')
-        # Table des transactions
-        cursor.execute('''
-          CREATE TABLE IF NOT EXISTS les_transactions (
-            id SERIAL PRIMARY KEY,
-            numero_envoyeur TEXT NOT NULL,
-            numero_destinataire TEXT NOT NULL,
-            montant REAL NOT NULL,
-            type_trans TEXT NOT NULL,
-            code_session TEXT UNIQUE NOT NULL,
-            etat TEXT NOT NULL,
-            transaction_hash TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-          )
-        ''')
-        # Table des inscriptions en attente
-        cursor.execute('''
-          CREATE TABLE IF NOT EXISTS pending_registrations (
-             id SERIAL PRIMARY KEY,
-             code_session TEXT UNIQUE NOT NULL,
-             nom TEXT NOT NULL,
-             numero TEXT NOT NULL,
-             pass_word TEXT NOT NULL,
-             type_compte TEXT NOT NULL DEFAULT 'standard',
-             solde REAL NOT NULL,
-             code_entite TEXT,
-             codeCompte TEXT,
-             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-          )
-        ''')
-        # Table du compte d'entreprise
-        cursor.execute('''
-          CREATE TABLE IF NOT EXISTS company_account (
-            id SERIAL PRIMARY KEY,
-            solde REAL NOT NULL,
-            pass_word TEXT NOT NULL
-          )
-        ''')
-        # Table premium_services
-        cursor.execute('''
-          CREATE TABLE IF NOT EXISTS premium_services (
-            id SERIAL PRIMARY KEY,
-            client TEXT NOT NULL, 
-            produit TEXT NOT NULL, 
-            percepteur TEXT NOT NULL,
-            transaction_hash TEXT NOT NULL
-          )
-        ''')
+    # Schéma : migrations versionnées (cf. migrations.py)
+    get_storage().migrate(log=logger.info)
 
+    with db_connection() as conn:
+        cursor = conn.cursor()
         # Insertion du compte d'entreprise s'il n'existe pas
         cursor.execute("SELECT COUNT(*) as count FROM company_account")
         row = cursor.fetchone()
         if row["count"] == 0:
-            config_file = os.path.join(os.getcwd(), "config.json")
-            if os.path.exists(config_file):
-                with open(config_file, "r") as f:
-                    config = json.load(f)
-                company_config = config.get("company_account", {})
-                company_solde = float(company_config.get("solde", 2000000.0))
-                company_password = company_config.get("pass_word", "adminpassword")
-            else:
-                company_solde = 2000000.0
-                company_password = "adminpassword"
+            company_config = load_config().get("company_account", {})
+            company_solde = float(company_config.get("solde", 2000000.0))
+            company_password = company_config.get("pass_word", "adminpassword")
             cursor.execute("INSERT INTO company_account (solde, pass_word) VALUES (%s, %s)", 
-                           (company_solde, company_password))
-        conn.commit()
-    conn.close()
+                           (company_solde, hash_password(company_password)))
+            append_ledger(cursor, ledger_rows(str(uuid.uuid4()), "ouverture", {}, company_solde))
+    company_account.invalidate()
+
+
+#####################################
+# Mots de passe
+#####################################
+# Le hachage scrypt (cf. passwords.py) tourne dans un pool de processus borné, pour ne jamais
+# bloquer la boucle d'événements. Un couple (numéro, mot de passe) vérifié est gardé
+# PASSWORD_CACHE_TTL secondes, tant que le hash stocké ne change pas.
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_CACHE_TTL = float(os.environ.get("PASSWORD_CACHE_TTL", "60"))
+PASSWORD_CACHE_SIZE = int(os.environ.get("PASSWORD_CACHE_SIZE", "10000"))
+
+
+class CredentialVerifier:
+    """
+    Vérifie et hache les mots de passe dans un pool de processus, avec un cache
+    des identifiants récemment vérifiés (clé : numéro et empreinte HMAC du secret).
+    """
+
+    def __init__(self, workers=1, ttl=60.0, maxsize=10000):
+        self.workers = workers
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._executor = None
+        # Clé propre au processus : le cache ne contient aucune empreinte réutilisable ailleurs
+        self._key = os.urandom(32)
+        self._verified = OrderedDict()  # clé -> (hash stocké, expiration)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "failures": 0, "hashes": 0, "upgrades": 0}
+        self._upgrades = {}  # numéro -> tâche de re-hachage en cours
+
+    def executor(self):
+        # forkserver : les processus de hachage n'héritent ni des threads ni des connexions du worker
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    context = multiprocessing.get_context("forkserver")
+                    context.set_forkserver_preload(["passwords"])
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    def _cache_key(self, numero, secret):
+        return numero, hmac.new(self._key, secret.encode(), hashlib.sha256).digest()
+
+    def _cached(self, key, stored):
+        with self._lock:
+            entry = self._verified.get(key)
+            if entry is None or entry[0] != stored or entry[1] < time.monotonic():
+                return False
+            self._verified.move_to_end(key)
+            return True
+
+    def _count(self, name):
+        # Compteurs mis à jour sous le même verrou que le cache
+        with self._lock:
+            self._stats[name] += 1
+
+    def remember(self, numero, secret, stored):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        key = self._cache_key(numero, secret)
+        with self._lock:
+            self._verified[key] = (stored, time.monotonic() + self.ttl)
+            self._verified.move_to_end(key)
+            while len(self._verified) > self.maxsize:
+                self._verified.popitem(last=False)
+
+    async def verify(self, numero, secret, stored):
+        if not secret or not stored:
+            return False
+        secret = str(secret)
+        if self._cached(self._cache_key(numero, secret), stored):
+            self._count("hits")
+            return True
+        self._count("misses")
+        if is_hashed(stored):
+            loop = asyncio.get_running_loop()
+            ok = await loop.run_in_executor(self.executor(), verify_password, secret, stored)
+        else:
+            ok = verify_password(secret, stored)
+        if ok:
+            self.remember(numero, secret, stored)
+        else:
+            self._count("failures")
+        return ok
+
+    async def hash(self, secret):
+        self._count("hashes")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor(), hash_password, secret)
+
+    async def upgrade(self, numero, secret, stored, update):
+        # `update(ancien, nouveau)` ne remplace la ligne que si elle n'a pas changé entre-temps
+        try:
+            hashed = await self.hash(secret)
+            if await run_db(update, stored, hashed):
+                self._count("upgrades")
+                self.remember(numero, secret, hashed)
+        except Exception as e:
+            logger.error(f"Re-hachage du mot de passe de {numero} impossible: {e}")
+
+    def schedule_upgrade(self, numero, secret, stored, update):
+        # Après une connexion réussie sur une ligne en clair (ou hachée avec d'anciens paramètres),
+        # re-hachage en tâche de fond : la requête n'attend pas
+        if needs_rehash(stored) and numero not in self._upgrades:
+            task = asyncio.create_task(self.upgrade(numero, str(secret), stored, update))
+            self._upgrades[numero] = task
+            task.add_done_callback(lambda _: self._upgrades.pop(numero, None))
+
+    def stats(self):
+        with self._lock:
+            size = len(self._verified)
+            counts = dict(self._stats)
+        return {"workers": self.workers, "ttl": self.ttl, "size": size, **counts}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+credentials = CredentialVerifier(PASSWORD_WORKERS, PASSWORD_CACHE_TTL, PASSWORD_CACHE_SIZE)
+
+
+async def check_user_password(user, secret):
+    # Vérifie le mot de passe d'un utilisateur déjà chargé (ligne de get_user_by_number)
+    if user is None or not await credentials.verify(user["numero"], secret, user["pass_word"]):
+        return False
+    credentials.schedule_upgrade(user["numero"], secret, user["pass_word"],
+                                 functools.partial(update_user_password, user["numero"]))
+    return True
+
+
+#####################################
+# Compte d'entreprise
+#####################################
+# Le mot de passe admin est gardé en mémoire et relu au plus toutes les COMPANY_CACHE_TTL secondes ;
+# le solde, lui, n'est jamais mis en cache (il est lu sous verrou là où l'argent bouge, cf. depot_pro).
+COMPANY_CACHE_TTL = float(os.environ.get("COMPANY_CACHE_TTL", "60"))
+# Les crédits (retraits, frais) sont répartis en tourniquet sur COMPANY_STRIPES lignes de
+# company_account_stripes, pour ne pas sérialiser tout le trafic sur la ligne id = 1 ; seuls les
+# débits (depot_pro) la verrouillent. Les bandes y sont reversées toutes les COMPANY_FOLD_INTERVAL s.
+COMPANY_STRIPES = int(os.environ.get("COMPANY_STRIPES", "16"))
+COMPANY_FOLD_INTERVAL = float(os.environ.get("COMPANY_FOLD_INTERVAL", "60"))
+
+_company_stripe = itertools.count()
+company_stats = {"stripes": COMPANY_STRIPES, "folds": 0, "last_fold": None, "last_folded": 0.0,
+                 "total_folded": 0.0, "errors": 0}
+
+
+def credit_company(cursor, amount):
+    if COMPANY_STRIPES <= 0:
+        cursor.execute("UPDATE company_account SET solde = solde + %s WHERE id = 1", (amount,))
+        return
+    stripe = next(_company_stripe) % COMPANY_STRIPES + 1
+    cursor.execute("UPDATE company_account_stripes SET solde = solde + %s WHERE stripe = %s", (amount, stripe))
+    if cursor.rowcount == 0:
+        # Bande pas encore créée (premier crédit, ou COMPANY_STRIPES augmenté)
+        cursor.execute("""
+            INSERT INTO company_account_stripes (stripe, solde) VALUES (%s, %s)
+            ON CONFLICT (stripe) DO UPDATE SET solde = company_account_stripes.solde + EXCLUDED.solde
+        """, (stripe, amount))
+
+def apply_company_delta(cursor, delta):
+    # Débit sur la ligne principale, verrouillée au préalable par lock_company_balance
+    if delta > 0:
+        credit_company(cursor, delta)
+    elif delta < 0:
+        cursor.execute("UPDATE company_account SET solde = solde + %s WHERE id = 1", (delta,))
+
+def company_balance(cursor):
+    # Solde agrégé : ligne principale + bandes (None si le compte n'existe pas)
+    cursor.execute("""
+        SELECT c.solde + COALESCE((SELECT SUM(solde) FROM company_account_stripes), 0) AS solde
+        FROM company_account c WHERE c.id = 1
+    """)
+    row = cursor.fetchone()
+    return row["solde"] if row else None
+
+def lock_company_balance(cursor):
+    # Verrouille la ligne principale, ce qui sérialise les débits et le reversement des bandes, puis lit
+    # le solde agrégé. Les bandes ne reçoivent que des crédits : un crédit concurrent non encore validé
+    # ne peut que sous-estimer le solde, jamais autoriser un débit à découvert.
+    cursor.execute("SELECT id FROM company_account WHERE id = 1 FOR UPDATE")
+    if cursor.fetchone() is None:
+        return None
+    return company_balance(cursor)
+
+def fold_company_stripes():
+    # Reverse les bandes dans la ligne principale, en une transaction courte. Ordre des verrous :
+    # ligne principale puis bandes ; un crédit ne prend qu'une bande, jamais la ligne principale.
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM company_account WHERE id = 1 FOR UPDATE")
+        if cursor.fetchone() is None:
+            return 0.0
+        cursor.execute("SELECT stripe, solde FROM company_account_stripes WHERE solde <> 0 ORDER BY stripe FOR UPDATE")
+        stripes = cursor.fetchall()
+        total = sum(row["solde"] for row in stripes)
+        if stripes:
+            cursor.execute("UPDATE company_account_stripes SET solde = 0 WHERE stripe = ANY(%s)",
+                           ([row["stripe"] for row in stripes],))
+            cursor.execute("UPDATE company_account SET solde = solde + %s WHERE id = 1", (total,))
+    company_stats["folds"] += 1
+    company_stats["last_fold"] = datetime.now().isoformat()
+    company_stats["last_folded"] = total
+    company_stats["total_folded"] += total
+    return total
+
+
+class CompanyAccountCache:
+    """
+    Identifiants du compte d'entreprise (id = 1) mis en cache par worker.
+    """
+
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self._pass_word = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def fresh(self):
+        return time.monotonic() < self._expires
+
+    def refresh(self):
+        with db_connection(write=False) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pass_word FROM company_account WHERE id = 1")
+            row = cursor.fetchone()
+        with self._lock:
+            self._pass_word = row["pass_word"] if row else None
+            self._expires = time.monotonic() + self.ttl
+
+    def invalidate(self):
+        with self._lock:
+            self._expires = 0.0
+
+    async def matches(self, candidate):
+        pass_word = self._pass_word
+        if not candidate or pass_word is None:
+            return False
+        if not await credentials.verify("company_account", candidate, pass_word):
+            return False
+        credentials.schedule_upgrade("company_account", candidate, pass_word, update_company_password)
+        return True
+
+
+company_account = CompanyAccountCache(COMPANY_CACHE_TTL)
+
+
+async def verify_company_pass(candidate):
+    # Aucune requête SQL tant que le cache est frais, ni quand aucun mot de passe n'est fourni
+    if not candidate:
+        return False
+    if not company_account.fresh:
+        await run_db(company_account.refresh)
+    return await company_account.matches(candidate)
+
+
+#####################################
+# Barème des frais
+#####################################
+# Barème par défaut : chaque palier est (plafond inclus, taux au début du palier, taux au plafond).
+# Entre les deux, le taux décroît linéairement ; None = pas de plafond. Surchargeable par la clé
+# "fee_schedule" de config.json : {"types_gratuits": [...], "paliers": [{"plafond": 20000, "taux": 0.05},
+# {"plafond": 100000, "taux_debut": 0.05, "taux_fin": 0.035}, ...]}
+DEFAULT_FEE_TIERS = [
+    (20000, 0.05, 0.05),
+    (100000, 0.05, 0.035),
+    (200000, 0.03, 0.03),
+    (1000000, 0.03, 0.015),
+    (None, 0.01, 0.01),
+]
+DEFAULT_FREE_TYPES = ['envoi', 'depot']
+FEE_QUOTE_MAX = 100000
+
+
+class FeeSchedule:
+    """
+    Barème compilé en tables : le calcul d'un montant ou d'un tableau NumPy de montants suit
+    exactement les mêmes opérations flottantes, palier par palier.
+    """
+
+    def __init__(self, tiers=DEFAULT_FEE_TIERS, free_types=DEFAULT_FREE_TYPES):
+        self.free_types = frozenset(free_types)
+        self.uppers = []
+        self.lowers = []
+        self.starts = []
+        self.slopes = []
+        lower = 0
+        for plafond, taux_debut, taux_fin in tiers:
+            upper = math.inf if plafond is None else plafond
+            self.uppers.append(upper)
+            self.lowers.append(lower)
+            self.starts.append(taux_debut)
+            self.slopes.append((taux_debut - taux_fin) / (upper - lower) if upper != math.inf else 0.0)
+            lower = upper
+        if self.uppers[-1] != math.inf:
+            raise ValueError("Le dernier palier du barème ne doit pas avoir de plafond")
+        self._uppers = np.array(self.uppers, dtype=np.float64)
+        self._lowers = np.array(self.lowers, dtype=np.float64)
+        self._starts = np.array(self.starts, dtype=np.float64)
+        self._slopes = np.array(self.slopes, dtype=np.float64)
+
+    @classmethod
+    def from_config(cls, config):
+        schedule = config.get("fee_schedule")
+        if not schedule:
+            return cls()
+        tiers = []
+        for palier in schedule["paliers"]:
+            taux_debut = palier.get("taux_debut", palier.get("taux"))
+            taux_fin = palier.get("taux_fin", palier.get("taux"))
+            tiers.append((palier.get("plafond"), float(taux_debut), float(taux_fin)))
+        return cls(tiers, schedule.get("types_gratuits", DEFAULT_FREE_TYPES))
+
+    def fee(self, montant, transaction_type):
+        if transaction_type in self.free_types:
+            return 0
+        i = bisect.bisect_left(self.uppers, montant)
+        return montant * (self.starts[i] - (montant - self.lowers[i]) * self.slopes[i])
+
+    def fees(self, montants, transaction_type):
+        montants = np.asarray(montants, dtype=np.float64)
+        if transaction_type in self.free_types:
+            return np.zeros_like(montants)
+        i = np.searchsorted(self._uppers, montants, side="left")
+        return montants * (self._starts[i] - (montants - self._lowers[i]) * self._slopes[i])
+
+
+_config = None
+
+
+def load_config():
+    # config.json (répertoire courant) n'est lu qu'une fois par processus
+    global _config
+    if _config is None:
+        config_file = os.path.join(os.getcwd(), "config.json")
+        if os.path.exists(config_file):
+            with open(config_file, "r") as f:
+                _config = json.load(f)
+        else:
+            _config = {}
+    return _config
+
+
+fee_schedule = FeeSchedule.from_config(load_config())
+
+
+def calculate_fees(montant, transaction_type):
+    # Pour les les_transactions 'envoi' et 'depot', aucun frais n'est appliqué
+    return fee_schedule.fee(montant, transaction_type)
+
+
+#####################################
+# Cache des utilisateurs
+#####################################
+# Couche inter-requêtes optionnelle (par worker) : USER_CACHE_SIZE=0 ou USER_CACHE_TTL=0 la désactive.
+# Les autres workers ne l'invalident pas : le TTL borne la durée pendant laquelle un solde affiché peut être ancien.
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "5"))
+
+# Mémoïsation par requête, installée par le middleware HTTP
+_request_users = ContextVar("request_users", default=None)
+
+
+class UserCache:
+    """
+    Cache LRU borné des lignes `users` par numéro, avec expiration (TTL).
+    """
+
+    def __init__(self, maxsize=10000, ttl=5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # numero -> (expiration, ligne)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "request_hits": 0, "invalidations": 0, "evictions": 0}
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, numero):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(numero)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[numero]
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(numero)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, numero, user):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[numero] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(numero)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, *numeros):
+        memo = _request_users.get()
+        with self._lock:
+            for numero in numeros:
+                self._entries.pop(numero, None)
+                if memo is not None:
+                    memo.pop(numero, None)
+                self._stats["invalidations"] += 1
+
+    def count_request_hit(self):
+        with self._lock:
+            self._stats["request_hits"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "size": len(self._entries), "maxsize": self.maxsize,
+                    "ttl": self.ttl, **self._stats}
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+@app.middleware("http")
+async def request_user_memo(request: Request, call_next):
+    token = _request_users.set({})
+    try:
+        return await call_next(request)
+    finally:
+        _request_users.reset(token)
 
 
 #####################################
 # Fonctions utilitaires SQL
 #####################################
+# Listes et exports
+USERS_PAGE_SIZE = 100
+USERS_PAGE_MAX = 1000
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", "2000"))
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 500
+MERCHANT_PAGE_SIZE = 50
+MERCHANT_PAGE_MAX = 500
+HISTORY_COLUMNS = ["id", "numero_envoyeur", "numero_destinataire", "montant", "type_trans", "etat",
+                   "transaction_hash", "timestamp", "sens"]
+
+# PostgreSQL replie les identifiants non quotés en minuscules : on ré-expose `codeCompte`
+USER_COLUMNS = 'id, nom, numero, pass_word, solde, type_compte, codecompte AS "codeCompte"'
+
 def insert_user(nom, numero, pass_word, type_compte="standard", solde=0.0, codeCompte=None):
-    conn = get_db_connection()
     try:
-        with conn:
+        with db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 INSERT INTO users (nom, numero, pass_word, solde, type_compte, codeCompte)
                 VALUES (%s, %s, %s, %s, %s, %s)
             """, (nom, numero, pass_word, solde, type_compte, codeCompte))
-            logger.info("Utilisateur enregistré avec succès !")
-            return True
-    except psycopg2.IntegrityError:
+            append_ledger(cursor, ledger_rows(str(uuid.uuid4()), "ouverture", {numero: solde}))
+        user_cache.invalidate(numero)
+        logger.info("Utilisateur enregistré avec succès !")
+        return True
+    except IntegrityError:
         logger.error("Erreur : Le numéro est déjà utilisé.")
         return False
-    except psycopg2.Error as e:
+    except DatabaseError as e:
         logger.error(f"Erreur SQLite : {e}")
         return False
-    finally:
-        conn.close()
 
 def get_user_by_number(codeCompte):
-    conn = get_db_connection()
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE numero = %s", (codeCompte,))
-        user = cursor.fetchone()
-    conn.close()
-    
+    memo = _request_users.get()
+    if memo is not None and codeCompte in memo:
+        user_cache.count_request_hit()
+        return memo[codeCompte]
+    user = user_cache.get(codeCompte)
+    if user is None:
+        with db_connection(write=False) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {USER_COLUMNS} FROM users WHERE numero = %s", (codeCompte,))
+            user = cursor.fetchone()
+        if user is not None:
+            user_cache.put(codeCompte, user)
+    if memo is not None:
+        memo[codeCompte] = user
     return user
 
-def update_user_balance(numero, new_balance):
-    conn = get_db_connection()
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET solde = %s WHERE numero = %s", (new_balance, numero))
-    conn.close()
-
 def update_user_code(numero, codeCompte):
-    conn = get_db_connection()
-    with conn:
+    with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("UPDATE users SET codeCompte = %s WHERE numero = %s", (codeCompte, numero))
-    conn.close()
+    user_cache.invalidate(numero)
 
-def update_company_account(amount):
-    conn = get_db_connection()
-    with conn:
+def update_user_password(numero, old_pass_word, new_pass_word):
+    # Remplacement conditionnel : sans effet si le mot de passe a changé depuis la vérification
+    with db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("UPDATE company_account SET solde = solde + %s WHERE id = 1", (amount,))
-    conn.close()
+        cursor.execute("UPDATE users SET pass_word = %s WHERE numero = %s AND pass_word = %s",
+                       (new_pass_word, numero, old_pass_word))
+        updated = cursor.rowcount == 1
+    user_cache.invalidate(numero)
+    return updated
+
+def update_company_password(old_pass_word, new_pass_word):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE company_account SET pass_word = %s WHERE id = 1 AND pass_word = %s",
+                       (new_pass_word, old_pass_word))
+        updated = cursor.rowcount == 1
+    company_account.invalidate()
+    return updated
 
 def insert_transaction(numero_envoyeur, numero_destinataire, montant, transaction_type, code_session):
-    conn = get_db_connection()
-    with conn:
+    with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
           INSERT INTO les_transactions (numero_envoyeur, numero_destinataire, montant, type_trans, code_session, etat)
           VALUES (%s, %s, %s, %s, %s, %s)
         """, (numero_envoyeur, numero_destinataire, montant, transaction_type, code_session, 'pending'))
-    conn.close()
 
-def validate_transaction(code_session):
-    conn = get_db_connection()
-    with conn:
+def get_pending_transaction(code_session):
+    with db_connection(write=False) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM les_transactions WHERE code_session = %s AND etat = 'pending'", (code_session,))
-        transaction = cursor.fetchone()
-        if transaction:
-            if is_session_expired(transaction["timestamp"]):
-                cursor.execute("UPDATE les_transactions SET etat = 'expired' WHERE code_session = %s", (code_session,))
-                conn.commit()
-                conn.close()
-                return None
-            cursor.execute("UPDATE les_transactions SET etat = 'completed' WHERE code_session = %s", (code_session,))
-            conn.commit()
-    conn.close()
-    return transaction
-
-def insert_pending_registration(code_session, nom, numero, pass_word, type_compte, solde, code_entite, codeCompte):
-    conn = get_db_connection()
-    with conn:
+        cursor.execute("""
+            SELECT numero_envoyeur, numero_destinataire, type_trans FROM les_transactions
+            WHERE code_session = %s AND etat = 'pending'
+        """, (code_session,))
+        return cursor.fetchone()
+
+def insert_pending_registration(code_session, nom, numero, pass_word, type_compte, solde, code_entite, codeCompte,
+                                montant=None):
+    # `montant` : crédit en attente d'un /makeagent (`solde` n'y est alors qu'indicatif)
+    with db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO pending_registrations (code_session, nom, numero, pass_word, type_compte, solde, code_entite, codeCompte) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                       (code_session, nom, numero, pass_word, type_compte, solde, code_entite, codeCompte))
-    conn.close()
+        cursor.execute("INSERT INTO pending_registrations (code_session, nom, numero, pass_word, type_compte, solde, code_entite, codeCompte, montant) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                       (code_session, nom, numero, pass_word, type_compte, solde, code_entite, codeCompte, montant))
 
 def get_pending_registration(code_session):
-    conn = get_db_connection()
-    with conn:
+    with db_connection(write=False) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM pending_registrations WHERE code_session = %s", (code_session,))
+        cursor.execute('SELECT *, codecompte AS "codeCompte" FROM pending_registrations WHERE code_session = %s', (code_session,))
         pending = cursor.fetchone()
-    conn.close()
     return pending
 
 def delete_pending_registration(code_session):
-    conn = get_db_connection()
-    with conn:
+    with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM pending_registrations WHERE code_session = %s", (code_session,))
-    conn.commit()
-    conn.close()
+
+def update_user_account(numero, type_compte, montant, codeCompte):
+    # Crédit relatif, comme une transaction : l'argent reçu depuis /makeagent reste sur le compte
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if lock_users(cursor, [numero]).get(numero) is None:
+            return
+        apply_balance_deltas(cursor, {numero: montant})
+        append_ledger(cursor, ledger_rows(str(uuid.uuid4()), "credit_agent", {numero: montant}))
+        cursor.execute("UPDATE users SET type_compte = %s, codeCompte = %s WHERE numero = %s",
+                       (type_compte, codeCompte, numero))
+    user_cache.invalidate(numero)
+
+def get_users_page(after_id=0, limit=USERS_PAGE_SIZE, type_compte=None):
+    # Pagination par clé (id) : coût constant quelle que soit la page demandée
+    with db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT id, nom, numero, solde, type_compte FROM users
+            WHERE id > %s {"AND type_compte = %s" if type_compte else ""}
+            ORDER BY id LIMIT %s
+        """, (after_id, type_compte, limit) if type_compte else (after_id, limit))
+        return cursor.fetchall()
+
+def stream_rows(query, params, fmt, columns):
+    # Lit `query` par un curseur côté serveur, EXPORT_CHUNK_SIZE lignes à la fois, et produit
+    # des morceaux NDJSON ou CSV : la mémoire reste constante quelle que soit la taille de la table
+    # Chaque morceau est produit dans un thread (et un contexte) différent : on ré-étiquette à chaque lecture
+    db_helper.set("stream_rows")
+    with db_connection(write=False) as conn:
+        cursor = get_storage().stream_cursor(conn, EXPORT_CHUNK_SIZE)
+        cursor.execute(query, params)
+        if fmt == "csv":
+            yield ",".join(columns) + "\r\n"
+        while True:
+            db_helper.set("stream_rows")
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            buffer = io.StringIO()
+            if fmt == "csv":
+                csv.writer(buffer).writerows([row[column] for column in columns] for row in rows)
+            else:
+                for row in rows:
+                    buffer.write(json.dumps(row, default=str, ensure_ascii=False))
+                    buffer.write("\n")
+            yield buffer.getvalue()
+
+def history_query(numero, direction="all", type_trans=None, etat=None, date_from=None, date_to=None,
+                  before=None, limit=None):
+    # Une branche par sens (envoyé / reçu), chacune servie par son index (compte, timestamp, id) :
+    # une page coûte le même temps pour 10 lignes ou 10 millions. Sans `limit`, ordre chronologique (relevés).
+    filters = []
+    filter_params = []
+    for clause, value in (("type_trans = %s", type_trans), ("etat = %s", etat),
+                          ("timestamp >= %s", date_from), ("timestamp < %s", date_to)):
+        if value is not None:
+            filters.append(clause)
+            filter_params.append(value)
+    if before is not None:
+        filters.append("(timestamp, id) < (%s, %s)")
+        filter_params.extend(before)
+    extra = "".join(f" AND {clause}" for clause in filters)
+    order = "timestamp DESC, id DESC" if limit else "timestamp, id"
+    limit_sql = " LIMIT %s" if limit else ""
+    columns = ", ".join(HISTORY_COLUMNS[:-1])
+
+    branches = []
+    params = []
+    if direction in ("all", "sent"):
+        branches.append(f"""SELECT * FROM (SELECT {columns}, 'envoyé' AS sens FROM les_transactions
+            WHERE numero_envoyeur = %s{extra} ORDER BY {order}{limit_sql}) AS envoyes""")
+        params += [numero] + filter_params + ([limit] if limit else [])
+    if direction in ("all", "received"):
+        branches.append(f"""SELECT * FROM (SELECT {columns}, 'reçu' AS sens FROM les_transactions
+            WHERE split_part(numero_destinataire, ';', 1) = %s AND numero_envoyeur <> %s{extra}
+            ORDER BY {order}{limit_sql}) AS recus""")
+        params += [numero, numero] + filter_params + ([limit] if limit else [])
+    query = f"SELECT * FROM ({' UNION ALL '.join(branches)}) AS h ORDER BY {order}{limit_sql}"
+    if limit:
+        params.append(limit)
+    return query, tuple(params)
+
+def get_history_page(numero, limit=HISTORY_PAGE_SIZE, **filters):
+    query, params = history_query(numero, limit=limit, **filters)
+    with db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+#####################################
+# Cumuls des marchands (liquider / facturer)
+#####################################
+# Chaque paiement confirmé ajoute sa ligne de détail à premium_services et incrémente, dans la même
+# transaction, les cumuls de son marchand (le destinataire) : par (jour, percepteur, produit, client)
+# dans merchant_rollups, et au total dans merchant_totals. Les tableaux de bord lisent ces cumuls
+# au lieu de sommer l'historique. Les lignes d'un marchand ne sont écrites que sous le verrou de son
+# compte (lock_users) : les cumuls n'ajoutent ni attente ni interblocage.
+MERCHANT_GROUPS = ("jour", "percepteur", "produit", "client")
+PREMIUM_COLUMNS = ["marchand", "client", "produit", "percepteur", "montant", "transaction_hash", "created_at"]
+
+def record_premium_payments(cursor, payments):
+    # `payments` : liste de (marchand, client, produit, percepteur, montant, transaction_hash)
+    now = datetime.now()
+    jour = now.date().isoformat()
+    rollups = {}
+    totals = {}
+    for marchand, client, produit, percepteur, montant, _ in payments:
+        for cumuls, key in ((rollups, (marchand, jour, percepteur, produit, client)), (totals, marchand)):
+            count, total = cumuls.get(key, (0, 0))
+            cumuls[key] = (count + 1, total + montant)
+
+    storage = get_storage()
+    storage.insert_many(cursor, "premium_services", PREMIUM_COLUMNS,
+                        [payment + (now,) for payment in payments], page_size=BULK_PAGE_SIZE)
+    # Pré-agrégés : une même clé ne peut pas être mise à jour deux fois par le même ON CONFLICT
+    storage.insert_many(
+        cursor, "merchant_rollups", ["marchand", "jour", "percepteur", "produit", "client", "paiements", "montant"],
+        [key + value for key, value in sorted(rollups.items())], page_size=BULK_PAGE_SIZE,
+        on_conflict="ON CONFLICT (marchand, jour, percepteur, produit, client) DO UPDATE SET "
+                    "paiements = merchant_rollups.paiements + excluded.paiements, "
+                    "montant = merchant_rollups.montant + excluded.montant"
+    )
+    storage.insert_many(
+        cursor, "merchant_totals", ["marchand", "paiements", "montant", "dernier_paiement"],
+        [(marchand, count, total, now) for marchand, (count, total) in sorted(totals.items())],
+        page_size=BULK_PAGE_SIZE,
+        on_conflict="ON CONFLICT (marchand) DO UPDATE SET "
+                    "paiements = merchant_totals.paiements + excluded.paiements, "
+                    "montant = merchant_totals.montant + excluded.montant, "
+                    "dernier_paiement = excluded.dernier_paiement"
+    )
+
+def merchant_totals(cursor, marchand):
+    cursor.execute("SELECT paiements, montant, dernier_paiement FROM merchant_totals WHERE marchand = %s",
+                   (marchand,))
+    return cursor.fetchone() or {"paiements": 0, "montant": 0.0, "dernier_paiement": None}
+
+def merchant_payments(cursor, marchand, percepteur=None, produit=None, client=None, date_from=None,
+                      date_to=None, before_id=None, limit=MERCHANT_PAGE_SIZE):
+    # Détail par clé (id décroissant) sur l'index (marchand, id) ; date_to incluse
+    filters = ["marchand = %s"]
+    params = [marchand]
+    for clause, value in (("percepteur = %s", percepteur), ("produit = %s", produit), ("client = %s", client),
+                          ("created_at >= %s", date_from and datetime.combine(date_from, datetime.min.time())),
+                          ("created_at < %s", date_to and datetime.combine(date_to + timedelta(days=1),
+                                                                          datetime.min.time())),
+                          ("id < %s", before_id)):
+        if value is not None:
+            filters.append(clause)
+            params.append(value)
+    cursor.execute(f"""
+        SELECT id, transaction_hash, client, produit, percepteur, montant, created_at FROM premium_services
+        WHERE {" AND ".join(filters)} ORDER BY id DESC LIMIT %s
+    """, (*params, limit))
+    return cursor.fetchall()
+
+def get_merchant_dashboard(marchand, before_id=None, limit=MERCHANT_PAGE_SIZE):
+    # Tableau de bord de /balance_pro : une ligne de totaux et une page de détail, sans jointure
+    with db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        return merchant_totals(cursor, marchand), merchant_payments(cursor, marchand, before_id=before_id,
+                                                                    limit=limit)
+
+def get_merchant_payments(marchand, limit=MERCHANT_PAGE_SIZE, **filters):
+    with db_connection(write=False) as conn:
+        return merchant_payments(conn.cursor(), marchand, limit=limit, **filters)
+
+def get_merchant_summary(marchand, group_by, date_from=None, date_to=None, after=None, limit=MERCHANT_PAGE_SIZE):
+    # Ne lit que les cumuls : le coût suit le nombre de groupes, pas le nombre de paiements.
+    # Les jours vont du plus récent au plus ancien, les autres regroupements par ordre alphabétique.
+    if group_by not in MERCHANT_GROUPS:
+        raise ValueError(f"Regroupement inconnu : {group_by}")
+    filters = ["marchand = %s"]
+    params = [marchand]
+    for clause, value in (("jour >= %s", date_from), ("jour <= %s", date_to)):
+        if value is not None:
+            filters.append(clause)
+            params.append(value.isoformat())
+    order, operator = ("DESC", "<") if group_by == "jour" else ("ASC", ">")
+    page_filters = filters + ([f"{group_by} {operator} %s"] if after is not None else [])
+    page_params = params + ([after] if after is not None else [])
+
+    with db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        if date_from is None and date_to is None:
+            totals = merchant_totals(cursor, marchand)
+        else:
+            cursor.execute(f"""
+                SELECT CAST(COALESCE(SUM(paiements), 0) AS BIGINT) AS paiements, COALESCE(SUM(montant), 0) AS montant
+                FROM merchant_rollups WHERE {" AND ".join(filters)}
+            """, tuple(params))
+            totals = {**cursor.fetchone(), "dernier_paiement": None}
+        cursor.execute(f"""
+            SELECT {group_by} AS cle, CAST(SUM(paiements) AS BIGINT) AS paiements, SUM(montant) AS montant
+            FROM merchant_rollups WHERE {" AND ".join(page_filters)}
+            GROUP BY {group_by} ORDER BY {group_by} {order} LIMIT %s
+        """, (*page_params, limit))
+        return totals, cursor.fetchall()
+
+# Durée de validité d'un code_session (inscription ou transaction en attente)
+SESSION_TTL_MINUTES = float(os.environ.get("SESSION_TTL_MINUTES", "15"))
 
 def is_session_expired(timestamp):
     try:
         # Pas besoin de parser, on suppose que c'est déjà un datetime
         if not isinstance(timestamp, datetime):
             timestamp = datetime.strptime(str(timestamp), "%Y-%m-%d %H:%M:%S.%f")
-        return datetime.now() - timestamp > timedelta(minutes=15)
+        return datetime.now() - timestamp > timedelta(minutes=SESSION_TTL_MINUTES)
     except Exception as e:
         logger.error(f"Erreur de conversion du timestamp '{timestamp}': {e}")
         raise HTTPException(status_code=500, detail="Erreur lors de la conversion du timestamp")
 
 
-def calculate_fees(montant, transaction_type):
-    # Pour les les_transactions 'envoi' et 'depot', aucun frais n'est appliqué
-    if transaction_type in ['envoi', 'depot']:
-        return 0
-    fee = 0
-    if montant <= 20000:
-        fee = montant * 0.05
-    elif montant <= 100000:
-        # Taux linéaire décroissant de 5% à 3.5%
-        rate = 0.05 - (montant - 20000) * ((0.05 - 0.035) / (100000 - 20000))
-        fee = montant * rate
-    elif montant <= 200000:
-        # Pour ce palier, taux fixe de 3%
-        fee = montant * 0.03
-    elif montant <= 1000000:
-        # Taux linéaire décroissant de 3% à 1.5% pour les montants de 200000 à 1000000
-        rate = 0.03 - (montant - 200000) * ((0.03 - 0.015) / (1000000 - 200000))
-        fee = montant * rate
-    else:
-        fee = montant * 0.01
-    return fee
+def lock_users(cursor, numeros):
+    # Verrouille les comptes en une requête, toujours dans l'ordre des numéros pour éviter les interblocages
+    cursor.execute(
+        f"SELECT {USER_COLUMNS} FROM users WHERE numero = ANY(%s) ORDER BY numero FOR UPDATE",
+        (sorted(set(numeros)),)
+    )
+    return {row["numero"]: row for row in cursor.fetchall()}
+
+def apply_balance_deltas(cursor, deltas):
+    # Applique des variations relatives de solde (numero -> delta) en une seule requête
+    rows = [(numero, delta) for numero, delta in deltas.items() if delta]
+    if not rows:
+        return
+    get_storage().add_to_balances(cursor, rows)
 
-def process_transaction(numero_envoyeur, numero_destinataire, montant, transaction_type, code_session, code_paie=None, id_paie=None):
-    sender = get_user_by_number(numero_envoyeur)
+#####################################
+# Grand livre (écritures en partie double)
+#####################################
+# Chaque mouvement d'argent ajoute ses écritures à ledger_entries, dans la transaction qui modifie
+# users.solde : une ligne par compte touché (montant signé), équilibrée par '@externe' quand l'argent
+# entre ou sort du système. users.solde reste le solde lu sous verrou pour les contrôles de solvabilité ;
+# le grand livre permet de le reconstruire et de l'auditer. Le solde d'un compte dans le grand livre est
+# son instantané (ledger_snapshots) plus les écritures postérieures, repliées périodiquement.
+LEDGER_COMPANY = "@entreprise"
+LEDGER_EXTERNAL = "@externe"
+LEDGER_COLUMNS = ["transaction_hash", "compte", "montant", "libelle", "created_at"]
+LEDGER_PAGE_SIZE = 500
+LEDGER_SNAPSHOT_INTERVAL = float(os.environ.get("LEDGER_SNAPSHOT_INTERVAL", "300"))
+# Les écritures plus récentes que ce délai (s) ne sont pas repliées : une transaction encore ouverte
+# peut valider une écriture d'id inférieur à celles déjà visibles
+LEDGER_SNAPSHOT_LAG = float(os.environ.get("LEDGER_SNAPSHOT_LAG", "60"))
+LEDGER_SNAPSHOT_CHUNK = int(os.environ.get("LEDGER_SNAPSHOT_CHUNK", "50000"))
+
+ledger_stats = {"runs": 0, "last_run": None, "last_entries": 0, "last_accounts": 0,
+                "total_entries": 0, "last_entry_id": 0, "errors": 0}
+
+
+def ledger_rows(transaction_hash, libelle, deltas, company_delta=0):
+    # Écritures d'un mouvement à partir des variations de solde (cf. transaction_movements)
+    now = datetime.now()
+    rows = [(transaction_hash, numero, delta, libelle, now) for numero, delta in deltas.items() if delta]
+    if company_delta:
+        rows.append((transaction_hash, LEDGER_COMPANY, company_delta, libelle, now))
+    balance = sum(row[2] for row in rows)
+    if balance:
+        rows.append((transaction_hash, LEDGER_EXTERNAL, -balance, libelle, now))
+    return rows
+
+def append_ledger(cursor, rows):
+    if rows:
+        get_storage().insert_many(cursor, "ledger_entries", LEDGER_COLUMNS, rows, page_size=LEDGER_PAGE_SIZE)
+
+def ledger_balance(compte):
+    # Instantané + écritures postérieures (index (compte, id) : quelques lignes à sommer)
+    with db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT solde, last_entry_id, taken_at FROM ledger_snapshots WHERE compte = %s", (compte,))
+        snapshot = cursor.fetchone() or {"solde": 0.0, "last_entry_id": 0, "taken_at": None}
+        cursor.execute("""
+            SELECT COALESCE(SUM(montant), 0) AS tail, COUNT(*) AS entries FROM ledger_entries
+            WHERE compte = %s AND id > %s
+        """, (compte, snapshot["last_entry_id"]))
+        tail = cursor.fetchone()
+        cursor.execute("SELECT solde FROM users WHERE numero = %s", (compte,))
+        user = cursor.fetchone()
+    balance = {
+        "compte": compte,
+        "solde": snapshot["solde"] + tail["tail"],
+        "snapshot_solde": snapshot["solde"],
+        "snapshot_entry_id": snapshot["last_entry_id"],
+        "snapshot_taken_at": snapshot["taken_at"],
+        "entries_after_snapshot": tail["entries"],
+    }
+    if user is not None:
+        # Lu hors verrou : un écart passager est possible pendant qu'un mouvement est validé
+        balance["solde_compte"] = user["solde"]
+        balance["ecart"] = round(user["solde"] - balance["solde"], 6)
+    return balance
+
+def _fold_ledger_chunk(low, high, now):
+    # Un instantané n'avance que vers une écriture plus récente : deux workers qui replient en même
+    # temps écrivent chacun un couple (solde, last_entry_id) cohérent, et le plus avancé l'emporte
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO ledger_snapshots (compte, solde, last_entry_id, taken_at)
+            SELECT e.compte, COALESCE(MAX(s.solde), 0) + SUM(e.montant), MAX(e.id), %s
+            FROM ledger_entries e LEFT JOIN ledger_snapshots s ON s.compte = e.compte
+            WHERE e.id > %s AND e.id <= %s AND e.id > COALESCE(s.last_entry_id, 0)
+            GROUP BY e.compte
+            ON CONFLICT (compte) DO UPDATE SET
+                solde = EXCLUDED.solde, last_entry_id = EXCLUDED.last_entry_id, taken_at = EXCLUDED.taken_at
+            WHERE ledger_snapshots.last_entry_id < EXCLUDED.last_entry_id
+        """, (now, low, high))
+        return cursor.rowcount
+
+def take_ledger_snapshot():
+    # Replie les écritures plus anciennes que LEDGER_SNAPSHOT_LAG dans les instantanés, par tranches
+    # d'ids de LEDGER_SNAPSHOT_CHUNK (une transaction courte chacune)
+    now = datetime.now()
+    with db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        # Toutes les écritures jusqu'au plus grand last_entry_id sont déjà repliées
+        cursor.execute("SELECT COALESCE(MAX(last_entry_id), 0) AS low FROM ledger_snapshots")
+        low = cursor.fetchone()["low"]
+        cursor.execute("SELECT COALESCE(MAX(id), 0) AS high FROM ledger_entries WHERE created_at < %s",
+                       (now - timedelta(seconds=LEDGER_SNAPSHOT_LAG),))
+        high = cursor.fetchone()["high"]
+
+    accounts = 0
+    start = low
+    while start < high:
+        end = min(start + LEDGER_SNAPSHOT_CHUNK, high)
+        accounts += _fold_ledger_chunk(start, end, now)
+        start = end
+
+    entries = max(high - low, 0)
+    ledger_stats["runs"] += 1
+    ledger_stats["last_run"] = now.isoformat()
+    ledger_stats["last_entries"] = entries
+    ledger_stats["last_accounts"] = accounts
+    ledger_stats["total_entries"] += entries
+    ledger_stats["last_entry_id"] = max(high, low)
+    if entries:
+        logger.info(f"Instantané du grand livre : écritures {low + 1} à {high} repliées ({accounts} compte(s))")
+    return {"entries": entries, "accounts": accounts}
+
+
+# Paiements en lot (/transaction_batch) : depot_pro, qui puise dans le compte d'entreprise, en est exclu
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", "1000"))
+BULK_PAGE_SIZE = 500
+BULK_TRANSACTION_TYPES = ['envoi', 'paie', 'depot', 'retrait', 'liquider', 'facturer']
+
+def transaction_movements(numero_envoyeur, destinataire_phone, montant, transaction_type):
+    # Variations de solde d'un mouvement : (numero -> delta, delta du compte d'entreprise, frais prélevés).
+    # `destinataire_phone` vaut None quand le destinataire n'a pas de compte à créditer.
+    # Seuls retrait, liquider et facturer prélèvent les frais du barème ; les autres types en sont exemptés.
+    fee = calculate_fees(montant, transaction_type)
+    applied_fee = 0
+    deltas = {}
+    company_delta = 0
+
+    def add(numero, delta):
+        if numero is not None:
+            deltas[numero] = deltas.get(numero, 0) + delta
+
+    if transaction_type == 'retrait':
+        add(numero_envoyeur, -(montant + fee))
+        company_delta = montant + fee
+        applied_fee = fee
+    elif transaction_type in ['envoi', 'paie', 'depot']:
+        add(numero_envoyeur, -montant)
+        add(destinataire_phone, montant)
+    elif transaction_type in ['liquider', 'facturer']:
+        bonus = fee * 0.2
+        add(numero_envoyeur, -(montant + fee))
+        add(destinataire_phone, bonus)
+        company_delta = fee - bonus
+        applied_fee = fee
+    elif transaction_type == 'depot_pro':
+        add(numero_envoyeur, montant)
+        company_delta = -montant
+    return deltas, company_delta, applied_fee
+
+def process_transaction(cursor, numero_envoyeur, numero_destinataire, montant, transaction_type, code_session, code_paie=None, id_paie=None):
+    # Toutes les écritures passent par `cursor` : l'appelant tient la transaction et la valide (ou l'annule) en bloc
+    destinataire_phone = numero_destinataire.split(';')[0].strip()
+    accounts = lock_users(cursor, [numero_envoyeur, destinataire_phone])
+    sender = accounts.get(numero_envoyeur)
     if not sender:
         return {'detail': 'Utilisateur non trouvé'}, 400
+    recipient = accounts.get(destinataire_phone)
 
     sender_balance = sender['solde']
     montant = float(montant)
@@ -322,50 +1204,19 @@ def process_transaction(numero_envoyeur, numero_destinataire, montant, transacti
     fee = calculate_fees(montant, transaction_type)
     total_debit = montant + fee
 
+    # Contrôles propres à chaque type de transaction
     if transaction_type == 'retrait':
-        recipient = get_user_by_number(numero_destinataire)
         if sender_balance < total_debit:
             return {'detail': 'Solde insuffisant pour le retrait'}, 400
-        new_sender_balance = sender_balance - total_debit
-        update_user_balance(numero_envoyeur, new_sender_balance)
-        update_company_account(montant + fee)
-        transaction_hash = str(uuid.uuid4())
-        conn = get_db_connection()
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE les_transactions SET transaction_hash = %s WHERE code_session = %s", (transaction_hash, code_session))
-            conn.commit()
-        conn.close()
-        
-        return {'detail': f'Le retrait au pres de {recipient["nom"]} effectue avec succes\nVotre solde actuel est '+ new_sender_balance}, 200
 
     elif transaction_type in ['envoi', 'paie']:
         if sender_balance < montant:
             return {'detail': 'Solde insuffisant pour l\'envoi'}, 400
-        new_sender_balance = sender_balance - montant
-        update_user_balance(numero_envoyeur, new_sender_balance)
-        recipient = get_user_by_number(numero_destinataire)
-        if recipient:
-            new_recipient_balance = recipient['solde'] + montant
-            update_user_balance(numero_destinataire, new_recipient_balance)
-        transaction_hash = str(uuid.uuid4())
-        conn = get_db_connection()
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE les_transactions SET transaction_hash = %s WHERE code_session = %s", (transaction_hash, code_session))
-            conn.commit()
-        conn.close()
-        
-        return {'detail': f'Trasaction a {recipient["nom"]} effectue avec succes\nVotre solde actuel est '+ new_sender_balance}, 200
 
     elif transaction_type in ['liquider', 'facturer']:
         parts = numero_destinataire.split(';')
         if len(parts) < 4:
             return {'detail': 'Format invalide pour liquider/payer'}, 400
-
-        destinataire_phone = parts[0].strip()
-        recipient = get_user_by_number(destinataire_phone)
-
         if not recipient:
             return {'detail': 'Destinataire non trouvé'}, 400
 
@@ -373,89 +1224,1008 @@ def process_transaction(numero_envoyeur, numero_destinataire, montant, transacti
         produit = parts[2].strip()
         percepteur = parts[3].strip()
 
-        new_sender_balance = sender_balance - total_debit
-        update_user_balance(numero_envoyeur, new_sender_balance)
-
-        bonus = fee * 0.2
-        new_recipient_balance = recipient['solde'] + bonus
-        update_user_balance(destinataire_phone, new_recipient_balance)
-
-        update_company_account(fee - bonus)
-
-        transaction_hash = str(uuid.uuid4())
-
-        # Mise à jour de la transaction
-        conn = get_db_connection()
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE les_transactions SET transaction_hash = %s WHERE code_session = %s",
-                (transaction_hash, code_session)
-            )
-            conn.commit()
-        conn.close()
-
-        # Insertion dans premium_services
-        conn = get_db_connection()
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO premium_services (client, produit, percepteur, transaction_hash)
-                VALUES (%s, %s, %s, %s)
-            """, (client, produit, percepteur, transaction_hash))
-            conn.commit()
-        conn.close()
-
-        return {
-            'detail': f"Paiement de facture à {recipient['nom']} effectué avec succès\nVotre solde actuel est {new_sender_balance:.2f}"
-        }, 200
-
     elif transaction_type == 'depot':
         if sender_balance < montant:
             return {'detail': 'Solde insuffisant pour le dépôt'}, 400
-        new_sender_balance = sender_balance - montant
-        update_user_balance(numero_envoyeur, new_sender_balance)
-        recipient = get_user_by_number(numero_destinataire)
-        if recipient:
-            new_recipient_balance = recipient['solde'] + montant
-            update_user_balance(numero_destinataire, new_recipient_balance)
-        transaction_hash = str(uuid.uuid4())
-        conn = get_db_connection()
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE les_transactions SET transaction_hash = %s WHERE code_session = %s", (transaction_hash, code_session))
-            conn.commit()
-        conn.close()
-        
-        return {'detail': f'Le depot a {recipient["nom"]} a ete effectue avec succes\nVotre solde actuel est '+ new_sender_balance}, 200
 
     elif transaction_type == 'depot_pro':
         if sender['type_compte'] not in ['agent', 'premium']:
             return {'detail': 'Le compte de l\'envoyeur n\'est pas un agent valide pour depot_pro'}, 400
-        conn = get_db_connection()
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT solde FROM company_account WHERE id = 1")
-            company = cursor.fetchone()
-        conn.close()
-        if not company or company["solde"] < montant:
+        company_solde = lock_company_balance(cursor)
+        if company_solde is None or company_solde < montant:
             return {'detail': 'Fonds insuffisants dans le compte d\'entreprise pour le dépôt pro'}, 400
-        update_company_account(-montant)
-        new_sender_balance = sender_balance + montant
-        update_user_balance(numero_envoyeur, new_sender_balance)
-        transaction_hash = str(uuid.uuid4())
-        conn = get_db_connection()
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE les_transactions SET transaction_hash = %s WHERE code_session = %s", (transaction_hash, code_session))
-            conn.commit()
-        conn.close()
-        
-        return {'detail': f'Envoi d\'agent a : {recipient["nom"]} effectue avec succes\nVotre solde actuel est '+ new_sender_balance}, 200
 
     else:
         return {'detail': 'Type de transaction inconnu'}, 400
 
+    deltas, company_delta, applied_fee = transaction_movements(
+        numero_envoyeur, destinataire_phone if recipient else None, montant, transaction_type
+    )
+    new_sender_balance = sender_balance + deltas.get(numero_envoyeur, 0)
+
+    if transaction_type == 'retrait':
+        detail = f'Le retrait au pres de {recipient["nom"]} effectue avec succes\nVotre solde actuel est {new_sender_balance}'
+    elif transaction_type in ['envoi', 'paie']:
+        detail = f'Trasaction a {recipient["nom"]} effectue avec succes\nVotre solde actuel est {new_sender_balance}'
+    elif transaction_type in ['liquider', 'facturer']:
+        detail = f"Paiement de facture à {recipient['nom']} effectué avec succès\nVotre solde actuel est {new_sender_balance:.2f}"
+    elif transaction_type == 'depot':
+        detail = f'Le depot a {recipient["nom"]} a ete effectue avec succes\nVotre solde actuel est {new_sender_balance}'
+    else:
+        detail = f'Envoi d\'agent a : {(recipient or sender)["nom"]} effectue avec succes\nVotre solde actuel est {new_sender_balance}'
+
+    transaction_hash = str(uuid.uuid4())
+    apply_balance_deltas(cursor, deltas)
+    apply_company_delta(cursor, company_delta)
+    append_ledger(cursor, ledger_rows(transaction_hash, transaction_type, deltas, company_delta))
+    cursor.execute(
+        "UPDATE les_transactions SET transaction_hash = %s, etat = 'completed' WHERE code_session = %s",
+        (transaction_hash, code_session)
+    )
+    premium = None
+    if transaction_type in ['liquider', 'facturer']:
+        premium = (client, produit, percepteur)
+        record_premium_payments(cursor, [(destinataire_phone, client, produit, percepteur, montant, transaction_hash)])
+    enqueue_events(cursor, transaction_events(transaction_hash, transaction_type, numero_envoyeur,
+                                              destinataire_phone if recipient else None, montant, applied_fee,
+                                              premium))
+
+    return {'detail': detail, 'transaction_hash': transaction_hash}, 200
+
+def confirm_pending_transaction(code_session):
+    # Une seule transaction : verrouillage de la ligne, soldes, hash et état validés ensemble
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM les_transactions WHERE code_session = %s FOR UPDATE", (code_session,))
+        transaction = cursor.fetchone()
+
+        if not transaction:
+            raise HTTPException(status_code=400, detail="Code session invalide")
+        if transaction['etat'] != "pending":
+            raise HTTPException(status_code=400, detail="Transaction déjà confirmée ou annulée")
+        # Sous le verrou de ligne : une session expirée pas encore balayée n'est plus confirmable.
+        # Marquée 'expired' ici (validé en sortie de bloc), comme le ferait le balayage
+        expired = is_session_expired(transaction['timestamp'])
+        if expired:
+            cursor.execute("UPDATE les_transactions SET etat = 'expired' WHERE code_session = %s", (code_session,))
+        else:
+            # Traiter la transaction via la fonction process_transaction
+            result, status_code = process_transaction(
+                cursor,
+                transaction['numero_envoyeur'],
+                transaction['numero_destinataire'],
+                transaction['montant'],
+                transaction['type_trans'],
+                code_session
+            )
+            if status_code != 200:
+                raise HTTPException(status_code=status_code, detail=result.get('detail'))
+    if expired:
+        raise HTTPException(status_code=400, detail="Code session expiré")
+    # Invalidation après le commit, pour ne pas remettre en cache un solde pas encore validé
+    user_cache.invalidate(transaction['numero_envoyeur'], transaction['numero_destinataire'].split(';')[0].strip())
+    return result
+
+def process_bulk_transfer(numero_envoyeur, items):
+    # Paiements en lot d'un même envoyeur, dans une seule transaction : tous les comptes sont
+    # verrouillés en une requête, puis soldes, historique, premium_services, cumuls et événements sont écrits par lots.
+    # `items` est une liste de (num_destinataire, montant, transaction_type).
+    destinataires = [num_destinataire.split(';')[0].strip() for num_destinataire, _, _ in items]
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        accounts = lock_users(cursor, [numero_envoyeur] + destinataires)
+        sender = accounts.get(numero_envoyeur)
+        if not sender:
+            raise HTTPException(status_code=400, detail="Envoyeur non trouvé")
+
+        results = []
+        deltas = {}
+        company_delta = 0
+        transaction_rows = []
+        premium_rows = []
+        entries = []
+        events = []
+        for index, ((num_destinataire, montant, transaction_type), destinataire_phone) in enumerate(zip(items, destinataires)):
+            montant = round(float(montant))
+            result = {"index": index, "num_destinataire": num_destinataire, "montant": montant,
+                      "transaction_type": transaction_type}
+            parts = num_destinataire.split(';')
+            if transaction_type not in BULK_TRANSACTION_TYPES:
+                result.update(status="rejected", detail="Type de transaction non autorisé dans un lot")
+            elif montant <= 0:
+                result.update(status="rejected", detail="Montant invalide")
+            elif destinataire_phone not in accounts:
+                result.update(status="rejected", detail="Destinataire non trouvé")
+            elif transaction_type in ['liquider', 'facturer'] and len(parts) < 4:
+                result.update(status="rejected", detail="Format invalide pour liquider/payer")
+            else:
+                item_deltas, item_company_delta, frais = transaction_movements(
+                    numero_envoyeur, destinataire_phone, montant, transaction_type
+                )
+                for numero, delta in item_deltas.items():
+                    deltas[numero] = deltas.get(numero, 0) + delta
+                company_delta += item_company_delta
+                transaction_hash = str(uuid.uuid4())
+                entries.extend(ledger_rows(transaction_hash, transaction_type, item_deltas, item_company_delta))
+                transaction_rows.append((numero_envoyeur, num_destinataire, montant, transaction_type,
+                                         generate_session_code(), 'completed', transaction_hash))
+                premium = None
+                if transaction_type in ['liquider', 'facturer']:
+                    premium = (parts[1].strip(), parts[2].strip(), parts[3].strip())
+                    premium_rows.append((destinataire_phone, *premium, montant, transaction_hash))
+                events.extend(transaction_events(transaction_hash, transaction_type, numero_envoyeur,
+                                                 destinataire_phone, montant, frais, premium))
+                result.update(status="completed", frais=frais, transaction_hash=transaction_hash)
+            results.append(result)
+
+        # Un seul contrôle de solvabilité pour l'ensemble du lot
+        total_debit = -deltas.get(numero_envoyeur, 0)
+        if sender["solde"] < total_debit:
+            raise HTTPException(status_code=400, detail=f"Solde insuffisant pour le lot : {total_debit} requis, {sender['solde']} disponible")
+
+        if transaction_rows:
+            apply_balance_deltas(cursor, deltas)
+            apply_company_delta(cursor, company_delta)
+            storage = get_storage()
+            storage.insert_many(cursor, "les_transactions",
+                                ["numero_envoyeur", "numero_destinataire", "montant", "type_trans",
+                                 "code_session", "etat", "transaction_hash"],
+                                transaction_rows, page_size=BULK_PAGE_SIZE)
+            append_ledger(cursor, entries)
+            if premium_rows:
+                record_premium_payments(cursor, premium_rows)
+            enqueue_events(cursor, events)
+
+    user_cache.invalidate(*deltas)
+    completed = len(transaction_rows)
+    return {
+        "message": f"{completed} paiement(s) effectué(s), {len(items) - completed} rejeté(s)",
+        "total_debit": total_debit,
+        "solde": sender["solde"] - total_debit,
+        "completed": completed,
+        "rejected": len(items) - completed,
+        "items": results,
+    }
+
+#####################################
+# Verrous par compte
+#####################################
+# Deux opérations sur un même compte se suivent ; deux opérations sur des comptes distincts ne
+# s'attendent jamais. Dans un worker, l'attente se fait dans la boucle d'événements, avant tout
+# emprunt de thread ou de connexion : les requêtes en file sur un compte chaud n'immobilisent ni
+# le pool ni l'exécuteur. Entre workers, les verrous de ligne (lock_users, pris dans l'ordre des
+# numéros) sérialisent les écritures, bornés par DB_LOCK_TIMEOUT.
+ACCOUNT_LOCK_TIMEOUT = float(os.environ.get("ACCOUNT_LOCK_TIMEOUT", "5"))
+
+ACCOUNT_LOCKS = registry.counter("mopatas_account_lock_acquisitions_total",
+                                 "Verrous de compte demandés, par issue (immediate, waited, timeout)", ["outcome"])
+ACCOUNT_LOCK_WAIT = registry.histogram("mopatas_account_lock_wait_seconds",
+                                       "Attente d'un verrou de compte déjà tenu dans le worker")
+
+
+class AccountLocks:
+    """
+    Verrous asyncio par compte, créés à la demande et supprimés dès que personne ne les tient
+    ni ne les attend. Les clés sont prises dans l'ordre trié, ce qui exclut les interblocages.
+    """
+
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self._locks = {}  # clé -> [asyncio.Lock, nombre de détenteurs et d'attentes, acquisitions]
+        self._waiting = 0
+
+    @asynccontextmanager
+    async def hold(self, keys):
+        keys = sorted({key for key in keys if key})
+        entries = []
+        for key in keys:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0, 0]
+            entry[1] += 1
+            entries.append(entry)
+        deadline = time.monotonic() + self.timeout
+        acquired = []
+        try:
+            for entry in entries:
+                lock = entry[0]
+                # Même un verrou libre peut être promis à une attente réveillée : toute acquisition
+                # est bornée par l'échéance. Elle est immédiate si le verrou était libre et que
+                # personne ne l'a pris entre-temps.
+                free, seen = not lock.locked(), entry[2]
+                started = time.perf_counter()
+                self._waiting += 1
+                try:
+                    await asyncio.wait_for(lock.acquire(), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    ACCOUNT_LOCKS.inc("timeout")
+                    raise HTTPException(status_code=409, detail="Compte occupé par une autre opération, réessayez")
+                finally:
+                    self._waiting -= 1
+                acquired.append(lock)
+                if free and entry[2] == seen:
+                    ACCOUNT_LOCKS.inc("immediate")
+                else:
+                    ACCOUNT_LOCK_WAIT.observe(time.perf_counter() - started)
+                    ACCOUNT_LOCKS.inc("waited")
+                entry[2] += 1
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            for key, entry in zip(keys, entries):
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    def stats(self):
+        return {"timeout": self.timeout, "keys": len(self._locks), "waiting": self._waiting}
+
+
+account_locks = AccountLocks(ACCOUNT_LOCK_TIMEOUT)
+
+
+def transaction_lock_keys(transaction):
+    # Comptes touchés par la confirmation d'une transaction en attente
+    keys = [transaction["numero_envoyeur"], transaction["numero_destinataire"].split(';')[0].strip()]
+    if transaction["type_trans"] == "depot_pro":
+        keys.append(LEDGER_COMPANY)
+    return keys
+
+
+#####################################
+# Contrôle d'admission et limitation par compte
+#####################################
+# Chaque classe de routes a son plafond de requêtes en cours dans le worker : au-delà, les requêtes
+# attendent leur tour dans la boucle d'événements, au plus ADMISSION_QUEUE_TIMEOUT s. Une requête est
+# refusée tout de suite (503) si la file est pleine ou si l'attente estimée (file × durée moyenne /
+# plafond) dépasse déjà ce délai : en pic, mieux vaut répondre vite « réessayez » que laisser le p99
+# de tout le monde exploser. Plafond à 0 = classe non limitée ; les routes hors classe (/metrics,
+# /*_stats, /test) ne le sont jamais.
+ADMISSION_LIMITS = {
+    "money": int(os.environ.get("ADMISSION_MONEY_LIMIT", str(DB_POOL_MAX))),
+    "read": int(os.environ.get("ADMISSION_READ_LIMIT", str(2 * DB_POOL_MAX))),
+    "admin": int(os.environ.get("ADMISSION_ADMIN_LIMIT", "2")),
+}
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "1"))
+
+ROUTE_CLASSES = {
+    "/transaction": "money",
+    "/confirm_transaction": "money",
+    "/transaction_batch": "money",
+    "/confirm_agent": "money",
+    "/confirm_inscription": "money",
+    # Écritures dans pending_registrations : elles prennent des places d'écriture, pas de lecture
+    "/inscription": "money",
+    "/recup_inscription": "money",
+    "/balance": "read",
+    "/ledger": "read",
+    "/balance_pro": "read",
+    "/merchant/summary": "read",
+    "/merchant/payments": "read",
+    "/history": "read",
+    "/history/export": "read",
+    "/fees/quote": "read",
+    "/users": "admin",
+    "/users/export": "admin",
+    "/makeagent": "admin",
+    "/outbox_stats": "admin",
+}
+
+# Jetons par numéro (par worker) pour /transaction et /balance : RATE_LIMIT_BURST requêtes d'affilée,
+# puis RATE_LIMIT_PER_SECOND par seconde. RATE_LIMIT_PER_SECOND=0 désactive la limitation.
+# Le seau n'est débité qu'après authentification : un tiers qui ne connaît que le numéro ne peut
+# pas maintenir le titulaire en 429.
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", "2"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_KEYS = int(os.environ.get("RATE_LIMIT_KEYS", "100000"))
+
+ADMISSIONS = registry.counter("mopatas_admission_total",
+                              "Requêtes par classe et issue (admitted, queued, shed_full, shed_estimate, shed_timeout)",
+                              ["class", "outcome"])
+ADMISSION_WAIT = registry.histogram("mopatas_admission_wait_seconds",
+                                    "Attente en file avant admission, par classe", ["class"])
+RATE_LIMITED = registry.counter("mopatas_rate_limited_total",
+                                "Requêtes refusées par la limitation par numéro, par route", ["route"])
+
+
+class AdmissionGate:
+    """
+    Plafond de requêtes en cours avec file d'attente FIFO bornée dans le temps et en longueur.
+    Toutes les méthodes s'exécutent dans la boucle d'événements : aucun verrou n'est nécessaire.
+    """
+
+    def __init__(self, name, limit, queue_size=64, timeout=1.0):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._inflight = 0
+        self._waiters = deque()
+        self._service_time = 0.0  # moyenne glissante de la durée d'une requête admise (s)
+        self._stats = {"admitted": 0, "queued": 0, "shed_full": 0, "shed_estimate": 0, "shed_timeout": 0}
+
+    def _shed(self, outcome):
+        self._stats[outcome] += 1
+        ADMISSIONS.inc(self.name, outcome)
+        return False
+
+    async def acquire(self):
+        # True si la requête est admise (release() à appeler), False si elle doit être refusée
+        if self._inflight < self.limit and not self._waiters:
+            self._inflight += 1
+            self._stats["admitted"] += 1
+            ADMISSIONS.inc(self.name, "admitted")
+            return True
+        if len(self._waiters) >= self.queue_size:
+            return self._shed("shed_full")
+        if (len(self._waiters) + 1) * self._service_time / self.limit > self.timeout:
+            return self._shed("shed_estimate")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait([waiter], timeout=self.timeout)
+        except asyncio.CancelledError:
+            # Client parti : on quitte la file, ou on rend la place que release() venait de céder
+            if waiter.done():
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            raise
+        finally:
+            ADMISSION_WAIT.observe(time.perf_counter() - started, self.name)
+        if not waiter.done():
+            waiter.cancel()
+            self._waiters.remove(waiter)
+            return self._shed("shed_timeout")
+        self._stats["queued"] += 1
+        ADMISSIONS.inc(self.name, "queued")
+        return True
+
+    def release(self, elapsed=None):
+        if elapsed is not None:
+            self._service_time += (elapsed - self._service_time) * 0.1
+        # La place passe directement au premier en file encore en attente
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._inflight -= 1
+
+    def stats(self):
+        return {"limit": self.limit, "inflight": self._inflight, "waiting": len(self._waiters),
+                "service_time": self._service_time, **self._stats}
+
+
+class RateLimiter:
+    """
+    Seau à jetons par clé, dans un LRU borné : une clé évincée repart avec un seau plein.
+    """
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # clé -> [jetons, instant de la dernière mise à jour]
+        self._stats = {"allowed": 0, "limited": 0}
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def check(self, route, key):
+        # Lève une 429 (avec Retry-After) si `key` a épuisé ses jetons
+        if not self.enabled or not key:
+            return
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self._stats["limited"] += 1
+            RATE_LIMITED.inc(route)
+            retry_after = math.ceil((1 - bucket[0]) / self.rate)
+            raise HTTPException(status_code=429, detail="Trop de requêtes pour ce numéro, réessayez plus tard",
+                                headers={"Retry-After": str(retry_after)})
+        bucket[0] -= 1
+        self._stats["allowed"] += 1
+
+    def stats(self):
+        return {"enabled": self.enabled, "rate": self.rate, "burst": self.burst, "keys": len(self._buckets),
+                **self._stats}
+
+
+admission_gates = {name: AdmissionGate(name, limit, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+                   for name, limit in ADMISSION_LIMITS.items() if limit > 0}
+rate_limiter = RateLimiter(RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST, RATE_LIMIT_KEYS)
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    # Les exports en flux libèrent leur place à l'envoi des en-têtes, comme pour les métriques HTTP
+    gate = admission_gates.get(ROUTE_CLASSES.get(request.url.path))
+    if gate is None:
+        return await call_next(request)
+    if not await gate.acquire():
+        return JSONResponse({"detail": "Service saturé, réessayez dans un instant"}, status_code=503,
+                            headers={"Retry-After": "1"})
+    started = time.perf_counter()
+    try:
+        return await call_next(request)
+    finally:
+        gate.release(time.perf_counter() - started)
+
+
+# Configuration CORS : autorise toutes les origines (à restreindre en production). Ajoutée après les
+# autres middlewares, elle les enveloppe tous : les 503 du contrôle d'admission portent aussi les
+# en-têtes CORS, et le navigateur peut honorer leur Retry-After
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["GET", "POST"],
+    allow_headers=["*"],
+    expose_headers=["Retry-After"],
+)
+
+
+#####################################
+# Idempotence (/transaction, /confirm_transaction)
+#####################################
+# Un client qui rejoue une requête avec le même en-tête Idempotency-Key reçoit la réponse
+# enregistrée, sans toucher aux tables users ni les_transactions. Les réponses récentes sont
+# aussi gardées en mémoire : un rejeu servi par le même worker ne fait aucune requête SQL.
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_KEY_MAX = 255
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# Attente maximum (s) d'un doublon dont l'original tourne sur un autre worker
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", "10"))
+# Au-delà (s), un original toujours sans réponse est considéré perdu (worker arrêté) et peut être repris
+IDEMPOTENCY_STALE = float(os.environ.get("IDEMPOTENCY_STALE", "60"))
+# Réponses à ne pas rejouer : le client doit pouvoir réessayer
+IDEMPOTENCY_RETRYABLE = {408, 409, 429}
+# Champs secrets exclus de l'empreinte : stockée dans idempotency_keys, un sha256 qui les couvrirait
+# permettrait de tester des mots de passe hors ligne
+IDEMPOTENCY_SECRET_FIELDS = {"pass_word", "company_pass", "codeCompte"}
+
+
+def claim_idempotency_key(endpoint, key, fingerprint):
+    # Réserve la clé : None si elle nous revient, sinon la ligne existante
+    now = datetime.now()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO idempotency_keys (endpoint, idem_key, fingerprint, created_at)
+            VALUES (%s, %s, %s, %s) ON CONFLICT (endpoint, idem_key) DO NOTHING
+        """, (endpoint, key, fingerprint, now))
+        if cursor.rowcount == 1:
+            return None
+        cursor.execute("""
+            UPDATE idempotency_keys SET created_at = %s
+            WHERE endpoint = %s AND idem_key = %s AND fingerprint = %s
+              AND status_code IS NULL AND created_at < %s
+        """, (now, endpoint, key, fingerprint, now - timedelta(seconds=IDEMPOTENCY_STALE)))
+        if cursor.rowcount == 1:
+            return None
+        cursor.execute("""
+            SELECT fingerprint, status_code, response FROM idempotency_keys
+            WHERE endpoint = %s AND idem_key = %s
+        """, (endpoint, key))
+        # None si l'original vient d'échouer et de libérer la clé : l'appelant réessaie
+        return cursor.fetchone()
+
+def get_idempotency_key(endpoint, key):
+    with db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT fingerprint, status_code, response FROM idempotency_keys
+            WHERE endpoint = %s AND idem_key = %s
+        """, (endpoint, key))
+        return cursor.fetchone()
+
+def complete_idempotency_key(endpoint, key, status_code, response):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE idempotency_keys SET status_code = %s, response = %s
+            WHERE endpoint = %s AND idem_key = %s
+        """, (status_code, response, endpoint, key))
+
+def release_idempotency_key(endpoint, key):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM idempotency_keys WHERE endpoint = %s AND idem_key = %s AND status_code IS NULL",
+                       (endpoint, key))
+
+
+class IdempotencyStore:
+    """
+    Réponses enregistrées par (route, Idempotency-Key) : cache mémoire du worker devant la table
+    idempotency_keys, partagée entre workers. Les doublons concurrents d'une requête en cours
+    attendent l'original au lieu de s'exécuter une seconde fois.
+    """
+
+    def __init__(self, ttl=86400.0, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._done = OrderedDict()  # (route, clé) -> (empreinte, statut, corps, expiration)
+        self._inflight = {}  # (route, clé) -> Future résolue quand l'original a fini
+        self._stats = {"requests": 0, "replays": 0, "waits": 0, "mismatches": 0, "executions": 0}
+
+    def _cached(self, ident):
+        entry = self._done.get(ident)
+        if entry is None:
+            return None
+        if entry[3] < time.monotonic():
+            del self._done[ident]
+            return None
+        return entry
+
+    def _remember(self, ident, fingerprint, status_code, body):
+        if self.maxsize <= 0:
+            return
+        self._done[ident] = (fingerprint, status_code, body, time.monotonic() + self.ttl)
+        self._done.move_to_end(ident)
+        while len(self._done) > self.maxsize:
+            self._done.popitem(last=False)
+
+    def _replay(self, fingerprint, entry):
+        if entry[0] != fingerprint:
+            self._stats["mismatches"] += 1
+            raise HTTPException(status_code=422, detail=f"{IDEMPOTENCY_HEADER} déjà utilisée pour une autre requête")
+        self._stats["replays"] += 1
+        return JSONResponse(status_code=entry[1], content=entry[2], headers={"Idempotent-Replayed": "true"})
+
+    async def _wait_remote(self, endpoint, key):
+        # L'original tourne sur un autre worker : on relit la table jusqu'à sa réponse
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            row = await run_db(get_idempotency_key, endpoint, key)
+            if row is None or row["status_code"] is not None:
+                return row
+        raise HTTPException(status_code=409, detail="Une requête identique est en cours de traitement, réessayez")
+
+    async def run(self, request, endpoint, payload, handler):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return await handler()
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX:
+            raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} invalide")
+        self._stats["requests"] += 1
+        payload = {field: value for field, value in payload.items() if field not in IDEMPOTENCY_SECRET_FIELDS}
+        fingerprint = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+        ident = (endpoint, key)
+
+        while True:
+            entry = self._cached(ident)
+            if entry is not None:
+                return self._replay(fingerprint, entry)
+            inflight = self._inflight.get(ident)
+            if inflight is not None:
+                self._stats["waits"] += 1
+                await asyncio.shield(inflight)
+                continue
+
+            # Enregistrée avant le premier await : un doublon arrivant entre-temps attend cette requête
+            claim = asyncio.get_running_loop().create_future()
+            self._inflight[ident] = claim
+            try:
+                row = await run_db(claim_idempotency_key, endpoint, key, fingerprint)
+                if row is None:
+                    return await self._execute(ident, fingerprint, handler)
+            finally:
+                self._inflight.pop(ident, None)
+                claim.set_result(None)
+
+            if row is not None and row["status_code"] is None:
+                row = await self._wait_remote(endpoint, key)
+            if row is None:
+                continue
+            entry = (row["fingerprint"], row["status_code"], json.loads(row["response"]), time.monotonic() + self.ttl)
+            if row["fingerprint"] == fingerprint:
+                self._remember(ident, *entry[:3])
+            return self._replay(fingerprint, entry)
+
+    async def _execute(self, ident, fingerprint, handler):
+        endpoint, key = ident
+        self._stats["executions"] += 1
+        try:
+            status_code, body = 200, await handler()
+        except HTTPException as e:
+            if e.status_code >= 500 or e.status_code in IDEMPOTENCY_RETRYABLE:
+                await run_db(release_idempotency_key, endpoint, key)
+                raise
+            status_code, body = e.status_code, {"detail": e.detail}
+        except BaseException:
+            # Erreur inattendue ou client parti : la clé est libérée pour qu'un rejeu s'exécute
+            try:
+                await run_db(release_idempotency_key, endpoint, key)
+            except Exception as e:
+                logger.error(f"Libération de la clé d'idempotence {key} impossible: {e}")
+            raise
+        await run_db(complete_idempotency_key, endpoint, key, status_code, json.dumps(body, default=str))
+        self._remember(ident, fingerprint, status_code, body)
+        return JSONResponse(status_code=status_code, content=body)
+
+    def stats(self):
+        return {"ttl": self.ttl, "size": len(self._done), "inflight": len(self._inflight), **self._stats}
+
+
+idempotency = IdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_SIZE)
+
+
+#####################################
+# Boîte d'envoi (outbox) des effets de bord
+#####################################
+# Reçus SMS, webhooks marchands, reçus QR… ne tournent jamais sur le chemin de la requête : chaque
+# transaction confirmée inscrit ses événements dans outbox_events, dans la transaction qui modifie les
+# soldes (pas d'événement sans paiement, pas de paiement sans événement). Une tâche de fond par worker
+# réserve les événements dus par lots (SKIP LOCKED, puis un bail de OUTBOX_LEASE s tenu hors transaction
+# pendant la livraison), les livre au plus OUTBOX_CONCURRENCY à la fois et réessaie les échecs avec un
+# délai croissant. Livraison au moins une fois : le destinataire dédoublonne sur l'id de l'événement.
+# OUTBOX_POLL_INTERVAL=0 désactive la livraison sur ce worker.
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_CONCURRENCY = int(os.environ.get("OUTBOX_CONCURRENCY", "10"))
+OUTBOX_DELIVERY_TIMEOUT = float(os.environ.get("OUTBOX_DELIVERY_TIMEOUT", "5"))
+OUTBOX_LEASE = float(os.environ.get("OUTBOX_LEASE", "60"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE = float(os.environ.get("OUTBOX_RETRY_BASE", "2"))
+OUTBOX_RETRY_MAX = float(os.environ.get("OUTBOX_RETRY_MAX", "600"))
+# Les événements livrés sont purgés par le balayage au bout de OUTBOX_RETENTION s
+OUTBOX_RETENTION = float(os.environ.get("OUTBOX_RETENTION", "604800"))
+# Destination locale de substitution (cf. LocalSink)
+OUTBOX_SINK_PATH = os.environ.get("OUTBOX_SINK_PATH")
+OUTBOX_SINK_DELAY = float(os.environ.get("OUTBOX_SINK_DELAY", "0"))
+OUTBOX_SINK_FAILURE_RATE = float(os.environ.get("OUTBOX_SINK_FAILURE_RATE", "0"))
+OUTBOX_COLUMNS = ["event_type", "transaction_hash", "payload", "available_at", "created_at"]
+OUTBOX_LAG_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+OUTBOX_EVENTS = registry.counter("mopatas_outbox_events_total",
+                                 "Événements de l'outbox traités, par type et issue (delivered, retried, failed)",
+                                 ["event_type", "outcome"])
+OUTBOX_LAG = registry.histogram("mopatas_outbox_delivery_lag_seconds",
+                                "Délai entre l'écriture d'un événement et sa livraison, par type", ["event_type"],
+                                OUTBOX_LAG_BUCKETS)
+
+outbox_stats = {"batches": 0, "last_run": None, "last_batch": 0, "in_flight": 0, "delivered": 0,
+                "retried": 0, "failed": 0, "lag_seconds": 0.0, "errors": 0}
+
+
+def transaction_events(transaction_hash, transaction_type, numero_envoyeur, destinataire, montant, frais,
+                       premium=None):
+    # Événements d'une transaction confirmée ; `premium` : (client, produit, percepteur) d'un liquider/facturer
+    events = [("transaction_confirmee", transaction_hash, {
+        "transaction_hash": transaction_hash, "type_trans": transaction_type, "numero_envoyeur": numero_envoyeur,
+        "numero_destinataire": destinataire, "montant": montant, "frais": frais,
+    })]
+    if premium is not None:
+        client, produit, percepteur = premium
+        events.append(("paiement_marchand", transaction_hash, {
+            "transaction_hash": transaction_hash, "marchand": destinataire, "client": client,
+            "produit": produit, "percepteur": percepteur, "montant": montant,
+        }))
+    return events
+
+def enqueue_events(cursor, events):
+    # Dans la transaction de l'appelant : les événements sont validés ou annulés avec les soldes
+    if not events:
+        return
+    now = datetime.now()
+    rows = [(event_type, transaction_hash, json.dumps(payload, ensure_ascii=False), now, now)
+            for event_type, transaction_hash, payload in events]
+    get_storage().insert_many(cursor, "outbox_events", OUTBOX_COLUMNS, rows, page_size=BULK_PAGE_SIZE)
+
+def claim_outbox_batch(limit=OUTBOX_BATCH_SIZE):
+    # Transaction courte : les lignes réservées sont repoussées de OUTBOX_LEASE s, ce qui les cache aux
+    # autres workers pendant la livraison ; celles d'un worker arrêté en route reviennent à la fin du bail
+    now = datetime.now()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE outbox_events SET available_at = %s, attempts = attempts + 1 WHERE id IN (
+                SELECT id FROM outbox_events
+                WHERE status = 'pending' AND available_at <= %s
+                ORDER BY available_at, id LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, event_type, transaction_hash, payload, attempts, created_at
+        """, (now + timedelta(seconds=OUTBOX_LEASE), now, limit))
+        return sorted(cursor.fetchall(), key=lambda row: row["id"])
+
+def complete_outbox_batch(results):
+    # `results` : liste de (événement réservé, erreur ou None). Un échec n'est enregistré que si l'événement
+    # n'a pas été réservé de nouveau entre-temps (bail expiré pendant la livraison)
+    now = datetime.now()
+    delivered = [event["id"] for event, error in results if error is None]
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if delivered:
+            cursor.execute("""
+                UPDATE outbox_events SET status = 'delivered', delivered_at = %s, last_error = NULL
+                WHERE id = ANY(%s)
+            """, (now, delivered))
+        for event, error in results:
+            if error is None:
+                continue
+            if event["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                cursor.execute("""
+                    UPDATE outbox_events SET status = 'failed', last_error = %s
+                    WHERE id = %s AND status = 'pending' AND attempts = %s
+                """, (error, event["id"], event["attempts"]))
+            else:
+                delay = min(OUTBOX_RETRY_BASE * 2 ** (event["attempts"] - 1), OUTBOX_RETRY_MAX)
+                cursor.execute("""
+                    UPDATE outbox_events SET available_at = %s, last_error = %s
+                    WHERE id = %s AND status = 'pending' AND attempts = %s
+                """, (now + timedelta(seconds=delay), error, event["id"], event["attempts"]))
+
+def outbox_backlog():
+    # Pour /outbox_stats : événements en attente (y compris en cours de réessai) et abandonnés
+    with db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT status, COUNT(*) AS events FROM outbox_events
+            WHERE status IN ('pending', 'failed') GROUP BY status
+        """)
+        counts = {row["status"]: row["events"] for row in cursor.fetchall()}
+        # Colonne lue telle quelle (et non MIN()) : SQLite ne convertit pas le résultat d'un agrégat
+        cursor.execute("SELECT created_at FROM outbox_events WHERE status = 'pending' ORDER BY id LIMIT 1")
+        oldest = cursor.fetchone()
+    return {
+        "pending_events": counts.get("pending", 0),
+        "oldest_pending_s": (datetime.now() - oldest["created_at"]).total_seconds() if oldest else 0.0,
+        "failed_events": counts.get("failed", 0),
+    }
+
+
+class LocalSink:
+    """
+    Destination de substitution, en attendant les passerelles SMS, webhooks et reçus QR : chaque événement
+    livré est ajouté au fichier NDJSON `path` (à défaut, au journal). `delay` et `failure_rate` simulent
+    la latence et les erreurs d'un service distant. Une destination réelle est un appelable asynchrone
+    de même signature, qui lève une exception en cas d'échec.
+    """
+
+    def __init__(self, path=None, delay=0.0, failure_rate=0.0):
+        self.path = path
+        self.delay = delay
+        self.failure_rate = failure_rate
+
+    async def __call__(self, event):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise ConnectionError("échec simulé de la destination")
+        line = json.dumps({"id": event["id"], "event_type": event["event_type"],
+                           "transaction_hash": event["transaction_hash"], "attempts": event["attempts"],
+                           "payload": json.loads(event["payload"])}, ensure_ascii=False)
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as sink_file:
+                sink_file.write(line + "\n")
+        else:
+            logger.info(f"Événement livré : {line}")
+
+
+outbox_sink = LocalSink(OUTBOX_SINK_PATH, OUTBOX_SINK_DELAY, OUTBOX_SINK_FAILURE_RATE)
+
+
+async def deliver_event(event, semaphore):
+    async with semaphore:
+        try:
+            await asyncio.wait_for(outbox_sink(event), OUTBOX_DELIVERY_TIMEOUT)
+            return event, None
+        except asyncio.TimeoutError:
+            return event, f"délai de {OUTBOX_DELIVERY_TIMEOUT}s dépassé"
+        except Exception as e:
+            return event, f"{type(e).__name__}: {e}"
+
+
+async def dispatch_outbox_batch(semaphore):
+    events = await run_db(claim_outbox_batch)
+    outbox_stats["batches"] += 1
+    outbox_stats["last_run"] = datetime.now().isoformat()
+    outbox_stats["last_batch"] = len(events)
+    # Retard de la livraison : âge du plus ancien événement réservé (0 quand rien n'est dû)
+    outbox_stats["lag_seconds"] = (
+        (datetime.now() - min(event["created_at"] for event in events)).total_seconds() if events else 0.0
+    )
+    if not events:
+        return 0
+
+    outbox_stats["in_flight"] = len(events)
+    try:
+        results = await asyncio.gather(*(deliver_event(event, semaphore) for event in events))
+    finally:
+        outbox_stats["in_flight"] = 0
+    await run_db(complete_outbox_batch, results)
+
+    now = datetime.now()
+    for event, error in results:
+        if error is None:
+            outcome = "delivered"
+            OUTBOX_LAG.observe((now - event["created_at"]).total_seconds(), event["event_type"])
+        elif event["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            outcome = "failed"
+            logger.error(f"Événement {event['id']} ({event['event_type']}) abandonné après "
+                         f"{event['attempts']} tentative(s) : {error}")
+        else:
+            outcome = "retried"
+        OUTBOX_EVENTS.inc(event["event_type"], outcome)
+        outbox_stats[outcome] += 1
+    return len(events)
+
+
+async def outbox_dispatcher():
+    semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    while True:
+        try:
+            claimed = await dispatch_outbox_batch(semaphore)
+        except Exception as e:
+            claimed = 0
+            outbox_stats["errors"] += 1
+            logger.error(f"Erreur lors de la livraison de l'outbox: {e}")
+        # Lot plein : il reste des événements dus, on enchaîne sans attendre
+        if claimed < OUTBOX_BATCH_SIZE:
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+
+#####################################
+# Balayage des sessions expirées
+#####################################
+# Tâche de fond par worker : supprime les inscriptions en attente et marque 'expired' les transactions
+# restées 'pending' au-delà de SESSION_TTL_MINUTES, par lots courts (SKIP LOCKED : jamais d'attente
+# sur une ligne tenue par une requête). EXPIRY_SWEEP_INTERVAL=0 désactive le balayage sur ce worker.
+EXPIRY_SWEEP_INTERVAL = float(os.environ.get("EXPIRY_SWEEP_INTERVAL", "60"))
+EXPIRY_SWEEP_CHUNK = int(os.environ.get("EXPIRY_SWEEP_CHUNK", "1000"))
+
+expiry_stats = {"runs": 0, "last_run": None, "last_registrations": 0, "last_transactions": 0,
+                "last_idempotency_keys": 0, "last_outbox_events": 0, "total_registrations": 0,
+                "total_transactions": 0, "total_idempotency_keys": 0, "total_outbox_events": 0, "errors": 0}
+
+
+def _sweep_chunk(query, cutoff):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, (cutoff, EXPIRY_SWEEP_CHUNK))
+        return cursor.rowcount
+
+
+def sweep_expired_sessions():
+    # Chaque lot est une transaction courte ; on s'arrête dès qu'un lot n'est pas plein
+    swept = {"registrations": 0, "transactions": 0, "idempotency_keys": 0, "outbox_events": 0}
+    # Même horloge que is_session_expired
+    now = datetime.now()
+    cutoff = now - timedelta(minutes=SESSION_TTL_MINUTES)
+    for key, cutoff, query in (
+        ("registrations", cutoff, """
+            DELETE FROM pending_registrations WHERE id IN (
+                SELECT id FROM pending_registrations
+                WHERE timestamp < %s
+                ORDER BY timestamp LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        """),
+        ("transactions", cutoff, """
+            UPDATE les_transactions SET etat = 'expired' WHERE id IN (
+                SELECT id FROM les_transactions
+                WHERE etat = 'pending' AND timestamp < %s
+                ORDER BY timestamp LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        """),
+        ("idempotency_keys", now - timedelta(seconds=IDEMPOTENCY_TTL), """
+            DELETE FROM idempotency_keys WHERE id IN (
+                SELECT id FROM idempotency_keys
+                WHERE created_at < %s
+                ORDER BY created_at LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        """),
+        ("outbox_events", now - timedelta(seconds=OUTBOX_RETENTION), """
+            DELETE FROM outbox_events WHERE id IN (
+                SELECT id FROM outbox_events
+                WHERE status = 'delivered' AND delivered_at < %s
+                ORDER BY delivered_at LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        """),
+    ):
+        while True:
+            count = _sweep_chunk(query, cutoff)
+            swept[key] += count
+            if count < EXPIRY_SWEEP_CHUNK:
+                break
+
+    expiry_stats["runs"] += 1
+    expiry_stats["last_run"] = datetime.now().isoformat()
+    expiry_stats["last_registrations"] = swept["registrations"]
+    expiry_stats["last_transactions"] = swept["transactions"]
+    expiry_stats["total_registrations"] += swept["registrations"]
+    expiry_stats["total_transactions"] += swept["transactions"]
+    expiry_stats["last_idempotency_keys"] = swept["idempotency_keys"]
+    expiry_stats["total_idempotency_keys"] += swept["idempotency_keys"]
+    expiry_stats["last_outbox_events"] = swept["outbox_events"]
+    expiry_stats["total_outbox_events"] += swept["outbox_events"]
+    logger.info(f"Balayage des sessions expirées : {swept['registrations']} inscription(s) supprimée(s), "
+                f"{swept['transactions']} transaction(s) expirée(s), "
+                f"{swept['idempotency_keys']} clé(s) d'idempotence supprimée(s), "
+                f"{swept['outbox_events']} événement(s) livré(s) purgé(s)")
+    return swept
+
+
+async def expiry_sweeper():
+    while True:
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+        try:
+            await run_db(sweep_expired_sessions)
+        except Exception as e:
+            expiry_stats["errors"] += 1
+            logger.error(f"Erreur lors du balayage des sessions expirées: {e}")
+
+
+async def ledger_snapshotter():
+    while True:
+        await asyncio.sleep(LEDGER_SNAPSHOT_INTERVAL)
+        try:
+            await run_db(take_ledger_snapshot)
+        except Exception as e:
+            ledger_stats["errors"] += 1
+            logger.error(f"Erreur lors de l'instantané du grand livre: {e}")
+
+
+async def company_folder():
+    while True:
+        await asyncio.sleep(COMPANY_FOLD_INTERVAL)
+        try:
+            await run_db(fold_company_stripes)
+        except Exception as e:
+            company_stats["errors"] += 1
+            logger.error(f"Erreur lors du reversement des bandes du compte d'entreprise: {e}")
+
+
+_background_tasks = []
+
+
+async def start_worker():
+    # Le pool de connexions naît ici (premier emprunt), pas à l'import ; les processus de
+    # hachage, eux, attendent le premier mot de passe à vérifier
+    started = time.perf_counter()
+    version = await run_db(check_schema)
+    if EXPIRY_SWEEP_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(expiry_sweeper()))
+    if LEDGER_SNAPSHOT_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(ledger_snapshotter()))
+    if COMPANY_STRIPES > 0 and COMPANY_FOLD_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(company_folder()))
+    if OUTBOX_POLL_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(outbox_dispatcher()))
+    logger.info(f"Worker prêt en {time.perf_counter() - started:.3f}s (schéma version {version})")
+
+
+async def stop_worker():
+    global _storage
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    credentials.close()
+    if _storage is not None:
+        _storage.close()
+        _storage = None
+
 #####################################
 # Endpoints FastAPI
 #####################################
@@ -464,116 +2234,196 @@ def process_transaction(numero_envoyeur, numero_destinataire, montant, transacti
 def test_endpoint():
     return {"message": "Merci d'utiliser Mopatas"}
 
+@app.get("/pool_stats")
+def pool_stats_endpoint():
+    # Statistiques du pool de ce worker, pour dimensionner DB_POOL_MIN / DB_POOL_MAX (ou SQLITE_READERS)
+    return get_storage().stats()
+
+@app.get("/expiry_stats")
+def expiry_stats_endpoint():
+    # Lignes balayées par le dernier passage et depuis le démarrage du worker
+    return expiry_stats
+
+@app.get("/ledger_stats")
+def ledger_stats_endpoint():
+    # Dernier repli des écritures du grand livre dans les instantanés
+    return ledger_stats
+
+@app.get("/admission_stats")
+def admission_stats_endpoint():
+    # File et refus par classe de routes, et limitation par numéro, pour régler les plafonds de ce worker
+    return {"classes": {name: gate.stats() for name, gate in admission_gates.items()},
+            "rate_limit": rate_limiter.stats()}
+
+@app.get("/cache_stats")
+def cache_stats_endpoint():
+    # Compteurs du cache utilisateurs de ce worker (hits/misses inter-requêtes et par requête)
+    return user_cache.stats()
+
+@app.get("/outbox_stats")
+async def outbox_stats_endpoint():
+    # Livraison de ce worker et, pour toute la base, événements en attente et abandonnés
+    return {**outbox_stats, **await run_db(outbox_backlog)}
+
+
+registry.gauges("mopatas_db_pool", "Pool de connexions du worker (cf. /pool_stats)", lambda: get_storage().stats())
+registry.gauges("mopatas_user_cache", "Cache utilisateurs du worker (cf. /cache_stats)", lambda: user_cache.stats())
+registry.gauges("mopatas_credentials", "Vérification des mots de passe du worker", lambda: credentials.stats())
+registry.gauges("mopatas_idempotency", "Clés d'idempotence du worker", lambda: idempotency.stats())
+registry.gauges("mopatas_account_locks", "Verrous de compte du worker", lambda: account_locks.stats())
+for _name, _gate in admission_gates.items():
+    registry.gauges(f"mopatas_admission_{_name}", "Contrôle d'admission du worker (cf. /admission_stats)", _gate.stats)
+registry.gauges("mopatas_rate_limit", "Limitation par numéro du worker", lambda: rate_limiter.stats())
+registry.gauges("mopatas_company", "Bandes du compte d'entreprise", lambda: company_stats)
+registry.gauges("mopatas_ledger", "Instantanés du grand livre (cf. /ledger_stats)", lambda: ledger_stats)
+registry.gauges("mopatas_expiry", "Balayage des sessions expirées (cf. /expiry_stats)", lambda: expiry_stats)
+registry.gauges("mopatas_outbox", "Livraison de l'outbox par le worker (cf. /outbox_stats)", lambda: outbox_stats)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    # Format texte Prometheus, métriques de ce worker uniquement
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+#####################################
+# Modèles des requêtes et réponses JSON
+#####################################
+# Les corps sont validés par pydantic avant l'appel de l'endpoint : une requête mal formée est
+# refusée (422) sans requête SQL ni hachage de mot de passe. Les réponses déclarées par
+# response_model sont sérialisées par pydantic ; les grandes listes (/users, /history,
+# /fees/quote) sont renvoyées telles quelles par FastJSONResponse.
+TransactionType = Literal["envoi", "paie", "depot", "retrait", "liquider", "facturer", "depot_pro"]
+TypeCompte = Literal["standard", "agent", "premium"]
+ExportFormat = Literal["ndjson", "csv"]
+# Numéro saisi (le destinataire peut porter client;produit;percepteur) et secret : bornés pour
+# qu'un corps démesuré ne parte ni en base ni dans scrypt
+Numero = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=255)]
+Secret = Annotated[str, StringConstraints(max_length=128)]
+Montant = Annotated[float, Field(gt=0, allow_inf_nan=False)]
+Confirmation = Annotated[bool, BeforeValidator(parse_confirmation)]
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Type non sérialisable en JSON : {type(value).__name__}")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    Réponse JSON écrite directement, sans validation ni passage par jsonable_encoder : orjson
+    s'il est installé (dates et tableaux numpy natifs), sinon json compact.
+    """
+
+    def render(self, content):
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+
+class SessionResponse(BaseModel):
+    message: str
+    code_session: str
+
+class DetailResponse(BaseModel):
+    detail: str
+
+
 #####################################
 # Endpoints
 #####################################
 
-@app.post("/inscription")
-async def inscription_endpoint(data: dict):
+class InscriptionRequest(BaseModel):
+    nom: Annotated[str, StringConstraints(strip_whitespace=True, min_length=1, max_length=255)]
+    numero: Annotated[str, AfterValidator(validate_phone)]
+    pass_word: Annotated[Secret, AfterValidator(validate_password)]
+    type_compte: TypeCompte = "standard"
+    codeCompte: Optional[str] = None  # Obligatoire pour non-agent
+    code_entite: Optional[str] = None
+    montant: float = Field(0.0, ge=0, allow_inf_nan=False)  # Solde initial d'un agent
+
+    @model_validator(mode="after")
+    def check_code_compte(self):
+        if self.type_compte != "agent" and not self.codeCompte:
+            raise ValueError("codeCompte requis pour ce type de compte")
+        return self
+
+@app.post("/inscription", response_model=SessionResponse)
+async def inscription_endpoint(data: InscriptionRequest):
     try:
-        
-        logger.info(f"Requête inscription reçue: {data}")
-        
-        # Vérifier les champs obligatoires
-        nom = data.get('nom')
-        pass_word = data.get('pass_word')
-        numero = data.get('numero')
-        type_compte = data.get('type_compte', 'standard')
-        codeCompte = data.get('codeCompte')  # Obligatoire pour non-agent
-        code_entite = data.get('code_entite') if type_compte == 'premium' else None
-
-        if not nom or not pass_word or not numero:
-            raise HTTPException(status_code=400, detail="Les champs nom, pass_word et numero sont obligatoires")
-        
-        # Validation du mot de passe
-        validate_password(pass_word)
-        # Validation du numéro
-        validate_phone(numero)
-        
+        logger.info(f"Requête inscription reçue pour {data.numero} ({data.type_compte})")
+
         # Vérifier si le numéro existe déjà dans pending_registrations ou dans users
-        if get_user_by_number(numero):
+        if await run_db(get_user_by_number, data.numero):
             raise HTTPException(status_code=400, detail="Numéro déjà inscrit")
-        
-        # Déterminer le montant :
+
         # Si le compte est agent, on prend le montant envoyé, sinon, montant = 0.0
-        if type_compte == 'agent':
-            try:
-                montant = float(data.get("montant", 0.0))
-            except:
-                raise HTTPException(status_code=400, detail="Montant invalide")
-        else:
-            montant = 0.0
-        
-        # Pour les comptes non-agent, codeCompte est obligatoire
-        if type_compte != 'agent' and not codeCompte:
-            raise HTTPException(status_code=400, detail="codeCompte requis pour ce type de compte")
-        
+        montant = data.montant if data.type_compte == 'agent' else 0.0
+        code_entite = data.code_entite if data.type_compte == 'premium' else None
+
         code_session = generate_session_code()
-        insert_pending_registration(code_session, nom, numero, pass_word, type_compte, montant, code_entite, codeCompte)
-        confirmation_message = f"Inscription demandée pour {nom}. Veuillez confirmer avec code_session: {code_session}"
+        # Le mot de passe n'est jamais stocké en clair, pas même dans pending_registrations
+        pass_word = await credentials.hash(data.pass_word)
+        await run_db(insert_pending_registration, code_session, data.nom, data.numero, pass_word, data.type_compte,
+                     montant, code_entite, data.codeCompte)
+        confirmation_message = f"Inscription demandée pour {data.nom}. Veuillez confirmer avec code_session: {code_session}"
         return {"message": confirmation_message, "code_session": code_session}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 class TransactionRequest(BaseModel):
-    num_destinataire: str
-    num_envoyeur: str
-    montant: Union[float, int, str]
-    pass_word: str
-    transaction_type: str
+    num_destinataire: Numero
+    num_envoyeur: Numero
+    montant: Montant
+    pass_word: Secret
+    transaction_type: TransactionType
     codeCompte: str
 
-    @validator("montant", pre=True)
-    def parse_montant(cls, v):
-        try:
-            return float(v)
-        except ValueError:
-            raise ValueError("Le champ 'montant' doit être un nombre valide.")
-
 class ConfirmTransactionRequest(BaseModel):
-    code_session: str
-    confirmation: Union[bool, str]
+    code_session: Annotated[str, StringConstraints(min_length=1, max_length=64)]
+    confirmation: Confirmation
 
-    @validator("confirmation", pre=True)
-    def parse_confirmation(cls, v):
-        if isinstance(v, str):
-            return v.lower() == "yes"
-        return bool(v)
+class ConfirmTransactionResponse(BaseModel):
+    detail: Optional[str] = None
+    message: str
+    transaction_hash: Optional[str] = None
 
 # 2. Confirm_inscription : Confirmation et insertion dans la table users
 
 class ConfirmRequest(BaseModel):
-    code_session: str
+    code_session: Annotated[str, StringConstraints(min_length=1, max_length=64)]
     codeCompte: str
-    confirmation: Union[bool, str]
+    confirmation: Confirmation
 
-    @validator("confirmation", pre=True)
-    def parse_confirmation(cls, v):
-        if isinstance(v, str):
-            return v.lower() == "yes"
-        return v
+class ConfirmInscriptionResponse(BaseModel):
+    detail: str
+    numero: str
+    type_compte: str
+    codeCompte: Optional[str] = None
 
 ##################################
 #   Confirmation d'inscription   #
 ##################################
-@app.post("/confirm_inscription")
+@app.post("/confirm_inscription", response_model=ConfirmInscriptionResponse)
 async def confirm_inscription_endpoint(data: ConfirmRequest):
     try:
-        logger.info(f"Requête inscription reçue: {data.dict()}")
+        logger.info(f"Confirmation d'inscription reçue: {data.code_session}")
         code_session = data.code_session
-        confirmation = data.confirmation
-        codeCompte   = data.codeCompte
 
-        if not confirmation:
+        if not data.confirmation:
             raise HTTPException(status_code=400, detail="La confirmation doit être vraie")
-        if not code_session:
-            raise HTTPException(status_code=400, detail="code_session requis pour confirmation")
         
-        pending = get_pending_registration(code_session)
+        pending = await run_db(get_pending_registration, code_session)
         if not pending:
             raise HTTPException(status_code=400, detail="Code de session invalide ou déjà confirmé")
         if is_session_expired(pending["timestamp"]):
-            delete_pending_registration(code_session)
+            await run_db(delete_pending_registration, code_session)
             raise HTTPException(status_code=400, detail="Code de session expiré")
         
         # Pour un agent, codeCompte doit être None, sinon on le récupère depuis pending.
@@ -583,7 +2433,8 @@ async def confirm_inscription_endpoint(data: ConfirmRequest):
             codeCompte = data.codeCompte or pending["codeCompte"]
 
         # Insertion dans la table users (on suppose que insert_user gère aussi les erreurs)
-        insert_user(
+        await run_db(
+            insert_user,
             pending["nom"],
             pending["numero"],
             pending["pass_word"],
@@ -591,7 +2442,7 @@ async def confirm_inscription_endpoint(data: ConfirmRequest):
             pending["solde"],
             codeCompte
         )
-        delete_pending_registration(code_session)
+        await run_db(delete_pending_registration, code_session)
         
         logger.info(f"Inscription confirmée pour {pending['numero']}")
         return {
@@ -611,86 +2462,103 @@ async def confirm_inscription_endpoint(data: ConfirmRequest):
 
 
 # 3. Recup_inscription : Récupérer un utilisateur et mettre à jour son codeCompte
-@app.post("/recup_inscription")
-async def recup_inscription_endpoint(data: Request):
-   
-    numero = data.get('numero')
-    pass_word = data.get('pass_word')
-    codeCompte = data.get('codeCompte')
-    if not numero or not pass_word or not codeCompte:
-        raise HTTPException(status_code=400, detail="numero, pass_word et codeCompte sont requis")
-    user = get_user_by_number(numero)
+class RecupInscriptionRequest(BaseModel):
+    numero: Numero
+    pass_word: Secret
+    codeCompte: Annotated[str, StringConstraints(min_length=1)]
+
+class RecupInscriptionResponse(BaseModel):
+    message: str
+    numero: str
+    nom: str
+    solde: float
+    codeCompte: str
+
+@app.post("/recup_inscription", response_model=RecupInscriptionResponse)
+async def recup_inscription_endpoint(data: RecupInscriptionRequest):
+    user = await run_db(get_user_by_number, data.numero)
     if not user:
         raise HTTPException(status_code=400, detail="Utilisateur non trouvé")
-    if user['pass_word'] != pass_word:
+    if not await check_user_password(user, data.pass_word):
         raise HTTPException(status_code=400, detail="Mot de passe incorrect")
     # Mettre à jour le codeCompte de l'utilisateur
-    update_user_code(numero, codeCompte)
+    await run_db(update_user_code, data.numero, data.codeCompte)
     return {
         "message": "Compte mis à jour avec succès",
-        "numero": numero,
-        "nom":user['pass_word'],
-        "solde":user['solde'],
-        "codeCompte": codeCompte
+        "numero": data.numero,
+        "nom": user['nom'],
+        "solde": user['solde'],
+        "codeCompte": data.codeCompte
     }
 
 class MakeAgentRequest(BaseModel):
-    numero: str
-    montant: float
-    type_compte: str = "agent"
-    company_pass: str
+    numero: Numero
+    montant: float = Field(ge=0, allow_inf_nan=False)
+    type_compte: TypeCompte = "agent"
+    company_pass: Secret
 
 class ConfirmRequestAgent(BaseModel):
-    code_session: str
+    code_session: Annotated[str, StringConstraints(min_length=1, max_length=64)]
     confirmation: bool
 
 class BalanceRequest(BaseModel):
-    numero: str
-    password: str = None
-    codeCompte: str = None
-    company_pass: str = None  # Ajout de ce champ
+    numero: Numero
+    password: Optional[Secret] = None
+    codeCompte: Optional[str] = None
+    company_pass: Optional[Secret] = None  # Ajout de ce champ
+
+class BalanceResponse(BaseModel):
+    solde: float
+    message: Optional[str] = None
+
+class LedgerBalanceResponse(BaseModel):
+    compte: str
+    solde: float
+    snapshot_solde: float
+    snapshot_entry_id: int
+    snapshot_taken_at: Optional[datetime] = None
+    entries_after_snapshot: int
+    # Absents pour '@entreprise' et '@externe'
+    solde_compte: Optional[float] = None
+    ecart: Optional[float] = None
 
 
 #########################################
 # Endpoint: Création d'un agent (/makeagent)
 #########################################
-@app.post("/makeagent")
+@app.post("/makeagent", response_model=SessionResponse)
 async def make_agent_endpoint(data: MakeAgentRequest):
-    user = get_user_by_number(data.numero)
+    user = await run_db(get_user_by_number, data.numero)
     if not user:
         raise HTTPException(status_code=400, detail="Numéro introuvable")
     
-    company = get_company_account()
-    if not company or data.company_pass != company["pass_word"]:
+    if not await verify_company_pass(data.company_pass):
         raise HTTPException(status_code=400, detail="Mot de passe admin incorrect")
     
     nom, numero, pass_word = user["nom"], user["numero"], user["pass_word"]
     new_balance = user["solde"] + data.montant
 
     code_session = generate_session_code()
-    insert_pending_registration(code_session, nom, numero, pass_word, data.type_compte, new_balance, None, user["codeCompte"])
+    await run_db(insert_pending_registration, code_session, nom, numero, pass_word, data.type_compte, new_balance, None,
+                 user["codeCompte"], data.montant)
     
     return {"message": f"Voulez vous faire de {nom} un agent sur Mopatas %s. Confirmez avec code_session: {code_session}", "code_session": code_session}
 
 #########################################
 # Endpoint: Confirmation d'inscription (/confirm_inscription)
 #########################################
-@app.post("/confirm_agent")
-async def confirm_inscription_endpoint(data: ConfirmRequestAgent):
-    print(f"{data}")
-    pending = get_pending_registration(data.code_session)
-    if not pending or is_session_expired(pending["timestamp"]):
-        delete_pending_registration(data.code_session)
+@app.post("/confirm_agent", response_model=DetailResponse)
+async def confirm_agent_endpoint(data: ConfirmRequestAgent):
+    pending = await run_db(get_pending_registration, data.code_session)
+    # Sans montant : session d'inscription, ou /makeagent antérieur à la migration 10
+    if not pending or pending["montant"] is None or is_session_expired(pending["timestamp"]):
+        await run_db(delete_pending_registration, data.code_session)
         raise HTTPException(status_code=400, detail="Code session invalide ou expiré")
 
-    conn = get_db_connection()
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET type_compte = %s, solde = %s, codeCompte = %s WHERE numero = %s",
-                       (pending["type_compte"], pending["solde"], pending["codeCompte"], pending["numero"]))
-    conn.close()
+    async with account_locks.hold([pending["numero"]]):
+        await run_db(update_user_account, pending["numero"], pending["type_compte"], pending["montant"], pending["codeCompte"])
 
-    delete_pending_registration(data.code_session)
+    await run_db(delete_pending_registration, data.code_session)
     return {"detail": f"Inscription confirmée pour {pending['nom']}. Compte mis à jour."}
 
 #########################################
@@ -700,110 +2568,170 @@ async def confirm_inscription_endpoint(data: ConfirmRequestAgent):
 
 
 
-@app.post("/users")
-async def list_users(data: dict):
-    print(f"{data}")
-    # Vérifier si le mot de passe est correct
-    company = get_company_account()
+class UsersRequest(BaseModel):
+    company_pass: Optional[Secret] = None
+    after_id: int = Field(0, ge=0)  # curseur : id du dernier utilisateur de la page précédente
+    limit: int = Field(USERS_PAGE_SIZE, ge=1, le=USERS_PAGE_MAX)
+    type_compte: Optional[TypeCompte] = None
+
+class UsersExportRequest(BaseModel):
+    company_pass: Optional[Secret] = None
+    format: ExportFormat = "ndjson"
+    type_compte: Optional[TypeCompte] = None
 
-    if not company or company["company_pass"] != data.get("company_pass"):
+class UserSummary(BaseModel):
+    id: int
+    nom: str
+    numero: str
+    solde: float
+    type_compte: str
+
+class UsersPage(BaseModel):
+    # Nombre d'utilisateurs de la page (et non du total, que la pagination ne compte pas)
+    count: int
+    users: List[UserSummary]
+    next_after_id: Optional[int] = None
+
+@app.post("/users", response_model=UsersPage, response_class=FastJSONResponse)
+async def list_users(data: UsersRequest):
+    # Vérifier si le mot de passe est correct
+    if not await verify_company_pass(data.company_pass):
         raise HTTPException(status_code=403, detail="Accès refusé, mot de passe incorrect.")
 
-    # Si l'accès est autorisé, récupérer la liste des utilisateurs
-    conn = get_db_connection()
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT nom, numero, solde, type_compte FROM users")
-        users = cursor.fetchall()
-    if users :
-        # Convertir les résultats en liste de dictionnaires
+    # Si l'accès est autorisé, récupérer une page d'utilisateurs
+    users = await run_db(get_users_page, data.after_id, data.limit, data.type_compte)
+    if users or data.after_id:
+        # Lignes renvoyées telles quelles (dictionnaires), sans validation une à une
         users_list = [dict(user) for user in users]
-        return {"total_users": len(users_list), "users": users_list}
+        next_after_id = users_list[-1]["id"] if len(users_list) == data.limit else None
+        return FastJSONResponse({"count": len(users_list), "users": users_list, "next_after_id": next_after_id})
     else :
         raise HTTPException(status_code=403, detail="Aucun utilisateur disponible !")
 
+@app.post("/users/export")
+async def export_users(data: UsersExportRequest):
+    # Export complet en flux (NDJSON ou CSV), lu par morceaux depuis un curseur côté serveur
+    if not await verify_company_pass(data.company_pass):
+        raise HTTPException(status_code=403, detail="Accès refusé, mot de passe incorrect.")
+
+    columns = ["id", "nom", "numero", "solde", "type_compte"]
+    query = f"SELECT {', '.join(columns)} FROM users"
+    params = ()
+    if data.type_compte:
+        query += " WHERE type_compte = %s"
+        params = (data.type_compte,)
+    query += " ORDER BY id"
+    return StreamingResponse(
+        stream_rows(query, params, data.format, columns),
+        media_type=EXPORT_MEDIA_TYPES[data.format],
+        headers={"Content-Disposition": f"attachment; filename=users.{data.format}"},
+    )
+
 
 #########################################
 # Endpoint: Récupérer le solde d'un utilisateur (/balance)
 #########################################
-@app.post("/balance")
+@app.post("/balance", response_model=BalanceResponse, response_model_exclude_unset=True)
 async def get_balance_endpoint(data: BalanceRequest):
     """
     Vérifie si `company_pass` est correct. Si oui, retourne le solde sans vérifier `password` et `codeCompte`.
     Sinon, vérifie normalement les identifiants utilisateur.
     """
-    company = get_company_account()
-    
     # Vérification du mot de passe admin
-    if data.company_pass and company and data.company_pass == company["pass_word"]:
-        user = get_user_by_number(data.numero)
+    if await verify_company_pass(data.company_pass):
+        rate_limiter.check("/balance", data.numero)
+        user = await run_db(get_user_by_number, data.numero)
         if not user:
             raise HTTPException(status_code=400, detail="Utilisateur introuvable")
         
         return {"solde": user["solde"]}  # Retourne directement le solde
     
     # Si `company_pass` est absent ou incorrect, vérification normale
-    user = get_user_by_number(data.numero)
-    if not user or data.password != user["pass_word"] or data.codeCompte != user["codeCompte"]:
+    user = await run_db(get_user_by_number, data.numero)
+    if not user or data.codeCompte != user["codeCompte"] or not await check_user_password(user, data.password):
         raise HTTPException(status_code=400, detail="Identifiants incorrects")
+    rate_limiter.check("/balance", data.numero)
     
     return {"solde": user["solde"], "message": f"Votre solde est de {user['solde']} "}
 
-@app.post("/balance_pro")
-async def balance_pro_endpoint(data: dict):
-    user = get_user_by_number(data.get('numero'))
-    print(f"{data}")
-    if user is None or data.get('pass_word') != user["pass_word"]:
-        raise HTTPException(
-            status_code=400,
-            detail="Utilisateur non trouvé ou mot de passe incorrect"
-        )
-    if user["codeCompte"] is not None and data.get('codeCompte') != user["codeCompte"]:
-        raise HTTPException(status_code=400, detail="codeCompte invalide")
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-           SELECT 
-            p.id_paiement AS paiement_id, 
-            u.nom AS nom_payeur, 
-            t.montant AS montant_transfere, 
-            t.transaction_hash,
-            p.client,
-            p.percepteur,
-            p.produit
-        FROM 
-            premium_services AS p
-        INNER JOIN 
-            users AS u ON u.numero = p.id_payeur
-        INNER JOIN 
-            les_transactions AS t ON t.id = p.id_paiement
-        WHERE 
-            p.id_payeur = %s
-            AND t.etat = 'completed'
-            """, (user['numero'],))
+@app.post("/ledger", response_model=LedgerBalanceResponse, response_model_exclude_unset=True)
+async def ledger_endpoint(data: BalanceRequest):
+    # Solde reconstruit depuis le grand livre, comparé à users.solde ; avec company_pass, `numero`
+    # peut aussi désigner '@entreprise' ou '@externe'
+    if await verify_company_pass(data.company_pass):
+        user = await run_db(get_user_by_number, data.numero)
+        if not user and data.numero not in (LEDGER_COMPANY, LEDGER_EXTERNAL):
+            raise HTTPException(status_code=400, detail="Utilisateur introuvable")
+    else:
+        user = await run_db(get_user_by_number, data.numero)
+        if not user or data.codeCompte != user["codeCompte"] or not await check_user_password(user, data.password):
+            raise HTTPException(status_code=400, detail="Identifiants incorrects")
+
+    return await run_db(ledger_balance, data.numero)
+
+class BalanceProRequest(BaseModel):
+    numero: Numero
+    pass_word: Secret
+    codeCompte: Optional[str] = None
+    # Page suivante du détail : id du dernier paiement de la page précédente
+    before_id: Optional[int] = None
+    limit: int = Field(MERCHANT_PAGE_SIZE, ge=1, le=MERCHANT_PAGE_MAX)
+
+class PremiumServiceItem(BaseModel):
+    code_transaction: str
+    client: Optional[str] = None
+    percepteur: Optional[str] = None
+    produit: Optional[str] = None
+    montant: Optional[float] = None
+    date: Optional[datetime] = None
+
+class MerchantTotals(BaseModel):
+    paiements: int
+    montant: float
+    dernier_paiement: Optional[datetime] = None
 
-    
-    premium_services = cursor.fetchall()
-    conn.close()
-    
-    premium_list = [
+class BalanceProResponse(BaseModel):
+    solde: float
+    message: str
+    totaux: MerchantTotals
+    premium_services: List[PremiumServiceItem]
+    next_before_id: Optional[int] = None
+
+def premium_page(rows, limit):
+    items = [
         {
             "code_transaction": row["transaction_hash"],
             "client": row["client"],
             "percepteur": row["percepteur"],
             "produit": row["produit"],
-            "montant": row["montant_transfere"]
+            "montant": row["montant"],
+            "date": row["created_at"],
         }
-        for row in premium_services
+        for row in rows
     ]
+    return items, rows[-1]["id"] if len(rows) == limit else None
+
+@app.post("/balance_pro", response_model=BalanceProResponse)
+async def balance_pro_endpoint(data: BalanceProRequest):
+    user = await run_db(get_user_by_number, data.numero)
+    if user is None or not await check_user_password(user, data.pass_word):
+        raise HTTPException(
+            status_code=400,
+            detail="Utilisateur non trouvé ou mot de passe incorrect"
+        )
+    if user["codeCompte"] is not None and data.codeCompte != user["codeCompte"]:
+        raise HTTPException(status_code=400, detail="codeCompte invalide")
+
+    # Totaux tenus à jour à chaque paiement et dernière page du détail : deux lectures par index
+    totals, rows = await run_db(get_merchant_dashboard, user['numero'], data.before_id, data.limit)
+    premium_list, next_before_id = premium_page(rows, data.limit)
 
-    
     return {
         "solde": user["solde"],
         "message": f"Bonjour {user['nom']}, votre solde est de {user['solde']}!",
-        "premium_services": premium_list
+        "totaux": totals,
+        "premium_services": premium_list,
+        "next_before_id": next_before_id,
     }
 
 
@@ -814,58 +2742,48 @@ async def balance_pro_endpoint(data: dict):
 #####################################
 # Endpoint /transaction
 #####################################
-@app.post("/transaction")
-async def create_transaction(data: dict):
-    # Vérification des champs attendus
-    required_fields = ['num_destinataire', 'montant', 'pass_word', 'transaction_type', 'codeCompte', 'num_envoyeur']
-    for field in required_fields:
-        if field not in data:
-            raise HTTPException(status_code=400, detail=f"Le champ {field} est requis")
-    
-    num_envoyeur = data['num_envoyeur']
-    pass_word = data['pass_word']
+@app.post("/transaction", response_model=SessionResponse)
+async def create_transaction(data: TransactionRequest, request: Request):
+    # Avec Idempotency-Key, un rejeu renvoie la même code_session sans nouvelle ligne en attente
+    return await idempotency.run(request, "/transaction", data.model_dump(), lambda: _create_transaction(data))
+
+async def _create_transaction(data: TransactionRequest):
+    num_envoyeur = data.num_envoyeur
+    pass_word = data.pass_word
     
     # Vérifier que l'envoyeur existe
-    sender = get_user_by_number(num_envoyeur)
+    sender = await run_db(get_user_by_number, num_envoyeur)
     if not sender:
         raise HTTPException(status_code=400, detail="Envoyeur non trouvé")
     
     # Vérifier que le mot de passe correspond
-    if sender['pass_word'] != pass_word:
+    if not await check_user_password(sender, pass_word):
         raise HTTPException(status_code=400, detail="Mot de passe incorrect")
+    rate_limiter.check("/transaction", num_envoyeur)
     # Vous pouvez aussi utiliser validate_password(pass_word) si besoin
 
     # Vérifier le destinataire : si le numéro contient ';' on découpe et on prend la première partie
-    num_destinataire = data['num_destinataire']
+    num_destinataire = data.num_destinataire
     if ";" in num_destinataire:
         numero_dest = num_destinataire.split(';')[0].strip()
     else:
         numero_dest = num_destinataire.strip()
 
-    recipient = get_user_by_number(numero_dest)
+    recipient = await run_db(get_user_by_number, numero_dest)
 
     if not recipient:
         raise HTTPException(status_code=400, detail="Destinataire non trouvé")
     
     # Vérifier la solvabilité de l'envoyeur (pour un envoi par exemple)
-    montant = float(data['montant'])
-    if data['transaction_type'] == 'envoi' and sender['solde'] < montant:
+    montant = data.montant
+    if data.transaction_type == 'envoi' and sender['solde'] < montant:
         raise HTTPException(status_code=400, detail="Solde insuffisant pour l'envoi")
 
     # Générer le code de session pour la transaction
     code_session = generate_session_code()
 
     # Insérer la transaction dans la base avec l'état "pending"
-    conn = get_db_connection()
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO les_transactions 
-            (numero_envoyeur, numero_destinataire, montant, type_trans, code_session, etat) 
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (num_envoyeur, num_destinataire, montant, data['transaction_type'], code_session, "pending"))
-        conn.commit()
-    conn.close()
+    await run_db(insert_transaction, num_envoyeur, num_destinataire, montant, data.transaction_type, code_session)
 
     confirmation_message = "Transaction en attente de confirmation"
     return {"message": confirmation_message, "code_session": code_session}
@@ -873,53 +2791,253 @@ async def create_transaction(data: dict):
 #####################################
 # Endpoint /confirm_transaction
 #####################################
-@app.post("/confirm_transaction")
-async def confirm_transaction(confirmData: dict):
-    # Vérification des champs
-    required_fields = ['code_session', 'confirmation']
-    for field in required_fields:
-        if field not in confirmData:
-            raise HTTPException(status_code=400, detail=f"Le champ {field} est requis")
-    
-    if confirmData['confirmation'] != "yes":
+@app.post("/confirm_transaction", response_model=ConfirmTransactionResponse)
+async def confirm_transaction(confirmData: ConfirmTransactionRequest, request: Request):
+    return await idempotency.run(request, "/confirm_transaction", confirmData.model_dump(),
+                                 lambda: _confirm_transaction(confirmData))
+
+async def _confirm_transaction(confirmData: ConfirmTransactionRequest):
+    if not confirmData.confirmation:
         raise HTTPException(status_code=400, detail="Confirmation invalide")
     
-    code_session = confirmData['code_session']
-    # Récupérer la transaction en attente par code_session
-    conn = get_db_connection()
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM les_transactions WHERE code_session = %s", (code_session,))
-        transaction = cursor.fetchone()
-    conn.close()
-    
-    if not transaction:
-        raise HTTPException(status_code=400, detail="Code session invalide")
-    if transaction['etat'] != "pending":
-        raise HTTPException(status_code=400, detail="Transaction déjà confirmée ou annulée")
-    
-    # Traiter la transaction via la fonction process_transaction
-    result, status_code = process_transaction(
-        transaction['numero_envoyeur'],
-        transaction['numero_destinataire'],
-        transaction['montant'],
-        transaction['type_trans'],
-        code_session
-    )
-    if status_code != 200:
-        raise HTTPException(status_code=status_code, detail=result.get('detail'))
-    
-    # Mettre à jour l'état de la transaction à "completed"
-    conn = get_db_connection()
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE les_transactions SET etat = %s WHERE code_session = %s", ("completed", code_session))
-        conn.commit()
-    conn.close()
-    
+    code_session = confirmData.code_session
+    # Comptes lus avant d'emprunter une connexion d'écriture ; une transaction introuvable ou déjà
+    # traitée n'est pas verrouillée, confirm_pending_transaction renvoie l'erreur adaptée
+    pending = await run_db(get_pending_transaction, code_session)
+    async with account_locks.hold(transaction_lock_keys(pending) if pending else []):
+        result = await run_db(confirm_pending_transaction, code_session)
     return {"detail": result.get('detail'), "message": "Transaction confirmee", "transaction_hash": result.get('transaction_hash')}
 
 
+#####################################
+# Endpoint /transaction_batch
+#####################################
+# Montant et type d'un paiement sont contrôlés un par un par process_bulk_transfer : un paiement
+# invalide est rejeté dans le résultat sans faire échouer le lot
+class BulkTransferItem(BaseModel):
+    num_destinataire: Numero
+    montant: float = Field(allow_inf_nan=False)
+    transaction_type: str = "envoi"
+
+class BulkTransferRequest(BaseModel):
+    num_envoyeur: Numero
+    pass_word: Secret
+    codeCompte: Optional[str] = None
+    items: List[BulkTransferItem] = Field(min_length=1, max_length=BULK_MAX_ITEMS)
+
+class BulkTransferResult(BaseModel):
+    index: int
+    num_destinataire: str
+    montant: float
+    transaction_type: str
+    status: str
+    detail: Optional[str] = None
+    frais: Optional[float] = None
+    transaction_hash: Optional[str] = None
+
+class BulkTransferResponse(BaseModel):
+    message: str
+    total_debit: float
+    solde: float
+    completed: int
+    rejected: int
+    items: List[BulkTransferResult]
+
+@app.post("/transaction_batch", response_model=BulkTransferResponse, response_model_exclude_unset=True)
+async def bulk_transaction_endpoint(data: BulkTransferRequest):
+    # Paie, distribution de float aux agents : une seule authentification pour tout le lot
+
+    sender = await run_db(get_user_by_number, data.num_envoyeur)
+    if not sender:
+        raise HTTPException(status_code=400, detail="Envoyeur non trouvé")
+    if not await check_user_password(sender, data.pass_word):
+        raise HTTPException(status_code=400, detail="Mot de passe incorrect")
+    # Comme /history : codeCompte exigé quand le compte en a un
+    if sender["codeCompte"] is not None and data.codeCompte != sender["codeCompte"]:
+        raise HTTPException(status_code=400, detail="codeCompte invalide")
+
+    items = [(item.num_destinataire, item.montant, item.transaction_type) for item in data.items]
+    keys = [data.num_envoyeur] + [item.num_destinataire.split(';')[0].strip() for item in data.items]
+    async with account_locks.hold(keys):
+        return await run_db(process_bulk_transfer, data.num_envoyeur, items)
+
+
+#####################################
+# Endpoints /history et /history/export
+#####################################
+class AccountAccess(BaseModel):
+    numero: Numero
+    pass_word: Optional[Secret] = None
+    codeCompte: Optional[str] = None
+    company_pass: Optional[Secret] = None
+
+class HistoryFilters(AccountAccess):
+    direction: Literal["all", "sent", "received"] = "all"
+    type_trans: Optional[TransactionType] = None
+    etat: Optional[str] = None
+    date_from: Optional[datetime] = None
+    date_to: Optional[datetime] = None
+
+class HistoryRequest(HistoryFilters):
+    # Curseur : (timestamp, id) de la dernière transaction de la page précédente
+    before_timestamp: Optional[datetime] = None
+    before_id: Optional[int] = None
+    limit: int = Field(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_PAGE_MAX)
+
+    @model_validator(mode="after")
+    def check_cursor(self):
+        if (self.before_timestamp is None) != (self.before_id is None):
+            raise ValueError("before_timestamp et before_id vont ensemble")
+        return self
+
+class HistoryExportRequest(HistoryFilters):
+    format: ExportFormat = "csv"
+
+class HistoryEntry(BaseModel):
+    id: int
+    numero_envoyeur: str
+    numero_destinataire: str
+    montant: float
+    type_trans: str
+    etat: str
+    transaction_hash: Optional[str] = None
+    timestamp: datetime
+    sens: str
+
+class HistoryCursor(BaseModel):
+    before_timestamp: datetime
+    before_id: int
+
+class HistoryPage(BaseModel):
+    numero: str
+    transactions: List[HistoryEntry]
+    next_cursor: Optional[HistoryCursor] = None
+
+async def check_account_access(data: AccountAccess):
+    # Le titulaire (mot de passe + codeCompte s'il en a un) ou l'administrateur
+    if await verify_company_pass(data.company_pass):
+        return
+    user = await run_db(get_user_by_number, data.numero)
+    if not await check_user_password(user, data.pass_word):
+        raise HTTPException(status_code=400, detail="Identifiants incorrects")
+    if user["codeCompte"] is not None and data.codeCompte != user["codeCompte"]:
+        raise HTTPException(status_code=400, detail="codeCompte invalide")
+
+def history_filters(data: HistoryFilters):
+    return dict(direction=data.direction, type_trans=data.type_trans, etat=data.etat,
+                date_from=data.date_from, date_to=data.date_to)
+
+@app.post("/history", response_model=HistoryPage, response_class=FastJSONResponse)
+async def history_endpoint(data: HistoryRequest):
+    await check_account_access(data)
+
+    before = (data.before_timestamp, data.before_id) if data.before_id is not None else None
+    rows = await run_db(get_history_page, data.numero, data.limit, before=before, **history_filters(data))
+    transactions = [dict(row) for row in rows]
+    next_cursor = None
+    if len(transactions) == data.limit:
+        last = transactions[-1]
+        next_cursor = {"before_timestamp": last["timestamp"], "before_id": last["id"]}
+    return FastJSONResponse({"numero": data.numero, "transactions": transactions, "next_cursor": next_cursor})
+
+@app.post("/history/export")
+async def history_export_endpoint(data: HistoryExportRequest):
+    # Relevé complet en flux, dans l'ordre chronologique, lu depuis un curseur côté serveur
+    await check_account_access(data)
+
+    query, params = history_query(data.numero, **history_filters(data))
+    return StreamingResponse(
+        stream_rows(query, params, data.format, HISTORY_COLUMNS),
+        media_type=EXPORT_MEDIA_TYPES[data.format],
+        headers={"Content-Disposition": f"attachment; filename=releve_{data.numero}.{data.format}"},
+    )
+
+
+#####################################
+# Endpoints /merchant/summary et /merchant/payments
+#####################################
+class MerchantSummaryRequest(AccountAccess):
+    group_by: Literal["jour", "percepteur", "produit", "client"] = "jour"
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    # Curseur : clé du dernier groupe de la page précédente
+    after: Optional[str] = None
+    limit: int = Field(MERCHANT_PAGE_SIZE, ge=1, le=MERCHANT_PAGE_MAX)
+
+class MerchantGroup(BaseModel):
+    cle: str
+    paiements: int
+    montant: float
+
+class MerchantSummaryResponse(BaseModel):
+    numero: str
+    group_by: str
+    totaux: MerchantTotals
+    groupes: List[MerchantGroup]
+    next_after: Optional[str] = None
+
+class MerchantPaymentsRequest(AccountAccess):
+    percepteur: Optional[str] = None
+    produit: Optional[str] = None
+    client: Optional[str] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    before_id: Optional[int] = None
+    limit: int = Field(MERCHANT_PAGE_SIZE, ge=1, le=MERCHANT_PAGE_MAX)
+
+class MerchantPaymentsResponse(BaseModel):
+    numero: str
+    premium_services: List[PremiumServiceItem]
+    next_before_id: Optional[int] = None
+
+@app.post("/merchant/summary", response_model=MerchantSummaryResponse, response_class=FastJSONResponse)
+async def merchant_summary_endpoint(data: MerchantSummaryRequest):
+    # Totaux et cumuls par jour, percepteur, produit ou client, lus dans les cumuls sans toucher au détail
+    await check_account_access(data)
+    totals, rows = await run_db(get_merchant_summary, data.numero, data.group_by, data.date_from, data.date_to,
+                                data.after, data.limit)
+    groups = [{"cle": str(row["cle"]), "paiements": row["paiements"], "montant": row["montant"]} for row in rows]
+    next_after = groups[-1]["cle"] if len(groups) == data.limit else None
+    return FastJSONResponse({"numero": data.numero, "group_by": data.group_by, "totaux": totals,
+                             "groupes": groups, "next_after": next_after})
+
+@app.post("/merchant/payments", response_model=MerchantPaymentsResponse, response_class=FastJSONResponse)
+async def merchant_payments_endpoint(data: MerchantPaymentsRequest):
+    # Détail d'un groupe du résumé (ex. percepteur + jour), page par page
+    await check_account_access(data)
+    rows = await run_db(get_merchant_payments, data.numero, data.limit, percepteur=data.percepteur,
+                        produit=data.produit, client=data.client, date_from=data.date_from,
+                        date_to=data.date_to, before_id=data.before_id)
+    premium_list, next_before_id = premium_page(rows, data.limit)
+    return FastJSONResponse({"numero": data.numero, "premium_services": premium_list,
+                             "next_before_id": next_before_id})
+
+
+#####################################
+# Endpoint /fees/quote
+#####################################
+class FeeQuoteRequest(BaseModel):
+    transaction_type: TransactionType
+    montants: List[Annotated[float, Field(ge=0, allow_inf_nan=False)]] = Field(max_length=FEE_QUOTE_MAX)
+
+class FeeQuoteResponse(BaseModel):
+    transaction_type: str
+    montants: List[float]
+    frais: List[float]
+    totaux: List[float]
+
+@app.post("/fees/quote", response_model=FeeQuoteResponse, response_class=FastJSONResponse)
+async def fee_quote_endpoint(data: FeeQuoteRequest):
+    # Aperçu des frais pour un lot de montants, arrondis comme à la confirmation (process_transaction)
+    montants = np.rint(np.asarray(data.montants, dtype=np.float64))
+    frais = fee_schedule.fees(montants, data.transaction_type)
+    # Tableaux numpy sérialisés directement par FastJSONResponse
+    return FastJSONResponse({
+        "transaction_type": data.transaction_type,
+        "montants": montants,
+        "frais": frais,
+        "totaux": montants + frais,
+    })
 
 
 if __name__ == "__main__":
@@ -0,0 +1,383 @@
+"""
+Banc de charge de bout en bout des parcours de paiement.
+
+Peuple une base locale avec N utilisateurs puis rejoue un mélange de parcours
+(/inscription -> /confirm_inscription, /transaction -> /confirm_transaction pour chaque
+transaction_type, /balance) à concurrence fixe ou à débit cible, et écrit un rapport JSON :
+débit, latences p50/p95/p99, allers-retours base de données par requête et taux d'erreur.
+
+    python bench.py --users 1000 --duration 30 --concurrency 32
+    python bench.py --rate 200 --mix balance=60,envoi=30,inscription=10 --output bench.json
+    python bench.py --backend postgres --dsn postgresql://localhost/mopatas_bench
+
+Sans --url, l'application tourne dans le processus (transport ASGI, un seul worker) ;
+avec --url, les requêtes partent vers un serveur déjà lancé sur la même base. Dans le processus, la
+limitation par numéro et le contrôle d'admission sont coupés (RATE_LIMIT_PER_SECOND et ADMISSION_*_LIMIT
+à 0, sauf s'ils sont fixés dans l'environnement) ; le rapport indique les limites en vigueur.
+
+Avec --direct, seules les confirmations sont mesurées : `concurrency` threads insèrent chacun une
+transaction en attente puis appellent confirm_pending_transaction, sans HTTP ni boucle d'événements.
+Cela isole la contention dans la base (verrous de ligne, validations), par exemple :
+
+    python bench.py --direct --backend postgres --dsn ... --mix retrait=50,liquider=50 --concurrency 16
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import httpx
+import numpy as np
+
+from passwords import hash_password
+
+DEFAULT_MIX = "balance=40,envoi=20,paie=10,retrait=8,depot=7,liquider=8,depot_pro=2,inscription=5"
+SCENARIOS = ["balance", "inscription", "envoi", "paie", "retrait", "depot", "liquider", "facturer", "depot_pro"]
+
+# Plages de numéros réservées au banc : comptes peuplés (09...) et inscriptions jouées (08...)
+SEED_PREFIX = "09"
+SIGNUP_PREFIX = "08"
+BENCH_PASSWORD = "bench-pw"
+SEED_BALANCE = 1e9
+AGENT_EVERY = 10
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise SystemExit(f"Scénario inconnu : {name} (attendus : {', '.join(SCENARIOS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def seed(app, users):
+    # Remet à zéro les comptes du banc, puis les recrée en un seul lot
+    numeros = [f"{SEED_PREFIX}{i:08d}" for i in range(users)]
+    # Mots de passe déjà hachés, comme en production après migration (un seul hash pour tous les comptes)
+    pass_word = hash_password(BENCH_PASSWORD)
+    rows = [
+        (f"Bench {i}", numero, pass_word, SEED_BALANCE,
+         "agent" if i % AGENT_EVERY == 0 else "standard", f"bench{i}")
+        for i, numero in enumerate(numeros)
+    ]
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        for prefix in (SEED_PREFIX, SIGNUP_PREFIX):
+            cursor.execute("DELETE FROM users WHERE numero LIKE %s", (prefix + "%",))
+            cursor.execute("DELETE FROM pending_registrations WHERE numero LIKE %s", (prefix + "%",))
+        app.get_storage().insert_many(cursor, "users",
+                                      ["nom", "numero", "pass_word", "solde", "type_compte", "codeCompte"], rows)
+        cursor.execute("UPDATE company_account_stripes SET solde = 0")
+        cursor.execute("UPDATE company_account SET solde = %s WHERE id = 1", (SEED_BALANCE * users,))
+    app.user_cache.invalidate(*numeros)
+    return numeros
+
+
+class Recorder:
+    def __init__(self):
+        self.requests = []   # (endpoint, latence s, erreur, requêtes SQL, transactions)
+        self.flows = []      # (scénario, latence s, erreur)
+
+    def request(self, endpoint, elapsed, error, response=None):
+        headers = response.headers if response is not None else {}
+        self.requests.append((endpoint, elapsed, error,
+                              int(headers.get("x-db-queries", 0)), int(headers.get("x-db-transactions", 0))))
+
+
+async def call(client, recorder, endpoint, payload):
+    start = time.perf_counter()
+    try:
+        response = await client.post(endpoint, json=payload)
+    except httpx.HTTPError:
+        recorder.request(endpoint, time.perf_counter() - start, True)
+        return None
+    recorder.request(endpoint, time.perf_counter() - start, response.status_code >= 400, response)
+    return response.json() if response.status_code < 400 else None
+
+
+async def run_flow(client, recorder, scenario, accounts, signups):
+    sender, recipient = random.sample(accounts["standard"], 2)
+    if scenario == "balance":
+        i = int(sender[len(SEED_PREFIX):])
+        return await call(client, recorder, "/balance",
+                          {"numero": sender, "password": BENCH_PASSWORD, "codeCompte": f"bench{i}"}) is not None
+
+    if scenario == "inscription":
+        numero = f"{SIGNUP_PREFIX}{next(signups):08d}"
+        result = await call(client, recorder, "/inscription",
+                            {"nom": "Bench", "numero": numero, "pass_word": BENCH_PASSWORD, "codeCompte": numero})
+        if result is None:
+            return False
+        return await call(client, recorder, "/confirm_inscription",
+                          {"code_session": result["code_session"], "codeCompte": numero, "confirmation": "yes"}) is not None
+
+    if scenario == "depot_pro":
+        sender = random.choice(accounts["agent"])
+    destinataire = recipient
+    if scenario in ("liquider", "facturer"):
+        destinataire = f"{recipient};client-bench;produit-bench;percepteur-bench"
+    result = await call(client, recorder, "/transaction", {
+        "num_destinataire": destinataire,
+        "num_envoyeur": sender,
+        "montant": random.randint(100, 50000),
+        "pass_word": BENCH_PASSWORD,
+        "transaction_type": scenario,
+        "codeCompte": f"bench{int(sender[len(SEED_PREFIX):])}",
+    })
+    if result is None:
+        return False
+    return await call(client, recorder, "/confirm_transaction",
+                      {"code_session": result["code_session"], "confirmation": "yes"}) is not None
+
+
+async def drive(client, recorder, mix, accounts, signups, duration, concurrency, rate):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    deadline = time.perf_counter() + duration
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(scheduled):
+        scenario = random.choices(names, weights)[0]
+        async with slots:
+            ok = await run_flow(client, recorder, scenario, accounts, signups)
+        # À débit cible, la latence part de l'instant prévu : l'attente d'un créneau libre est comptée
+        recorder.flows.append((scenario, time.perf_counter() - scheduled, not ok))
+
+    if rate:
+        # Boucle ouverte : un parcours démarre toutes les 1/rate secondes, que les précédents aient fini ou non
+        tasks = []
+        next_start = time.perf_counter()
+        while next_start < deadline:
+            delay = next_start - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one(next_start)))
+            next_start += 1.0 / rate
+        await asyncio.gather(*tasks)
+    else:
+        # Boucle fermée : `concurrency` clients enchaînent les parcours sans pause
+        async def worker():
+            while time.perf_counter() < deadline:
+                await one(time.perf_counter())
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def drive_direct(app, recorder, mix, accounts, duration, concurrency):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    deadline = time.perf_counter() + duration
+    sessions = itertools.count()
+
+    def worker():
+        rnd = random.Random(random.random())
+        while time.perf_counter() < deadline:
+            scenario = rnd.choices(names, weights)[0]
+            sender, recipient = rnd.sample(accounts["standard"], 2)
+            if scenario == "depot_pro":
+                sender = rnd.choice(accounts["agent"])
+            if scenario in ("liquider", "facturer"):
+                recipient = f"{recipient};client-bench;produit-bench;percepteur-bench"
+            code_session = f"bench-{next(sessions)}-{time.time_ns()}"
+            app.insert_transaction(sender, recipient, rnd.randint(100, 50000), scenario, code_session)
+            counter = {"queries": 0, "transactions": 0}
+            token = app.db_round_trips.set(counter)
+            start = time.perf_counter()
+            try:
+                app.confirm_pending_transaction(code_session)
+                error = False
+            except app.HTTPException:
+                error = True
+            finally:
+                app.db_round_trips.reset(token)
+            elapsed = time.perf_counter() - start
+            recorder.requests.append(("confirm_pending_transaction", elapsed, error,
+                                      counter["queries"], counter["transactions"]))
+            recorder.flows.append((scenario, elapsed, error))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def latency_summary(values):
+    if not len(values):
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    ms = np.asarray(values) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3),
+            "mean": round(float(ms.mean()), 3), "max": round(float(ms.max()), 3)}
+
+
+def request_summary(rows, elapsed):
+    count = len(rows)
+    errors = sum(1 for row in rows if row[2])
+    queries = sum(row[3] for row in rows)
+    transactions = sum(row[4] for row in rows)
+    return {
+        "requests": count,
+        "errors": errors,
+        "error_rate": round(errors / count, 6) if count else 0.0,
+        "throughput_rps": round(count / elapsed, 2),
+        "latency_ms": latency_summary([row[1] for row in rows]),
+        # BEGIN et COMMIT comptent pour deux allers-retours par transaction
+        "db_queries_per_request": round(queries / count, 3) if count else 0.0,
+        "db_transactions_per_request": round(transactions / count, 3) if count else 0.0,
+        "db_round_trips_per_request": round((queries + 2 * transactions) / count, 3) if count else 0.0,
+    }
+
+
+def report(recorder, elapsed, config):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    by_endpoint = {}
+    for row in recorder.requests:
+        by_endpoint.setdefault(row[0], []).append(row)
+    by_scenario = {}
+    for scenario, latency, error in recorder.flows:
+        by_scenario.setdefault(scenario, []).append((latency, error))
+    flow_errors = sum(1 for flow in recorder.flows if flow[2])
+    return {
+        "commit": commit,
+        "started_at": config.pop("started_at"),
+        "config": config,
+        "duration_s": round(elapsed, 3),
+        **request_summary(recorder.requests, elapsed),
+        "flows": len(recorder.flows),
+        "flow_errors": flow_errors,
+        "flows_per_s": round(len(recorder.flows) / elapsed, 2),
+        "endpoints": {endpoint: request_summary(rows, elapsed) for endpoint, rows in sorted(by_endpoint.items())},
+        "scenarios": {
+            scenario: {
+                "flows": len(rows),
+                "errors": sum(1 for _, error in rows if error),
+                "latency_ms": latency_summary([latency for latency, _ in rows]),
+            }
+            for scenario, rows in sorted(by_scenario.items())
+        },
+    }
+
+
+async def bench(args):
+    # Jamais la base de production par défaut : SQLite local, ou un DSN explicite
+    if args.backend == "postgres":
+        if not args.dsn:
+            raise SystemExit("--dsn est requis avec --backend postgres")
+        os.environ["DATABASE_URL"] = args.dsn
+    os.environ["DB_BACKEND"] = args.backend
+    os.environ["SQLITE_PATH"] = args.sqlite_path
+    os.environ.setdefault("EXPIRY_SWEEP_INTERVAL", "0")
+    # Le banc rejoue les mêmes numéros à haut débit : limitation par numéro et plafonds d'admission
+    # coupés par défaut, sinon ils apparaissent comme des erreurs 429/503 dans le rapport
+    for name in ("RATE_LIMIT_PER_SECOND", "ADMISSION_MONEY_LIMIT", "ADMISSION_READ_LIMIT", "ADMISSION_ADMIN_LIMIT"):
+        os.environ.setdefault(name, "0")
+    import app
+    app.logger.setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    app.init_db()
+    numeros = seed(app, args.users)
+    accounts = {
+        "agent": [n for i, n in enumerate(numeros) if i % AGENT_EVERY == 0],
+        "standard": [n for i, n in enumerate(numeros) if i % AGENT_EVERY != 0],
+    }
+    mix = parse_mix(args.mix)
+    if args.direct:
+        if {"balance", "inscription"} & set(mix):
+            raise SystemExit("--direct ne mesure que les confirmations : retirez balance et inscription de --mix")
+        config = {
+            "started_at": datetime.now().isoformat(),
+            "target": "direct",
+            "backend": args.backend,
+            "users": args.users,
+            "duration_s": args.duration,
+            "concurrency": args.concurrency,
+            "mix": mix,
+        }
+        if args.warmup:
+            drive_direct(app, Recorder(), mix, accounts, args.warmup, args.concurrency)
+        recorder = Recorder()
+        start = time.perf_counter()
+        drive_direct(app, recorder, mix, accounts, args.duration, args.concurrency)
+        return report(recorder, time.perf_counter() - start, config)
+    # Numéros d'inscription partagés entre l'échauffement et la mesure
+    signups = itertools.count()
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+    else:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://bench",
+                                   timeout=args.timeout)
+    config = {
+        "started_at": datetime.now().isoformat(),
+        "target": args.url or "in-process",
+        "backend": args.backend,
+        "users": args.users,
+        "duration_s": args.duration,
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        "mix": mix,
+    }
+    if not args.url:
+        # Limites du worker dans ce processus (un serveur --url applique les siennes)
+        config["rate_limit_per_second"] = app.RATE_LIMIT_PER_SECOND
+        config["admission_limits"] = app.ADMISSION_LIMITS
+    async with client:
+        if args.warmup:
+            await drive(client, Recorder(), mix, accounts, signups, args.warmup, args.concurrency, args.rate)
+        recorder = Recorder()
+        start = time.perf_counter()
+        await drive(client, recorder, mix, accounts, signups, args.duration, args.concurrency, args.rate)
+        elapsed = time.perf_counter() - start
+    return report(recorder, elapsed, config)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc de charge des parcours de paiement Mopatas")
+    parser.add_argument("--users", type=int, default=1000, help="Comptes peuplés avant le banc")
+    parser.add_argument("--duration", type=float, default=10, help="Durée mesurée (s)")
+    parser.add_argument("--warmup", type=float, default=2, help="Échauffement non mesuré (s)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Parcours simultanés au maximum")
+    parser.add_argument("--rate", type=float, default=0, help="Parcours démarrés par seconde (0 : boucle fermée)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Poids des scénarios, ex. balance=60,envoi=40")
+    parser.add_argument("--url", help="Serveur à solliciter (par défaut, l'application dans ce processus)")
+    parser.add_argument("--direct", action="store_true",
+                        help="Appelle confirm_pending_transaction depuis des threads, sans HTTP")
+    parser.add_argument("--backend", choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument("--dsn", help="DSN PostgreSQL de la base de test (--backend postgres)")
+    parser.add_argument("--sqlite-path", default="mopatas_bench.sqlite3")
+    parser.add_argument("--timeout", type=float, default=30, help="Délai maximum d'une requête HTTP (s)")
+    parser.add_argument("--seed", type=int, help="Graine du tirage des scénarios")
+    parser.add_argument("--output", help="Fichier JSON du rapport (par défaut, la sortie standard)")
+    args = parser.parse_args()
+    if args.users < 3:
+        parser.error("--users doit valoir au moins 3")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    result = asyncio.run(bench(args))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Préparation de la base avant le démarrage des workers, et contrôle du temps de démarrage.
+
+    python bootstrap.py                       # migre le schéma et crée le compte d'entreprise
+    python bootstrap.py --status              # version du schéma (code de sortie 1 si en retard)
+    python bootstrap.py --boot-budget 1.5     # échec si l'import + le démarrage d'un worker dépasse 1,5 s
+
+La base est celle de l'application (DB_BACKEND, DATABASE_URL, SQLITE_PATH). À lancer une fois par
+déploiement, avant `gunicorn -k uvicorn.workers.UvicornWorker main:app` : les workers ne font
+que vérifier la version du schéma au démarrage.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Exécuté dans un interpréteur neuf : import de l'application puis cycle de vie ASGI complet
+# (contrôle du schéma, tâches de fond), comme au démarrage d'un worker
+BOOT_PROBE = """
+import asyncio, json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+
+async def boot():
+    async with app.app.router.lifespan_context(app.app):
+        return time.perf_counter()
+
+ready = asyncio.run(boot())
+print(json.dumps({"import_s": imported - started, "startup_s": ready - imported}))
+"""
+
+
+def measure_boot(runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", BOOT_PROBE], capture_output=True, text=True)
+        wall = time.perf_counter() - started
+        if result.returncode != 0:
+            raise RuntimeError(f"Démarrage du worker en échec :\n{result.stderr.strip()}")
+        sample = json.loads(result.stdout.strip().splitlines()[-1])
+        sample["boot_s"] = sample["import_s"] + sample["startup_s"]
+        sample["process_s"] = wall
+        samples.append(sample)
+    return {key: round(statistics.median(sample[key] for sample in samples), 4)
+            for key in ("import_s", "startup_s", "boot_s", "process_s")}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Préparation de la base Mopatas et contrôle du démarrage")
+    parser.add_argument("--status", action="store_true", help="Affiche la version du schéma sans migrer")
+    parser.add_argument("--boot-budget", type=float,
+                        help="Durée maximum (s, médiane) de l'import et du démarrage d'un worker")
+    parser.add_argument("--runs", type=int, default=5, help="Démarrages mesurés avec --boot-budget")
+    args = parser.parse_args(argv)
+
+    if args.boot_budget is not None:
+        result = measure_boot(args.runs)
+        print(json.dumps({**result, "budget_s": args.boot_budget, "runs": args.runs}, indent=2))
+        if result["boot_s"] > args.boot_budget:
+            print(f"Démarrage en {result['boot_s']:.3f}s, au-delà du budget de {args.boot_budget:.3f}s",
+                  file=sys.stderr)
+            return 1
+        return 0
+
+    from app import SCHEMA_VERSION, get_storage, init_db
+
+    if args.status:
+        version = get_storage().schema_version()
+        print(f"Version du schéma : {version} (attendue : {SCHEMA_VERSION})")
+        return 0 if version >= SCHEMA_VERSION else 1
+
+    started = time.perf_counter()
+    init_db()
+    print(f"Schéma en version {get_storage().schema_version()}, prêt en {time.perf_counter() - started:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1 +1,3 @@
-gunicorn -k uvicorn.workers.UvicornWorker main:app
+# Point d'entrée des workers : gunicorn -k uvicorn.workers.UvicornWorker main:app
+# Le schéma est créé et migré à part, avant le démarrage (python bootstrap.py)
+from app import app
@@ -0,0 +1,139 @@
+import bisect
+import threading
+
+# Bornes (s) par défaut des histogrammes de latence
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, registry, name, help, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def inc(self, *labels, value=1):
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def merge(self, values, data):
+        return (values or 0) + data
+
+    def render(self, values):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, registry, name, help, labels, buckets):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # Par fragment : [effectifs par intervalle (le dernier est +Inf), somme]
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        data = shard.get(key)
+        if data is None:
+            data = shard[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+
+    def merge(self, values, data):
+        if values is None:
+            return [list(data[0]), data[1]]
+        return [[a + b for a, b in zip(values[0], data[0])], values[1] + data[1]]
+
+    def render(self, values):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _labels(self.labels, labels, f'le="{_number(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Métriques d'un processus worker, exposées au format texte Prometheus.
+    Chaque thread incrémente ses propres compteurs (aucun verrou sur le chemin chaud) ;
+    `render` additionne les fragments des threads au moment de la collecte.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._gauges = []  # (préfixe, aide, fonction -> {nom: valeur})
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self._local = threading.local()
+
+    def shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def counter(self, name, help, labels=()):
+        return self._metrics.setdefault(name, Counter(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._metrics.setdefault(name, Histogram(self, name, help, labels, buckets))
+
+    def gauges(self, prefix, help, func):
+        # Jauges lues à la collecte : une série `<prefix>_<clé>` par valeur numérique renvoyée par `func`
+        self._gauges.append((prefix, help, func))
+
+    def render(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        merged = {name: {} for name in self._metrics}
+        for shard in shards:
+            for (name, labels), data in list(shard.items()):
+                values = merged[name]
+                values[labels] = self._metrics[name].merge(values.get(labels), data)
+
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.extend(metric.render(merged[name]))
+        for prefix, help, func in self._gauges:
+            for key, value in func().items():
+                if isinstance(value, bool):
+                    value = int(value)
+                elif not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# HELP {prefix}_{key} {help}")
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
@@ -0,0 +1,569 @@
+import argparse
+import sys
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+
+#####################################
+# Migrations du schéma PostgreSQL
+#####################################
+# Chaque migration est (version, nom, étapes) ; les versions sont appliquées dans l'ordre et
+# enregistrées dans `schema_version`. Toutes les étapes sont rejouables sans effet de bord
+# (IF NOT EXISTS, index invalides reconstruits), et tournent en autocommit pour permettre
+# CREATE INDEX CONCURRENTLY, qui ne verrouille pas les écritures du trafic en cours.
+
+# Clé du verrou consultatif qui sérialise les exécutions concurrentes du migrateur
+MIGRATION_LOCK_KEY = 727001
+
+
+def sql(statement):
+    def step(cursor):
+        cursor.execute(statement)
+    step.description = statement.strip().splitlines()[0]
+    return step
+
+
+def concurrent_index(name, table, columns, where=None, unique=False):
+    def step(cursor):
+        # Un CREATE INDEX CONCURRENTLY interrompu laisse un index invalide qu'IF NOT EXISTS ignorerait
+        cursor.execute("""
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND NOT i.indisvalid
+        """, (name,))
+        if cursor.fetchone():
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        cursor.execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} "
+            f"ON {table} ({columns})" + (f" WHERE {where}" if where else "")
+        )
+    step.description = f"index {name} ON {table} ({columns})"
+    return step
+
+
+MIGRATIONS = [
+    (1, "schéma initial", [
+        sql('''
+          CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            nom TEXT NOT NULL,
+            numero TEXT UNIQUE NOT NULL,
+            pass_word TEXT NOT NULL,
+            solde REAL NOT NULL,
+            type_compte TEXT NOT NULL DEFAULT 'standard',
+            codeCompte TEXT
+          )
+        '''),
+        sql('''
+          CREATE TABLE IF NOT EXISTS les_transactions (
+            id SERIAL PRIMARY KEY,
+            numero_envoyeur TEXT NOT NULL,
+            numero_destinataire TEXT NOT NULL,
+            montant REAL NOT NULL,
+            type_trans TEXT NOT NULL,
+            code_session TEXT UNIQUE NOT NULL,
+            etat TEXT NOT NULL,
+            transaction_hash TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+          )
+        '''),
+        sql('''
+          CREATE TABLE IF NOT EXISTS pending_registrations (
+             id SERIAL PRIMARY KEY,
+             code_session TEXT UNIQUE NOT NULL,
+             nom TEXT NOT NULL,
+             numero TEXT NOT NULL,
+             pass_word TEXT NOT NULL,
+             type_compte TEXT NOT NULL DEFAULT 'standard',
+             solde REAL NOT NULL,
+             code_entite TEXT,
+             codeCompte TEXT,
+             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+          )
+        '''),
+        sql('''
+          CREATE TABLE IF NOT EXISTS company_account (
+            id SERIAL PRIMARY KEY,
+            solde REAL NOT NULL,
+            pass_word TEXT NOT NULL
+          )
+        '''),
+        sql('''
+          CREATE TABLE IF NOT EXISTS premium_services (
+            id SERIAL PRIMARY KEY,
+            client TEXT NOT NULL,
+            produit TEXT NOT NULL,
+            percepteur TEXT NOT NULL,
+            transaction_hash TEXT NOT NULL
+          )
+        '''),
+    ]),
+    (2, "index des requêtes fréquentes", [
+        concurrent_index("idx_les_transactions_envoyeur_timestamp", "les_transactions", "numero_envoyeur, timestamp"),
+        concurrent_index("idx_les_transactions_etat_timestamp", "les_transactions", "etat, timestamp"),
+        concurrent_index("idx_premium_services_transaction_hash", "premium_services", "transaction_hash"),
+        concurrent_index("idx_pending_registrations_timestamp", "pending_registrations", "timestamp"),
+        # Remplacé par idx_les_transactions_etat_timestamp
+        sql("DROP INDEX CONCURRENTLY IF EXISTS idx_les_transactions_pending_timestamp"),
+    ]),
+    (3, "pagination des utilisateurs par type de compte", [
+        concurrent_index("idx_users_type_compte_id", "users", "type_compte, id"),
+    ]),
+    (4, "historique des transactions par compte", [
+        # Pagination par clé (timestamp, id) sur les transactions envoyées et reçues ; le destinataire
+        # est la première partie de numero_destinataire ("numero;client;produit;percepteur")
+        concurrent_index("idx_les_transactions_envoyeur_ts_id", "les_transactions", "numero_envoyeur, timestamp, id"),
+        concurrent_index("idx_les_transactions_destinataire_ts_id", "les_transactions",
+                         "split_part(numero_destinataire, ';', 1), timestamp, id"),
+        # Remplacé par idx_les_transactions_envoyeur_ts_id
+        sql("DROP INDEX CONCURRENTLY IF EXISTS idx_les_transactions_envoyeur_timestamp"),
+    ]),
+    (5, "clés d'idempotence", [
+        # Réponse enregistrée par (route, Idempotency-Key) ; status_code NULL tant que la requête d'origine tourne
+        sql('''
+          CREATE TABLE IF NOT EXISTS idempotency_keys (
+            id SERIAL PRIMARY KEY,
+            endpoint TEXT NOT NULL,
+            idem_key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status_code INTEGER,
+            response TEXT,
+            created_at TIMESTAMP NOT NULL,
+            UNIQUE (endpoint, idem_key)
+          )
+        '''),
+        concurrent_index("idx_idempotency_keys_created_at", "idempotency_keys", "created_at"),
+    ]),
+    (6, "grand livre", [
+        # Écritures en partie double, jamais modifiées : les lignes d'un même transaction_hash s'annulent.
+        # Comptes : numéro d'utilisateur, '@entreprise' ou '@externe' (argent entrant ou sortant du système).
+        # DOUBLE PRECISION : les sommes d'écritures ne doivent pas hériter de l'arrondi de REAL (float4).
+        sql('''
+          CREATE TABLE IF NOT EXISTS ledger_entries (
+            id BIGSERIAL PRIMARY KEY,
+            transaction_hash TEXT NOT NULL,
+            compte TEXT NOT NULL,
+            montant DOUBLE PRECISION NOT NULL,
+            libelle TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL
+          )
+        '''),
+        # Solde de chaque compte arrêté à l'écriture last_entry_id (cf. take_ledger_snapshot dans app.py)
+        sql('''
+          CREATE TABLE IF NOT EXISTS ledger_snapshots (
+            compte TEXT PRIMARY KEY,
+            solde DOUBLE PRECISION NOT NULL,
+            last_entry_id BIGINT NOT NULL,
+            taken_at TIMESTAMP NOT NULL
+          )
+        '''),
+        concurrent_index("idx_ledger_entries_compte_id", "ledger_entries", "compte, id"),
+        # Soldes d'ouverture : les comptes antérieurs au grand livre partent de leur solde courant
+        sql('''
+          INSERT INTO ledger_snapshots (compte, solde, last_entry_id, taken_at)
+          SELECT numero, solde, 0, LOCALTIMESTAMP FROM users u
+          WHERE NOT EXISTS (SELECT 1 FROM ledger_entries e WHERE e.compte = u.numero)
+          ON CONFLICT (compte) DO NOTHING
+        '''),
+        sql('''
+          INSERT INTO ledger_snapshots (compte, solde, last_entry_id, taken_at)
+          SELECT '@entreprise', solde, 0, LOCALTIMESTAMP FROM company_account
+          WHERE id = 1 AND NOT EXISTS (SELECT 1 FROM ledger_entries e WHERE e.compte = '@entreprise')
+          ON CONFLICT (compte) DO NOTHING
+        '''),
+    ]),
+    (7, "compte d'entreprise réparti", [
+        # Crédits du compte d'entreprise répartis sur plusieurs lignes (cf. credit_company dans app.py) ;
+        # solde de l'entreprise = company_account.solde + SUM(company_account_stripes.solde)
+        sql('''
+          CREATE TABLE IF NOT EXISTS company_account_stripes (
+            stripe INTEGER PRIMARY KEY,
+            solde DOUBLE PRECISION NOT NULL DEFAULT 0
+          )
+        '''),
+    ]),
+    (8, "cumuls des marchands", [
+        # Marchand (destinataire du liquider/facturer), montant et date recopiés dans premium_services
+        # pour le détail paginé sans jointure sur les_transactions
+        sql("ALTER TABLE premium_services ADD COLUMN IF NOT EXISTS marchand TEXT"),
+        sql("ALTER TABLE premium_services ADD COLUMN IF NOT EXISTS montant DOUBLE PRECISION"),
+        sql("ALTER TABLE premium_services ADD COLUMN IF NOT EXISTS created_at TIMESTAMP"),
+        sql('''
+          UPDATE premium_services p
+          SET marchand = TRIM(split_part(t.numero_destinataire, ';', 1)), montant = ROUND(t.montant), created_at = t.timestamp
+          FROM les_transactions t
+          WHERE t.transaction_hash = p.transaction_hash AND p.marchand IS NULL
+        '''),
+        # Cumuls tenus à jour à chaque paiement confirmé (cf. record_premium_payments dans app.py)
+        sql('''
+          CREATE TABLE IF NOT EXISTS merchant_rollups (
+            marchand TEXT NOT NULL,
+            jour DATE NOT NULL,
+            percepteur TEXT NOT NULL,
+            produit TEXT NOT NULL,
+            client TEXT NOT NULL,
+            paiements BIGINT NOT NULL DEFAULT 0,
+            montant DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (marchand, jour, percepteur, produit, client)
+          )
+        '''),
+        sql('''
+          CREATE TABLE IF NOT EXISTS merchant_totals (
+            marchand TEXT PRIMARY KEY,
+            paiements BIGINT NOT NULL DEFAULT 0,
+            montant DOUBLE PRECISION NOT NULL DEFAULT 0,
+            dernier_paiement TIMESTAMP
+          )
+        '''),
+        # Cumuls de l'historique existant, calculés une seule fois (tables encore vides)
+        sql('''
+          INSERT INTO merchant_rollups (marchand, jour, percepteur, produit, client, paiements, montant)
+          SELECT marchand, created_at::date, percepteur, produit, client, COUNT(*), SUM(montant)
+          FROM premium_services
+          WHERE marchand IS NOT NULL AND NOT EXISTS (SELECT 1 FROM merchant_rollups)
+          GROUP BY 1, 2, 3, 4, 5
+        '''),
+        sql('''
+          INSERT INTO merchant_totals (marchand, paiements, montant, dernier_paiement)
+          SELECT marchand, COUNT(*), SUM(montant), MAX(created_at)
+          FROM premium_services
+          WHERE marchand IS NOT NULL AND NOT EXISTS (SELECT 1 FROM merchant_totals)
+          GROUP BY marchand
+        '''),
+        concurrent_index("idx_premium_services_marchand_id", "premium_services", "marchand, id"),
+    ]),
+    (9, "boîte d'envoi des événements", [
+        # Événements écrits avec les soldes, livrés ensuite par la tâche de fond (cf. claim_outbox_batch
+        # dans app.py) ; status : 'pending', 'delivered' ou 'failed' (tentatives épuisées)
+        sql('''
+          CREATE TABLE IF NOT EXISTS outbox_events (
+            id BIGSERIAL PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            transaction_hash TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            delivered_at TIMESTAMP,
+            last_error TEXT
+          )
+        '''),
+        concurrent_index("idx_outbox_events_status_available_id", "outbox_events", "status, available_at, id"),
+        # Purge des événements livrés (cf. sweep_expired_sessions)
+        concurrent_index("idx_outbox_events_delivered_at", "outbox_events", "delivered_at",
+                         where="status = 'delivered'"),
+    ]),
+    (10, "crédit des agents en relatif", [
+        # Montant crédité par /makeagent, appliqué tel quel à la confirmation (et non un solde absolu)
+        sql("ALTER TABLE pending_registrations ADD COLUMN IF NOT EXISTS montant DOUBLE PRECISION"),
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+#####################################
+# Schéma SQLite (stockage embarqué)
+#####################################
+# Même schéma que les migrations PostgreSQL ci-dessus, dans sa version courante (REAL est déjà
+# un flottant 64 bits en SQLite). Toutes les instructions sont rejouables ; PRAGMA user_version tient le rôle de `schema_version`.
+# L'index sur split_part() nécessite la fonction enregistrée par storage.SQLiteConnection.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nom TEXT NOT NULL,
+    numero TEXT UNIQUE NOT NULL,
+    pass_word TEXT NOT NULL,
+    solde REAL NOT NULL,
+    type_compte TEXT NOT NULL DEFAULT 'standard',
+    codeCompte TEXT
+);
+CREATE TABLE IF NOT EXISTS les_transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    numero_envoyeur TEXT NOT NULL,
+    numero_destinataire TEXT NOT NULL,
+    montant REAL NOT NULL,
+    type_trans TEXT NOT NULL,
+    code_session TEXT UNIQUE NOT NULL,
+    etat TEXT NOT NULL,
+    transaction_hash TEXT,
+    timestamp TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+);
+CREATE TABLE IF NOT EXISTS pending_registrations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    code_session TEXT UNIQUE NOT NULL,
+    nom TEXT NOT NULL,
+    numero TEXT NOT NULL,
+    pass_word TEXT NOT NULL,
+    type_compte TEXT NOT NULL DEFAULT 'standard',
+    solde REAL NOT NULL,
+    code_entite TEXT,
+    codeCompte TEXT,
+    timestamp TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime'))
+);
+CREATE TABLE IF NOT EXISTS company_account (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    solde REAL NOT NULL,
+    pass_word TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS premium_services (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client TEXT NOT NULL,
+    produit TEXT NOT NULL,
+    percepteur TEXT NOT NULL,
+    transaction_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    endpoint TEXT NOT NULL,
+    idem_key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    status_code INTEGER,
+    response TEXT,
+    created_at TIMESTAMP NOT NULL,
+    UNIQUE (endpoint, idem_key)
+);
+CREATE TABLE IF NOT EXISTS ledger_entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_hash TEXT NOT NULL,
+    compte TEXT NOT NULL,
+    montant REAL NOT NULL,
+    libelle TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ledger_snapshots (
+    compte TEXT PRIMARY KEY,
+    solde REAL NOT NULL,
+    last_entry_id INTEGER NOT NULL,
+    taken_at TIMESTAMP NOT NULL
+);
+CREATE TABLE IF NOT EXISTS company_account_stripes (
+    stripe INTEGER PRIMARY KEY,
+    solde REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS merchant_rollups (
+    marchand TEXT NOT NULL,
+    jour TEXT NOT NULL,
+    percepteur TEXT NOT NULL,
+    produit TEXT NOT NULL,
+    client TEXT NOT NULL,
+    paiements INTEGER NOT NULL DEFAULT 0,
+    montant REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (marchand, jour, percepteur, produit, client)
+);
+CREATE TABLE IF NOT EXISTS merchant_totals (
+    marchand TEXT PRIMARY KEY,
+    paiements INTEGER NOT NULL DEFAULT 0,
+    montant REAL NOT NULL DEFAULT 0,
+    dernier_paiement TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS outbox_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_type TEXT NOT NULL,
+    transaction_hash TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    delivered_at TIMESTAMP,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_les_transactions_etat_timestamp ON les_transactions (etat, timestamp);
+CREATE INDEX IF NOT EXISTS idx_premium_services_transaction_hash ON premium_services (transaction_hash);
+CREATE INDEX IF NOT EXISTS idx_pending_registrations_timestamp ON pending_registrations (timestamp);
+CREATE INDEX IF NOT EXISTS idx_users_type_compte_id ON users (type_compte, id);
+CREATE INDEX IF NOT EXISTS idx_les_transactions_envoyeur_ts_id ON les_transactions (numero_envoyeur, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_les_transactions_destinataire_ts_id
+    ON les_transactions (split_part(numero_destinataire, ';', 1), timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at);
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_compte_id ON ledger_entries (compte, id);
+CREATE INDEX IF NOT EXISTS idx_outbox_events_status_available_id ON outbox_events (status, available_at, id);
+CREATE INDEX IF NOT EXISTS idx_outbox_events_delivered_at ON outbox_events (delivered_at) WHERE status = 'delivered';
+INSERT INTO ledger_snapshots (compte, solde, last_entry_id, taken_at)
+SELECT numero, solde, 0, strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime') FROM users u
+WHERE NOT EXISTS (SELECT 1 FROM ledger_entries e WHERE e.compte = u.numero)
+ON CONFLICT (compte) DO NOTHING;
+INSERT INTO ledger_snapshots (compte, solde, last_entry_id, taken_at)
+SELECT '@entreprise', solde, 0, strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime') FROM company_account
+WHERE id = 1 AND NOT EXISTS (SELECT 1 FROM ledger_entries e WHERE e.compte = '@entreprise')
+ON CONFLICT (compte) DO NOTHING;
+"""
+
+# Colonnes ajoutées à une table existante : ALTER TABLE ... ADD COLUMN n'a pas de IF NOT EXISTS en SQLite
+SQLITE_COLUMNS = [
+    ("premium_services", "marchand", "TEXT"),
+    ("premium_services", "montant", "REAL"),
+    ("premium_services", "created_at", "TIMESTAMP"),
+    ("pending_registrations", "montant", "REAL"),
+]
+
+# Exécuté après l'ajout des colonnes ci-dessus (cf. migration 8)
+SQLITE_BACKFILL = """
+UPDATE premium_services
+SET marchand = TRIM(split_part(t.numero_destinataire, ';', 1)), montant = ROUND(t.montant), created_at = t.timestamp
+FROM les_transactions t
+WHERE t.transaction_hash = premium_services.transaction_hash AND premium_services.marchand IS NULL;
+INSERT INTO merchant_rollups (marchand, jour, percepteur, produit, client, paiements, montant)
+SELECT marchand, date(created_at), percepteur, produit, client, COUNT(*), SUM(montant)
+FROM premium_services
+WHERE marchand IS NOT NULL AND NOT EXISTS (SELECT 1 FROM merchant_rollups)
+GROUP BY 1, 2, 3, 4, 5;
+INSERT INTO merchant_totals (marchand, paiements, montant, dernier_paiement)
+SELECT marchand, COUNT(*), SUM(montant), MAX(created_at)
+FROM premium_services
+WHERE marchand IS NOT NULL AND NOT EXISTS (SELECT 1 FROM merchant_totals)
+GROUP BY marchand;
+CREATE INDEX IF NOT EXISTS idx_premium_services_marchand_id ON premium_services (marchand, id);
+"""
+
+
+def sqlite_version(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()
+    return version["user_version"] if isinstance(version, dict) else version[0]
+
+
+def migrate_sqlite(conn, log=print):
+    # `conn` : connexion sqlite3 brute, hors transaction
+    version = sqlite_version(conn)
+    if version >= SCHEMA_VERSION:
+        return []
+    log(f"Schéma SQLite : version {version} -> {SCHEMA_VERSION}")
+    conn.executescript(SQLITE_SCHEMA)
+    for table, column, kind in SQLITE_COLUMNS:
+        existing = {row["name"] if isinstance(row, dict) else row[1]
+                    for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+    conn.executescript(SQLITE_BACKFILL)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return list(range(version + 1, SCHEMA_VERSION + 1))
+
+
+def ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def current_version(cursor):
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL AS present")
+    if not cursor.fetchone()["present"]:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version")
+    return cursor.fetchone()["version"]
+
+
+def migrate(conn, target=None, log=print):
+    # `conn` doit être une connexion dédiée (hors pool) : elle est passée en autocommit
+    conn.autocommit = True
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+    try:
+        ensure_version_table(cursor)
+        version = current_version(cursor)
+        applied = []
+        for number, name, steps in MIGRATIONS:
+            if number <= version or (target is not None and number > target):
+                continue
+            log(f"Migration {number} : {name}")
+            for step in steps:
+                log(f"  - {step.description}")
+                step(cursor)
+            cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (number, name))
+            applied.append(number)
+        return applied
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+        cursor.close()
+
+
+#####################################
+# Plans d'exécution des requêtes fréquentes
+#####################################
+HOT_QUERIES = [
+    ("utilisateur par numéro",
+     "SELECT * FROM users WHERE numero = %s", ("0000000000",)),
+    ("transaction par code_session",
+     "SELECT * FROM les_transactions WHERE code_session = %s", ("00000000",)),
+    ("historique envoyé",
+     "SELECT * FROM les_transactions WHERE numero_envoyeur = %s AND (timestamp, id) < (LOCALTIMESTAMP, 0) "
+     "ORDER BY timestamp DESC, id DESC LIMIT 50", ("0000000000",)),
+    ("historique reçu",
+     "SELECT * FROM les_transactions WHERE split_part(numero_destinataire, ';', 1) = %s "
+     "AND (timestamp, id) < (LOCALTIMESTAMP, 0) ORDER BY timestamp DESC, id DESC LIMIT 50", ("0000000000",)),
+    ("balayage des transactions en attente",
+     "SELECT id FROM les_transactions WHERE etat = 'pending' AND timestamp < LOCALTIMESTAMP - INTERVAL '15 minutes' "
+     "ORDER BY timestamp LIMIT 1000", ()),
+    ("balayage des inscriptions en attente",
+     "SELECT id FROM pending_registrations WHERE timestamp < LOCALTIMESTAMP - INTERVAL '15 minutes' "
+     "ORDER BY timestamp LIMIT 1000", ()),
+    ("page d'utilisateurs par type de compte",
+     "SELECT id, nom, numero, solde, type_compte FROM users WHERE id > %s AND type_compte = %s ORDER BY id LIMIT 100",
+     (0, "agent")),
+    ("service premium par transaction_hash",
+     "SELECT * FROM premium_services WHERE transaction_hash = %s", ("00000000-0000-0000-0000-000000000000",)),
+    ("totaux d'un marchand",
+     "SELECT paiements, montant, dernier_paiement FROM merchant_totals WHERE marchand = %s", ("0000000000",)),
+    ("cumuls d'un marchand par jour",
+     "SELECT jour, SUM(paiements), SUM(montant) FROM merchant_rollups WHERE marchand = %s "
+     "GROUP BY jour ORDER BY jour DESC LIMIT 50", ("0000000000",)),
+    ("détail des paiements d'un marchand",
+     "SELECT id, transaction_hash, client, produit, percepteur, montant, created_at FROM premium_services "
+     "WHERE marchand = %s ORDER BY id DESC LIMIT 50", ("0000000000",)),
+    ("événements de l'outbox à livrer",
+     "SELECT id FROM outbox_events WHERE status = 'pending' AND available_at <= LOCALTIMESTAMP "
+     "ORDER BY available_at, id LIMIT 100", ()),
+    ("écritures du grand livre après l'instantané",
+     "SELECT COALESCE(SUM(montant), 0) FROM ledger_entries WHERE compte = %s AND id > %s", ("0000000000", 0)),
+]
+
+
+def explain_hot_queries(conn, analyze=False, log=print):
+    cursor = conn.cursor()
+    for name, query, params in HOT_QUERIES:
+        cursor.execute(f"EXPLAIN {'(ANALYZE, BUFFERS) ' if analyze else ''}{query}", params)
+        log(f"== {name}")
+        for row in cursor.fetchall():
+            log(f"   {row[0]}")
+    conn.rollback()
+    cursor.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrations du schéma Mopatas")
+    parser.add_argument("--dsn", help="DSN PostgreSQL (défaut : DATABASE_URL de l'application)")
+    parser.add_argument("--target", type=int, help="Version cible (défaut : dernière)")
+    parser.add_argument("--status", action="store_true", help="Affiche la version du schéma sans migrer")
+    parser.add_argument("--explain", action="store_true", help="Affiche les plans des requêtes fréquentes")
+    parser.add_argument("--analyze", action="store_true", help="Avec --explain : EXPLAIN ANALYZE")
+    args = parser.parse_args(argv)
+
+    dsn = args.dsn
+    if dsn is None:
+        from app import DATABASE_URL
+        dsn = DATABASE_URL
+    if not dsn:
+        parser.error("--dsn ou DATABASE_URL requis")
+    conn = psycopg2.connect(dsn)
+    try:
+        if args.status:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            print(f"Version du schéma : {current_version(cursor)} (attendue : {SCHEMA_VERSION})")
+        elif args.explain:
+            explain_hot_queries(conn, analyze=args.analyze)
+        else:
+            applied = migrate(conn, target=args.target)
+            print(f"{len(applied)} migration(s) appliquée(s)" if applied else "Schéma déjà à jour")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+import base64
+import hashlib
+import hmac
+import os
+
+# Hachage scrypt (hashlib, sans dépendance). Avec les valeurs par défaut, un calcul
+# mobilise 16 Mio et quelques dizaines de millisecondes de CPU : il tourne dans le pool
+# de processus de app.py, jamais dans la boucle d'événements.
+SCRYPT_N = int(os.environ.get("PASSWORD_SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(os.environ.get("PASSWORD_SCRYPT_R", "8"))
+SCRYPT_P = int(os.environ.get("PASSWORD_SCRYPT_P", "1"))
+PREFIX = "scrypt$"
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode()
+
+
+def _scrypt(secret, salt, n, r, p):
+    return hashlib.scrypt(secret.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=128 * r * (n + p + 2) + (1 << 20), dklen=32)
+
+
+def is_hashed(stored):
+    return stored.startswith(PREFIX)
+
+
+def needs_rehash(stored):
+    # Mot de passe encore en clair, ou haché avec d'autres paramètres que ceux en vigueur
+    if not is_hashed(stored):
+        return True
+    _, n, r, p, _, _ = stored.split("$")
+    return (int(n), int(r), int(p)) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+def hash_password(secret):
+    # Format : scrypt$N$r$p$sel$empreinte (base64)
+    salt = os.urandom(16)
+    digest = _scrypt(secret, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"{PREFIX}{SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+
+
+def verify_password(secret, stored):
+    # Les anciennes lignes en clair sont comparées telles quelles (puis re-hachées par l'appelant)
+    if not is_hashed(stored):
+        return hmac.compare_digest(secret.encode(), stored.encode())
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        expected = base64.b64decode(digest)
+        actual = _scrypt(secret, base64.b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
@@ -0,0 +1,312 @@
+"""
+Rapprochement hors ligne des soldes avec l'historique des transactions.
+
+Recalcule le solde attendu de chaque compte à partir de ses écritures d'ouverture,
+d'ajustement et de crédit d'agent (grand livre) et des transactions 'completed' de les_transactions, avec les
+frais de calculate_fees et le bonus de 20 % de liquider/facturer, puis le compare à
+users.solde. Vérifie aussi que chaque liquider/facturer a sa ligne premium_services.
+
+Les comptes sont répartis en tranches de numéros traitées par un pool de processus ;
+chaque tranche lit les transactions par curseur côté serveur, par paquets de --chunk
+lignes, et n'a en mémoire que ses propres comptes.
+
+    python reconcile.py --output ecarts.csv
+    python reconcile.py --workers 8 --partitions 64 --dsn postgresql://localhost/mopatas
+    python reconcile.py --backend sqlite --sqlite-path mopatas_local.sqlite3
+
+Code de sortie 1 si des écarts (ou des services premium manquants) sont trouvés.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import psycopg2
+
+from storage import SQLiteConnection, translate_query
+
+# Écritures du grand livre qui ne correspondent à aucune ligne de les_transactions
+OPENING_LABELS = ["ouverture", "ajustement", "credit_agent"]
+COMPANY = "@entreprise"
+# Types qui créditent le destinataire (montant, ou bonus de 20 % des frais)
+CREDIT_TYPES = ["envoi", "paie", "depot", "liquider", "facturer"]
+BONUS_RATE = 0.2
+RECIPIENT = "TRIM(split_part(numero_destinataire, ';', 1))"
+
+
+#####################################
+# Connexions (une par processus, hors pool de l'application)
+#####################################
+class Source:
+    def __init__(self, backend, dsn, sqlite_path):
+        self.backend = backend
+        if backend == "postgres":
+            self.conn = psycopg2.connect(dsn)
+            self.conn.set_session(readonly=True)
+        else:
+            self.conn = SQLiteConnection(sqlite_path, write=False, busy_timeout=30)
+            # Tuples plutôt que dictionnaires : plusieurs millions de lignes par tranche
+            self.conn.raw.row_factory = None
+
+    def stream(self, query, params, chunk):
+        # Paquets de `chunk` lignes (curseur nommé côté serveur en PostgreSQL)
+        if self.backend == "postgres":
+            cursor = self.conn.cursor(name=f"reconcile_{uuid.uuid4().hex}")
+            cursor.itersize = chunk
+            cursor.execute(query, params)
+        else:
+            params = tuple(json.dumps(p) if isinstance(p, list) else p for p in params)
+            cursor = self.conn.raw.execute(translate_query(query), params)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def one(self, query, params=()):
+        rows = next(iter(self.stream(query, params, 1)), None)
+        return rows[0] if rows else None
+
+    def close(self):
+        if self.backend == "postgres":
+            self.conn.rollback()
+        self.conn.close()
+
+
+def range_filter(column, low, high):
+    # Tranche [low, high) ; high=None pour la dernière
+    if high is None:
+        return f"{column} >= %s", (low,)
+    return f"{column} >= %s AND {column} < %s", (low, high)
+
+
+def partition_bounds(source, partitions):
+    # Premier numéro de chaque tranche (NTILE sur l'index unique de users.numero)
+    bounds = []
+    for rows in source.stream("""
+        SELECT MIN(numero) FROM (
+            SELECT numero, NTILE(%s) OVER (ORDER BY numero) AS part FROM users
+        ) tranches GROUP BY part ORDER BY 1
+    """, (partitions,), 10000):
+        bounds.extend(row[0] for row in rows)
+    return [(low, bounds[i + 1] if i + 1 < len(bounds) else None) for i, low in enumerate(bounds)]
+
+
+#####################################
+# Tranche de comptes (processus du pool)
+#####################################
+def reconcile_range(backend, dsn, sqlite_path, low, high, chunk, tolerance):
+    from app import FeeSchedule, load_config
+
+    schedule = FeeSchedule.from_config(load_config())
+    started = time.perf_counter()
+    source = Source(backend, dsn, sqlite_path)
+    try:
+        where, params = range_filter("numero", low, high)
+        numeros = []
+        soldes = []
+        for rows in source.stream(f"SELECT numero, solde FROM users WHERE {where} ORDER BY numero", params, chunk):
+            for numero, solde in rows:
+                numeros.append(numero)
+                soldes.append(solde)
+        index = {numero: i for i, numero in enumerate(numeros)}
+        expected = np.zeros(len(numeros), dtype=np.float64)
+
+        def add(accounts, deltas):
+            # Comptes hors tranche (ou inexistants) ignorés, comme dans process_transaction
+            positions = np.fromiter((index.get(numero, -1) for numero in accounts), dtype=np.int64,
+                                    count=len(accounts))
+            known = positions >= 0
+            expected[:] += np.bincount(positions[known], weights=deltas[known], minlength=len(numeros))
+
+        where, params = range_filter("compte", low, high)
+        for rows in source.stream(f"""
+            SELECT compte, SUM(montant) FROM ledger_entries
+            WHERE libelle = ANY(%s) AND {where} GROUP BY compte
+        """, (OPENING_LABELS, *params), chunk):
+            add([row[0] for row in rows], np.array([row[1] for row in rows], dtype=np.float64))
+
+        # Transactions envoyées : débit (ou crédit pour depot_pro) de l'envoyeur et part de l'entreprise,
+        # comptée une seule fois par transaction, dans la tranche de l'envoyeur
+        transactions = 0
+        company = 0.0
+        missing_premium = []
+        where, params = range_filter("t.numero_envoyeur", low, high)
+        for rows in source.stream(f"""
+            SELECT t.numero_envoyeur, t.montant, t.type_trans, t.id,
+                   CASE WHEN t.type_trans IN ('liquider', 'facturer') THEN
+                       EXISTS (SELECT 1 FROM premium_services p WHERE p.transaction_hash = t.transaction_hash)
+                   END
+            FROM les_transactions t WHERE t.etat = 'completed' AND {where}
+        """, params, chunk):
+            transactions += len(rows)
+            accounts, montants, types, ids, premium = zip(*rows)
+            # Mêmes arrondis que process_transaction (round, demi-pair) et process_bulk_transfer
+            montants = np.round(np.array(montants, dtype=np.float64))
+            types = np.array(types)
+            sender = np.zeros(len(rows))
+            for transaction_type in np.unique(types):
+                mask = types == transaction_type
+                m = montants[mask]
+                fee = schedule.fees(m, transaction_type)
+                if transaction_type == "retrait":
+                    sender[mask] = -(m + fee)
+                    company += float((m + fee).sum())
+                elif transaction_type in ("envoi", "paie", "depot"):
+                    sender[mask] = -m
+                elif transaction_type in ("liquider", "facturer"):
+                    sender[mask] = -(m + fee)
+                    company += float((fee - fee * BONUS_RATE).sum())
+                elif transaction_type == "depot_pro":
+                    sender[mask] = m
+                    company -= float(m.sum())
+            add(accounts, sender)
+            missing_premium.extend(i for i, present in zip(ids, premium) if present is not None and not present)
+
+        # Transactions reçues : montant, ou bonus de 20 % des frais pour liquider/facturer. Destinataire
+        # débarrassé de ses espaces, comme dans process_transaction ("0812345678 ;..." crédite 0812345678)
+        where, params = range_filter(RECIPIENT, low, high)
+        for rows in source.stream(f"""
+            SELECT {RECIPIENT}, montant, type_trans FROM les_transactions
+            WHERE etat = 'completed' AND type_trans = ANY(%s) AND {where}
+        """, (CREDIT_TYPES, *params), chunk):
+            accounts, montants, types = zip(*rows)
+            montants = np.round(np.array(montants, dtype=np.float64))
+            types = np.array(types)
+            recipient = np.zeros(len(rows))
+            for transaction_type in np.unique(types):
+                mask = types == transaction_type
+                m = montants[mask]
+                if transaction_type in ("liquider", "facturer"):
+                    recipient[mask] = schedule.fees(m, transaction_type) * BONUS_RATE
+                else:
+                    recipient[mask] = m
+            add(accounts, recipient)
+    finally:
+        source.close()
+
+    soldes = np.array(soldes, dtype=np.float64)
+    ecarts = soldes - expected
+    differences = [(numeros[i], float(soldes[i]), float(expected[i]), float(ecarts[i]))
+                   for i in np.flatnonzero(np.abs(ecarts) > tolerance)]
+    return {
+        "low": low,
+        "high": high,
+        "accounts": len(numeros),
+        "transactions": transactions,
+        "company_delta": company,
+        "differences": differences,
+        "missing_premium": missing_premium,
+        "duration_s": time.perf_counter() - started,
+    }
+
+
+#####################################
+# Coordination
+#####################################
+def company_check(source, company_delta):
+    # Solde agrégé (ligne principale + bandes) comparé à l'ouverture + part de l'entreprise recalculée
+    row = source.one("""
+        SELECT c.solde + COALESCE((SELECT SUM(solde) FROM company_account_stripes), 0)
+        FROM company_account c WHERE c.id = 1
+    """)
+    opening = source.one("SELECT COALESCE(SUM(montant), 0) FROM ledger_entries WHERE compte = %s AND libelle = ANY(%s)",
+                         (COMPANY, OPENING_LABELS))
+    if row is None:
+        return None
+    expected = opening[0] + company_delta
+    return {"solde": row[0], "attendu": expected, "ecart": row[0] - expected}
+
+
+def reconcile(backend, dsn, sqlite_path, workers, partitions, chunk, tolerance, output=None, log=print):
+    started = time.perf_counter()
+    source = Source(backend, dsn, sqlite_path)
+    try:
+        ranges = partition_bounds(source, partitions)
+    finally:
+        source.close()
+    log(f"{len(ranges)} tranche(s) de comptes, {workers} processus")
+
+    totals = {"accounts": 0, "transactions": 0, "differences": 0, "missing_premium": 0}
+    company_delta = 0.0
+    missing_premium = []
+    writer = None
+    out = open(output, "w", newline="", encoding="utf-8") if output else None
+    try:
+        if out:
+            writer = csv.writer(out)
+            writer.writerow(["numero", "solde", "attendu", "ecart"])
+        # forkserver : les processus ne dupliquent ni les threads ni les connexions du parent
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as pool:
+            futures = [pool.submit(reconcile_range, backend, dsn, sqlite_path, low, high, chunk, tolerance)
+                       for low, high in ranges]
+            for future in as_completed(futures):
+                result = future.result()
+                totals["accounts"] += result["accounts"]
+                totals["transactions"] += result["transactions"]
+                totals["differences"] += len(result["differences"])
+                totals["missing_premium"] += len(result["missing_premium"])
+                company_delta += result["company_delta"]
+                missing_premium.extend(result["missing_premium"])
+                if writer:
+                    writer.writerows(result["differences"])
+                log(f"  tranche {result['low']} .. {result['high'] or 'fin'} : {result['accounts']} compte(s), "
+                    f"{result['transactions']} transaction(s), {len(result['differences'])} écart(s) "
+                    f"en {result['duration_s']:.1f}s")
+    finally:
+        if out:
+            out.close()
+
+    source = Source(backend, dsn, sqlite_path)
+    try:
+        company = company_check(source, company_delta)
+    finally:
+        source.close()
+    elapsed = time.perf_counter() - started
+    return {
+        **totals,
+        "company": company,
+        "missing_premium_ids": sorted(missing_premium)[:100],
+        "duration_s": round(elapsed, 3),
+        "transactions_per_s": round(totals["transactions"] / elapsed) if elapsed else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rapprochement des soldes Mopatas avec l'historique des transactions")
+    parser.add_argument("--backend", choices=["postgres", "sqlite"], default=os.environ.get("DB_BACKEND", "postgres"))
+    parser.add_argument("--dsn", help="DSN PostgreSQL (défaut : DATABASE_URL de l'application)")
+    parser.add_argument("--sqlite-path", default=os.environ.get("SQLITE_PATH", "mopatas_local.sqlite3"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processus de calcul")
+    parser.add_argument("--partitions", type=int, help="Tranches de comptes (défaut : 4 par processus)")
+    parser.add_argument("--chunk", type=int, default=50000, help="Lignes lues par paquet")
+    parser.add_argument("--tolerance", type=float, default=1.0,
+                        help="Écart toléré ; users.solde est un REAL (float4) en PostgreSQL")
+    parser.add_argument("--output", help="CSV des écarts (numero, solde, attendu, ecart)")
+    args = parser.parse_args(argv)
+
+    dsn = args.dsn
+    if args.backend == "postgres" and dsn is None:
+        from app import DATABASE_URL
+        dsn = DATABASE_URL
+    if args.backend == "postgres" and not dsn:
+        parser.error("--dsn ou DATABASE_URL requis")
+    log = lambda message: print(message, file=sys.stderr)
+    result = reconcile(args.backend, dsn, args.sqlite_path, args.workers, args.partitions or 4 * args.workers,
+                       args.chunk, args.tolerance, args.output, log=log)
+    print(json.dumps(result, indent=2, ensure_ascii=False, default=str))
+    company_ok = result["company"] is None or abs(result["company"]["ecart"]) <= args.tolerance
+    return 0 if not result["differences"] and not result["missing_premium"] and company_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,520 @@
+import functools
+import json
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+
+import psycopg2
+import psycopg2.errors
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, execute_values
+
+from metrics import registry
+from migrations import current_version, migrate, migrate_sqlite, sqlite_version
+
+
+# Erreurs communes aux deux moteurs, pour les helpers de app.py
+DatabaseError = (psycopg2.Error, sqlite3.Error)
+IntegrityError = (psycopg2.IntegrityError, sqlite3.IntegrityError)
+# Attente d'un verrou de ligne au-delà de lock_timeout (PostgreSQL ; en SQLite, l'attente du
+# rédacteur unique est bornée par le délai du pool et lève PoolTimeout)
+LockTimeout = (psycopg2.errors.LockNotAvailable,)
+
+#####################################
+# Mesures de la couche base de données
+#####################################
+# Compteurs de la requête HTTP en cours ({"queries": n, "transactions": n}, posés par le middleware
+# de app.py) et nom du helper qui parle à la base (posé par run_db), pour étiqueter les métriques.
+db_round_trips = ContextVar("db_round_trips", default=None)
+db_helper = ContextVar("db_helper", default="other")
+
+DB_QUERIES = registry.counter("mopatas_db_queries_total", "Instructions SQL envoyées, par helper", ["helper"])
+DB_QUERY_SECONDS = registry.histogram("mopatas_db_query_duration_seconds",
+                                      "Durée des instructions SQL, par helper", ["helper"])
+DB_CHECKOUTS = registry.counter("mopatas_db_checkouts_total",
+                                "Connexions empruntées (une transaction chacune), par helper", ["helper"])
+DB_CONNECTS = registry.counter("mopatas_db_connections_opened_total", "Connexions physiques ouvertes", ["backend"])
+
+
+def record_query(started, n=1):
+    helper = db_helper.get()
+    DB_QUERIES.inc(helper, value=n)
+    DB_QUERY_SECONDS.observe(time.perf_counter() - started, helper)
+    counter = db_round_trips.get()
+    if counter is not None:
+        counter["queries"] += n
+
+
+def record_checkout():
+    DB_CHECKOUTS.inc(db_helper.get())
+    counter = db_round_trips.get()
+    if counter is not None:
+        counter["transactions"] += 1
+
+
+#####################################
+# PostgreSQL : pool de connexions
+#####################################
+class PoolTimeout(Exception):
+    pass
+
+
+class MeteredCursor(RealDictCursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(started)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(started, len(vars_list))
+
+    def fetchmany(self, size=None):
+        # Curseur nommé : chaque paquet est un FETCH côté serveur
+        if self.name is None:
+            return super().fetchmany(size)
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(size)
+        finally:
+            record_query(started)
+
+
+class ConnectionPool:
+    """
+    Pool de connexions psycopg2 thread-safe, borné à `maxconn`.
+    `getconn` attend au plus `timeout` secondes qu'une connexion se libère.
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5.0, check_idle=30.0, lock_timeout=None):
+        self.dsn = dsn
+        self.lock_timeout = lock_timeout
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._idle = deque()  # (conn, dernière utilisation)
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        # lock_timeout posé à l'ouverture de la session : aucun aller-retour de plus par transaction
+        options = {"options": f"-c lock_timeout={int(self.lock_timeout * 1000)}"} if self.lock_timeout else {}
+        conn = psycopg2.connect(self.dsn, cursor_factory=MeteredCursor, **options)
+        self._stats["created"] += 1
+        DB_CONNECTS.inc("postgres")
+        return conn
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _discard(self, conn):
+        self._close(conn)
+        with self._cond:
+            self._size -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"Aucune connexion libre après {self.timeout}s")
+                self._cond.wait(remaining)
+            waited = time.monotonic() - start
+            self._stats["checkouts"] += 1
+            self._stats["wait_total"] += waited
+            self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+
+        if conn is not None and not self._healthy(conn, last_used):
+            # Remplacée sans rendre sa place : un thread en attente ne peut pas ouvrir une connexion de trop
+            self._close(conn)
+            with self._cond:
+                self._stats["discarded"] += 1
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def putconn(self, conn):
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+                self._size -= 1
+
+    def stats(self):
+        with self._cond:
+            checkouts = self._stats["checkouts"]
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "checkouts": checkouts,
+                "timeouts": self._stats["timeouts"],
+                "created": self._stats["created"],
+                "discarded": self._stats["discarded"],
+                "wait_avg_ms": round(1000 * self._stats["wait_total"] / checkouts, 3) if checkouts else 0.0,
+                "wait_max_ms": round(1000 * self._stats["wait_max"], 3),
+            }
+
+
+
+class PostgresStorage:
+    """
+    Stockage PostgreSQL : connexions empruntées au pool, transactions psycopg2 (`with conn`).
+    """
+
+    dialect = "postgres"
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5.0, check_idle=30.0, lock_timeout=None):
+        self.dsn = dsn
+        self.pool = ConnectionPool(dsn, minconn, maxconn, timeout, check_idle, lock_timeout)
+
+    def getconn(self, write=True):
+        return self.pool.getconn()
+
+    def putconn(self, conn, write=True):
+        self.pool.putconn(conn)
+
+    def stream_cursor(self, conn, itersize):
+        # Curseur nommé : les lignes restent côté serveur et arrivent par paquets de `itersize`
+        cursor = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+        cursor.itersize = itersize
+        return cursor
+
+    def add_to_balances(self, cursor, rows):
+        # rows : [(numero, delta)] appliqués en une seule requête
+        execute_values(cursor, """
+            UPDATE users AS u SET solde = u.solde + v.delta
+            FROM (VALUES %s) AS v(numero, delta)
+            WHERE u.numero = v.numero
+        """, rows)
+
+    def insert_many(self, cursor, table, columns, rows, page_size=500, on_conflict=""):
+        execute_values(cursor, f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s {on_conflict}", rows,
+                       page_size=page_size)
+
+    def migrate(self, log=print):
+        # Connexion dédiée hors pool : les migrations tournent en autocommit
+        conn = psycopg2.connect(self.dsn)
+        try:
+            return migrate(conn, log=log)
+        finally:
+            conn.close()
+
+    def schema_version(self):
+        # Contrôle au démarrage d'un worker : une connexion du pool, aucune DDL
+        conn = self.getconn()
+        try:
+            with conn:
+                return current_version(conn.cursor())
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        return {"backend": self.dialect, **self.pool.stats()}
+
+    def close(self):
+        self.pool.closeall()
+
+
+#####################################
+# SQLite embarqué (WAL)
+#####################################
+# Pour les bornes mono-nœud et les tests de charge locaux : une seule connexion d'écriture
+# (les transactions d'écriture démarrent par BEGIN IMMEDIATE, ce qui sérialise les écritures comme
+# les verrous de ligne de PostgreSQL) et un pool de connexions de lecture, qui lisent en parallèle
+# grâce au WAL. Les requêtes des helpers sont écrites pour PostgreSQL et traduites une fois par texte
+# de requête ; sqlite3 garde ensuite les instructions préparées en cache sur chaque connexion.
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+
+@functools.lru_cache(maxsize=1024)
+def translate_query(query):
+    # FOR UPDATE [SKIP LOCKED] est inutile sous BEGIN IMMEDIATE ; `= ANY(liste)` devient un json_each
+    query = re.sub(r"\s+FOR UPDATE(\s+SKIP LOCKED)?", "", query)
+    query = query.replace("= ANY(%s)", "IN (SELECT value FROM json_each(%s))")
+    return query.replace("%s", "?")
+
+
+def _split_part(value, delimiter, field):
+    # Équivalent de split_part() de PostgreSQL (champ manquant = chaîne vide)
+    if value is None:
+        return None
+    parts = value.split(delimiter)
+    return parts[field - 1] if 0 < field <= len(parts) else ""
+
+
+def _dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=()):
+        params = tuple(json.dumps(p) if isinstance(p, (list, tuple)) else p for p in params or ())
+        started = time.perf_counter()
+        try:
+            self._cursor.execute(translate_query(query), params)
+        finally:
+            record_query(started)
+        return self
+
+    def executemany(self, query, rows):
+        started = time.perf_counter()
+        try:
+            self._cursor.executemany(translate_query(query), rows)
+        finally:
+            record_query(started)
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """
+    Connexion sqlite3 présentée comme une connexion psycopg2 : `cursor()`, et `with conn:`
+    qui ouvre la transaction (IMMEDIATE pour l'écrivain) puis la valide ou l'annule.
+    """
+
+    def __init__(self, path, write, busy_timeout):
+        self.write = write
+        self.raw = sqlite3.connect(
+            path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=512,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=busy_timeout,
+        )
+        DB_CONNECTS.inc("sqlite")
+        self.raw.row_factory = _dict_row
+        self.raw.create_function("split_part", 3, _split_part, deterministic=True)
+        self.raw.execute("PRAGMA journal_mode=WAL")
+        self.raw.execute("PRAGMA synchronous=NORMAL")
+        self.raw.execute("PRAGMA temp_store=MEMORY")
+        self.raw.execute("PRAGMA cache_size=-16000")
+        self.raw.execute("PRAGMA mmap_size=268435456")
+        if not write:
+            self.raw.execute("PRAGMA query_only=ON")
+
+    def cursor(self):
+        return SQLiteCursor(self.raw.cursor())
+
+    def __enter__(self):
+        self.raw.execute("BEGIN IMMEDIATE" if self.write else "BEGIN")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.raw.in_transaction:
+            self.raw.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+    def close(self):
+        self.raw.close()
+
+
+class SQLiteStorage:
+    dialect = "sqlite"
+
+    def __init__(self, path, readers=4, timeout=5.0):
+        self.path = path
+        self.readers = readers
+        self.timeout = timeout
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._readers = deque()
+        self._reader_count = 0
+        self._cond = threading.Condition()
+        self._stats = {"writes": 0, "reads": 0, "timeouts": 0, "write_wait_total": 0.0, "write_wait_max": 0.0}
+
+    def getconn(self, write=True):
+        if write:
+            start = time.monotonic()
+            if not self._writer_lock.acquire(timeout=self.timeout):
+                self._stats["timeouts"] += 1
+                raise PoolTimeout(f"Connexion d'écriture SQLite occupée depuis {self.timeout}s")
+            waited = time.monotonic() - start
+            self._stats["writes"] += 1
+            self._stats["write_wait_total"] += waited
+            self._stats["write_wait_max"] = max(self._stats["write_wait_max"], waited)
+            try:
+                if self._writer is None:
+                    self._writer = SQLiteConnection(self.path, True, self.timeout)
+            except Exception:
+                self._writer_lock.release()
+                raise
+            return self._writer
+
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while not self._readers and self._reader_count >= self.readers:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"Aucune connexion de lecture SQLite libre après {self.timeout}s")
+                self._cond.wait(remaining)
+            self._stats["reads"] += 1
+            if self._readers:
+                return self._readers.pop()
+            self._reader_count += 1
+        try:
+            return SQLiteConnection(self.path, False, self.timeout)
+        except Exception:
+            with self._cond:
+                self._reader_count -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, write=True):
+        if conn.raw.in_transaction:
+            conn.raw.execute("ROLLBACK")
+        if conn.write:
+            self._writer_lock.release()
+            return
+        with self._cond:
+            self._readers.append(conn)
+            self._cond.notify()
+
+    def stream_cursor(self, conn, itersize):
+        # Le curseur sqlite3 avance déjà pas à pas : rien n'est matérialisé d'avance
+        return conn.cursor()
+
+    def add_to_balances(self, cursor, rows):
+        cursor.executemany("UPDATE users SET solde = solde + %s WHERE numero = %s",
+                           [(delta, numero) for numero, delta in rows])
+
+    def insert_many(self, cursor, table, columns, rows, page_size=500, on_conflict=""):
+        cursor.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) {on_conflict}",
+            rows
+        )
+
+    def migrate(self, log=print):
+        conn = self.getconn(write=True)
+        try:
+            return migrate_sqlite(conn.raw, log=log)
+        finally:
+            self.putconn(conn, write=True)
+
+    def schema_version(self):
+        conn = self.getconn(write=False)
+        try:
+            return sqlite_version(conn.raw)
+        finally:
+            self.putconn(conn, write=False)
+
+    def stats(self):
+        with self._cond:
+            writes = self._stats["writes"]
+            return {
+                "backend": self.dialect,
+                "path": self.path,
+                "readers_max": self.readers,
+                "readers_open": self._reader_count,
+                "readers_idle": len(self._readers),
+                "writer_busy": self._writer_lock.locked(),
+                "reads": self._stats["reads"],
+                "writes": writes,
+                "timeouts": self._stats["timeouts"],
+                "write_wait_avg_ms": round(1000 * self._stats["write_wait_total"] / writes, 3) if writes else 0.0,
+                "write_wait_max_ms": round(1000 * self._stats["write_wait_max"], 3),
+            }
+
+    def close(self):
+        with self._cond:
+            while self._readers:
+                self._readers.pop().close()
+                self._reader_count -= 1
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
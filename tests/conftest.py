@@ -0,0 +1,42 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Base SQLite jetable et tâches de fond coupées, avant le premier import d'app (lu à l'import)
+_tmpdir = tempfile.mkdtemp(prefix="mopatas-tests-")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_tmpdir, "mopatas.sqlite3")
+for name in ("OUTBOX_POLL_INTERVAL", "EXPIRY_SWEEP_INTERVAL", "LEDGER_SNAPSHOT_INTERVAL", "COMPANY_FOLD_INTERVAL"):
+    os.environ[name] = "0"
+os.environ.pop("OUTBOX_SINK_PATH", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_numeros = itertools.count(1)
+
+
+@pytest.fixture(scope="session")
+def app():
+    # Les workers ne migrent pas : le schéma est créé ici, comme par bootstrap.py
+    import app as mopatas
+    mopatas.init_db()
+    yield mopatas
+    if mopatas._storage is not None:
+        mopatas._storage.close()
+        mopatas._storage = None
+
+
+@pytest.fixture
+def client(app):
+    # Cycle de vie complet du worker (contrôle du schéma, tâches de fond coupées par l'environnement)
+    from fastapi.testclient import TestClient
+    with TestClient(app.app) as client:
+        yield client
+
+
+@pytest.fixture
+def numero():
+    # Numéros à 10 chiffres, uniques sur toute la session
+    return lambda: f"08{next(_numeros):08d}"
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_gate_sheds_when_queue_is_full(app):
+    async def run():
+        gate = app.AdmissionGate("test", 1, queue_size=1, timeout=1.0)
+        assert await gate.acquire()
+        queued = asyncio.create_task(gate.acquire())
+        await asyncio.sleep(0)
+        assert not await gate.acquire()
+        # La place libérée passe directement au premier en file
+        gate.release(0.01)
+        assert await queued
+        gate.release(0.01)
+        return gate.stats()
+
+    stats = asyncio.run(run())
+    assert (stats["admitted"], stats["queued"], stats["shed_full"], stats["inflight"]) == (1, 1, 1, 0)
+
+
+def test_gate_sheds_when_deadline_passes(app):
+    async def run():
+        gate = app.AdmissionGate("test", 1, queue_size=8, timeout=0.05)
+        assert await gate.acquire()
+        assert not await gate.acquire()
+        # Durée moyenne telle que l'attente estimée dépasse le délai : refus sans attendre
+        gate._service_time = 1.0
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert not await gate.acquire()
+        assert loop.time() - started < 0.05
+        return gate.stats()
+
+    stats = asyncio.run(run())
+    assert (stats["shed_timeout"], stats["shed_estimate"], stats["waiting"]) == (1, 1, 0)
+
+
+def test_shed_request_gets_503_with_cors_headers(app, client, monkeypatch):
+    gate = app.AdmissionGate("read", 1, queue_size=0, timeout=1.0)
+    gate._inflight = 1  # plafond déjà atteint
+    monkeypatch.setitem(app.admission_gates, "read", gate)
+
+    response = client.post("/balance", json={"numero": "0800000000"}, headers={"Origin": "https://app.mopatas.cd"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert response.headers["Access-Control-Allow-Origin"] in ("*", "https://app.mopatas.cd")
+    assert "retry-after" in response.headers["Access-Control-Expose-Headers"].lower()
+
+
+def test_token_bucket_limits_then_refills(app, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, "monotonic", clock)
+    limiter = app.RateLimiter(rate=2, burst=3)
+
+    for _ in range(3):
+        limiter.check("/balance", "0811111111")
+    with pytest.raises(HTTPException) as limited:
+        limiter.check("/balance", "0811111111")
+    assert limited.value.status_code == 429
+    assert limited.value.headers["Retry-After"] == "1"
+    # Les autres numéros ont leur propre seau
+    limiter.check("/balance", "0822222222")
+
+    # 0,5 s à 2 jetons/s : un jeton de plus, pas deux
+    clock.now += 0.5
+    limiter.check("/balance", "0811111111")
+    with pytest.raises(HTTPException):
+        limiter.check("/balance", "0811111111")
+
+    # Une longue pause ne remplit le seau que jusqu'à la rafale
+    clock.now += 60
+    for _ in range(3):
+        limiter.check("/balance", "0811111111")
+    with pytest.raises(HTTPException):
+        limiter.check("/balance", "0811111111")
+    assert limiter.stats()["limited"] == 3
+
+
+def test_bucket_is_charged_only_after_authentication(app, client, monkeypatch, numero):
+    victime = numero()
+    assert app.insert_user("Victime", victime, "bon-mot-de-passe", solde=10.0, codeCompte="cc")
+    monkeypatch.setattr(app, "rate_limiter", app.RateLimiter(rate=0.01, burst=2))
+
+    # Un tiers qui ne connaît que le numéro n'épuise pas le seau du titulaire
+    for _ in range(5):
+        response = client.post("/balance", json={"numero": victime, "password": "faux", "codeCompte": "cc"})
+        assert response.status_code == 400
+
+    body = {"numero": victime, "password": "bon-mot-de-passe", "codeCompte": "cc"}
+    assert [client.post("/balance", json=body).status_code for _ in range(2)] == [200, 200]
+    limited = client.post("/balance", json=body)
+    assert limited.status_code == 429
+    assert int(limited.headers["Retry-After"]) >= 1
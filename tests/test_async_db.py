@@ -0,0 +1,43 @@
+import asyncio
+import threading
+import time
+
+import httpx
+
+
+def test_concurrent_balance_calls_overlap(app, monkeypatch, numero):
+    # Helper SQL lent et bloquant : servi dans la boucle d'événements, il sérialiserait les appels
+    compte = numero()
+    assert app.insert_user("Titulaire", compte, "secret", solde=500.0, codeCompte="cc")
+    lock = threading.Lock()
+    running = {"now": 0, "max": 0}
+    get_user_by_number = app.get_user_by_number
+
+    def slow_get_user(numero):
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        try:
+            time.sleep(0.2)
+            return get_user_by_number(numero)
+        finally:
+            with lock:
+                running["now"] -= 1
+    monkeypatch.setattr(app, "get_user_by_number", slow_get_user)
+
+    async def run(calls):
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(
+                client.post("/balance", json={"numero": compte, "password": "secret", "codeCompte": "cc"})
+                for _ in range(calls)
+            ))
+            return responses, time.perf_counter() - started
+
+    responses, elapsed = asyncio.run(run(5))
+    assert [response.status_code for response in responses] == [200] * 5
+    assert all(response.json()["solde"] == 500.0 for response in responses)
+    # Cinq appels de 0,2 s : bien moins de 1 s s'ils se chevauchent
+    assert running["max"] >= 2
+    assert elapsed < 0.6
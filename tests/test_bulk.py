@@ -0,0 +1,84 @@
+import pytest
+
+
+@pytest.fixture
+def accounts(app, numero):
+    envoyeur, destinataire, marchand = numero(), numero(), numero()
+    assert app.insert_user("Employeur", envoyeur, "secret", solde=100000.0, codeCompte="cc-lot")
+    assert app.insert_user("Employé", destinataire, "x")
+    assert app.insert_user("Marchand", marchand, "x", type_compte="premium")
+    return envoyeur, destinataire, marchand
+
+
+def batch(client, envoyeur, items, codeCompte="cc-lot"):
+    return client.post("/transaction_batch", json={
+        "num_envoyeur": envoyeur, "pass_word": "secret", "codeCompte": codeCompte, "items": items,
+    })
+
+
+def completed_rows(app, envoyeur):
+    with app.db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) AS n FROM les_transactions WHERE numero_envoyeur = %s", (envoyeur,))
+        return cursor.fetchone()["n"]
+
+
+def test_invalid_items_are_rejected_without_failing_the_batch(app, client, accounts, numero):
+    envoyeur, destinataire, marchand = accounts
+    response = batch(client, envoyeur, [
+        {"num_destinataire": destinataire, "montant": 1000},
+        {"num_destinataire": destinataire, "montant": 1000, "transaction_type": "depot_pro"},
+        {"num_destinataire": destinataire, "montant": 0},
+        {"num_destinataire": numero(), "montant": 1000},
+        {"num_destinataire": f"{marchand};client", "montant": 1000, "transaction_type": "liquider"},
+        {"num_destinataire": destinataire, "montant": 2000, "transaction_type": "paie"},
+    ])
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["completed"], body["rejected"], body["total_debit"]) == (2, 4, 3000)
+    assert [item["status"] for item in body["items"]] == [
+        "completed", "rejected", "rejected", "rejected", "rejected", "completed",
+    ]
+    assert completed_rows(app, envoyeur) == 2
+    assert app.ledger_balance(envoyeur)["solde_compte"] == 97000.0
+    assert app.ledger_balance(destinataire)["solde_compte"] == 3000.0
+
+
+def test_insufficient_net_balance_rolls_back_the_whole_batch(app, client, accounts):
+    envoyeur, destinataire, _ = accounts
+    response = batch(client, envoyeur, [
+        {"num_destinataire": destinataire, "montant": 60000},
+        {"num_destinataire": destinataire, "montant": 60000},
+    ])
+    assert response.status_code == 400
+    assert completed_rows(app, envoyeur) == 0
+    for compte, attendu in ((envoyeur, 100000.0), (destinataire, 0.0)):
+        balance = app.ledger_balance(compte)
+        assert (balance["solde_compte"], balance["ecart"]) == (attendu, 0)
+
+
+def test_item_fees_are_the_fees_actually_debited(app, client, accounts):
+    envoyeur, destinataire, marchand = accounts
+    response = batch(client, envoyeur, [
+        {"num_destinataire": destinataire, "montant": 10000, "transaction_type": "retrait"},
+        {"num_destinataire": f"{marchand};client;produit;caisse", "montant": 30000,
+         "transaction_type": "liquider"},
+        {"num_destinataire": destinataire, "montant": 5000, "transaction_type": "paie"},
+    ])
+    assert response.status_code == 200
+    body = response.json()
+    frais = [item["frais"] for item in body["items"]]
+    assert frais[0] == app.calculate_fees(10000, "retrait")
+    assert frais[1] == app.calculate_fees(30000, "liquider")
+    assert frais[2] == 0
+    assert body["total_debit"] == pytest.approx(sum(item["montant"] + item["frais"] for item in body["items"]))
+    assert app.ledger_balance(envoyeur)["solde_compte"] == pytest.approx(100000 - body["total_debit"])
+    # Bonus de 20 % des frais pour le marchand
+    assert app.ledger_balance(marchand)["solde_compte"] == pytest.approx(frais[1] * 0.2)
+
+
+def test_batch_checks_codeCompte(app, client, accounts):
+    envoyeur, destinataire, _ = accounts
+    response = batch(client, envoyeur, [{"num_destinataire": destinataire, "montant": 1000}], codeCompte="autre")
+    assert response.status_code == 400
+    assert completed_rows(app, envoyeur) == 0
@@ -0,0 +1,74 @@
+import uuid
+
+import pytest
+
+
+def confirm(app, envoyeur, destinataire, montant, transaction_type):
+    code = uuid.uuid4().hex
+    app.insert_transaction(envoyeur, destinataire, montant, transaction_type, code)
+    return app.confirm_pending_transaction(code)
+
+
+def company(app):
+    # (ligne principale, somme des bandes, solde agrégé)
+    with app.db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT solde FROM company_account WHERE id = 1")
+        main = cursor.fetchone()["solde"]
+        cursor.execute("SELECT COALESCE(SUM(solde), 0) AS solde FROM company_account_stripes")
+        stripes = cursor.fetchone()["solde"]
+        return main, stripes, app.company_balance(cursor)
+
+
+def company_ledger(app):
+    return app.ledger_balance(app.LEDGER_COMPANY)["solde"]
+
+
+@pytest.fixture
+def agent(app, numero):
+    agent = numero()
+    assert app.insert_user("Agent", agent, "x", type_compte="agent", solde=50000.0)
+    return agent
+
+
+def test_credits_land_on_stripes_and_fold_into_the_main_row(app, agent, numero):
+    guichet = numero()
+    assert app.insert_user("Guichet", guichet, "x", type_compte="agent")
+    app.fold_company_stripes()
+    main, stripes, total = company(app)
+    ledger = company_ledger(app)
+    assert stripes == 0
+
+    for _ in range(3):
+        confirm(app, agent, guichet, 5000, "retrait")
+    after_main, after_stripes, after_total = company(app)
+    credited = company_ledger(app) - ledger
+    assert credited > 15000
+    assert (after_main, after_stripes, after_total) == (main, credited, total + credited)
+
+    assert app.fold_company_stripes() == credited
+    assert company(app) == (main + credited, 0, total + credited)
+    assert app.ledger_balance(agent)["ecart"] == 0
+
+
+def test_depot_pro_is_checked_against_the_aggregate(app, agent):
+    main, _, total = company(app)
+    # Tout le solde dans une bande : la ligne principale seule ne couvre plus rien
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE company_account SET solde = 0 WHERE id = 1")
+        app.credit_company(cursor, main)
+    assert company(app)[0] == 0
+
+    confirm(app, agent, agent, 1000, "depot_pro")
+    assert company(app)[2] == total - 1000
+    assert app.ledger_balance(agent)["solde_compte"] == 51000.0
+
+    with pytest.raises(app.HTTPException) as excinfo:
+        confirm(app, agent, agent, total, "depot_pro")
+    assert excinfo.value.status_code == 400
+    assert company(app)[2] == total - 1000
+
+    app.fold_company_stripes()
+    assert company(app) == (total - 1000, 0, total - 1000)
+    assert app.ledger_balance(agent)["ecart"] == 0
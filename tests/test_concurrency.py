@@ -0,0 +1,62 @@
+import asyncio
+import uuid
+
+from fastapi import HTTPException
+
+
+def confirm_all(app, codes):
+    # Confirmations concurrentes par le chemin de /confirm_transaction : verrous de compte, puis run_db
+    async def run():
+        return await asyncio.gather(*(
+            app._confirm_transaction(app.ConfirmTransactionRequest(code_session=code, confirmation=True))
+            for code in codes
+        ), return_exceptions=True)
+    return asyncio.run(run())
+
+
+def pending(app, envoyeur, destinataire, montant, count, transaction_type="envoi"):
+    codes = [uuid.uuid4().hex for _ in range(count)]
+    for code in codes:
+        app.insert_transaction(envoyeur, destinataire, montant, transaction_type, code)
+    return codes
+
+
+def test_concurrent_confirmations_keep_balance_and_ledger(app, numero):
+    envoyeur, destinataire = numero(), numero()
+    assert app.insert_user("Envoyeur", envoyeur, "x", solde=100000.0)
+    assert app.insert_user("Destinataire", destinataire, "x")
+    codes = pending(app, envoyeur, destinataire, 1000, 40)
+
+    # Chaque code est confirmé deux fois en même temps : une seule confirmation doit passer
+    results = confirm_all(app, codes + codes)
+
+    completed = [r for r in results if isinstance(r, dict)]
+    rejected = [r for r in results if isinstance(r, HTTPException)]
+    assert len(completed) == 40
+    assert len(rejected) == 40 and all(r.status_code == 400 for r in rejected)
+    assert len({r["transaction_hash"] for r in completed}) == 40
+
+    for compte, attendu in ((envoyeur, 60000.0), (destinataire, 40000.0)):
+        balance = app.ledger_balance(compte)
+        assert balance["solde_compte"] == attendu
+        assert balance["solde"] == attendu
+        assert balance["ecart"] == 0
+
+
+def test_concurrent_confirmations_never_overdraw(app, numero):
+    envoyeur, destinataire = numero(), numero()
+    assert app.insert_user("Envoyeur", envoyeur, "x", solde=10000.0)
+    assert app.insert_user("Destinataire", destinataire, "x")
+    codes = pending(app, envoyeur, destinataire, 1000, 25)
+
+    results = confirm_all(app, codes)
+
+    completed = [r for r in results if isinstance(r, dict)]
+    rejected = [r for r in results if isinstance(r, HTTPException)]
+    assert len(completed) == 10
+    assert len(rejected) == 15 and all(r.status_code == 400 for r in rejected)
+
+    for compte, attendu in ((envoyeur, 0.0), (destinataire, 10000.0)):
+        balance = app.ledger_balance(compte)
+        assert balance["solde_compte"] == attendu
+        assert balance["ecart"] == 0
@@ -0,0 +1,46 @@
+import math
+
+import numpy as np
+import pytest
+
+TRANSACTION_TYPES = ["envoi", "paie", "depot", "retrait", "liquider", "facturer", "depot_pro"]
+
+
+def legacy_calculate_fees(montant, transaction_type):
+    # Chaîne if/elif d'avant le barème en tables, recopiée telle quelle
+    if transaction_type in ['envoi', 'depot']:
+        return 0
+    fee = 0
+    if montant <= 20000:
+        fee = montant * 0.05
+    elif montant <= 100000:
+        rate = 0.05 - (montant - 20000) * ((0.05 - 0.035) / (100000 - 20000))
+        fee = montant * rate
+    elif montant <= 200000:
+        fee = montant * 0.03
+    elif montant <= 1000000:
+        rate = 0.03 - (montant - 200000) * ((0.03 - 0.015) / (1000000 - 200000))
+        fee = montant * rate
+    else:
+        fee = montant * 0.01
+    return fee
+
+
+def boundary_amounts():
+    montants = [0.0, 0.01, 1.0, 99.5, 12345.0, 54321.0, 150000.0, 654321.0, 5e6, 1e12]
+    for plafond in (20000, 100000, 200000, 1000000):
+        for offset in (-1, -0.5, 0, 0.5, 1):
+            montants.append(float(plafond + offset))
+        montants += [math.nextafter(plafond, 0), math.nextafter(plafond, math.inf)]
+    return montants
+
+
+@pytest.mark.parametrize("transaction_type", TRANSACTION_TYPES)
+def test_schedule_matches_legacy_chain(app, transaction_type):
+    schedule = app.FeeSchedule()
+    montants = boundary_amounts()
+    attendus = [legacy_calculate_fees(montant, transaction_type) for montant in montants]
+
+    # Égalité exacte, montant par montant et en lot
+    assert [schedule.fee(montant, transaction_type) for montant in montants] == attendus
+    assert schedule.fees(np.array(montants), transaction_type).tolist() == attendus
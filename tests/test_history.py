@@ -0,0 +1,81 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+BASE = datetime(2026, 1, 1, 12, 0, 0)
+
+
+@pytest.fixture
+def history(app, numero):
+    # Sept transactions de A : cinq envoyées, deux reçues ; deux partagent le même horodatage
+    titulaire, autre = numero(), numero()
+    assert app.insert_user("Titulaire", titulaire, "secret", codeCompte="cc-hist")
+    assert app.insert_user("Autre", autre, "x")
+    rows = [
+        (titulaire, autre, "envoi", 0, "completed"),
+        (titulaire, autre, "paie", 1, "pending"),
+        (autre, titulaire, "envoi", 2, "completed"),
+        (titulaire, f"{autre};client;produit;caisse", "liquider", 3, "completed"),
+        (titulaire, autre, "envoi", 3, "expired"),
+        (autre, titulaire, "depot", 4, "completed"),
+        (titulaire, autre, "envoi", 5, "completed"),
+    ]
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        for envoyeur, destinataire, type_trans, minutes, etat in rows:
+            cursor.execute("""
+                INSERT INTO les_transactions (numero_envoyeur, numero_destinataire, montant, type_trans,
+                                              code_session, etat, timestamp)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, (envoyeur, destinataire, 100, type_trans, uuid.uuid4().hex, etat, BASE + timedelta(minutes=minutes)))
+    return titulaire
+
+
+def page(client, numero, **body):
+    response = client.post("/history", json={"numero": numero, "pass_word": "secret", "codeCompte": "cc-hist", **body})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def walk(client, numero, limit, **filters):
+    # Toutes les pages, en suivant next_cursor
+    transactions, cursor = [], {}
+    while True:
+        body = page(client, numero, limit=limit, **filters, **cursor)
+        transactions += body["transactions"]
+        if body["next_cursor"] is None:
+            return transactions
+        cursor = body["next_cursor"]
+
+
+def test_keyset_pages_cover_history_once_in_order(client, history):
+    complete = page(client, history, limit=100)["transactions"]
+    assert len(complete) == 7
+    keys = [(t["timestamp"], t["id"]) for t in complete]
+    assert keys == sorted(keys, reverse=True)
+
+    for limit in (1, 2, 3):
+        assert [t["id"] for t in walk(client, history, limit)] == [t["id"] for t in complete]
+
+
+def test_history_filters(client, history):
+    assert {t["sens"] for t in walk(client, history, 2, direction="sent")} == {"envoyé"}
+    assert len(walk(client, history, 2, direction="sent")) == 5
+    assert [t["type_trans"] for t in walk(client, history, 2, direction="received")] == ["depot", "envoi"]
+    assert len(walk(client, history, 2, type_trans="envoi")) == 4
+    assert len(walk(client, history, 2, etat="completed")) == 5
+    window = walk(client, history, 2, date_from=(BASE + timedelta(minutes=2)).isoformat(),
+                  date_to=(BASE + timedelta(minutes=4)).isoformat())
+    assert sorted(t["type_trans"] for t in window) == ["envoi", "envoi", "liquider"]
+
+
+def test_history_requires_credentials(client, history):
+    wrong = client.post("/history", json={"numero": history, "pass_word": "faux", "codeCompte": "cc-hist"})
+    assert wrong.status_code == 400
+    missing_code = client.post("/history", json={"numero": history, "pass_word": "secret"})
+    assert missing_code.status_code == 400
+    # Curseur incomplet refusé par le modèle
+    partial = client.post("/history", json={"numero": history, "pass_word": "secret", "codeCompte": "cc-hist",
+                                            "before_id": 10})
+    assert partial.status_code == 422
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import json
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+
+def stored_key(app, key):
+    with app.db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM idempotency_keys WHERE endpoint = %s AND idem_key = %s", ("/transaction", key))
+        return cursor.fetchone()
+
+
+def test_transaction_replay_and_mismatch_keep_secrets_out(app, client, numero):
+    envoyeur, destinataire = numero(), numero()
+    secret = "Mot-de-passe-42!"
+    assert app.insert_user("Envoyeur", envoyeur, secret, solde=50000.0, codeCompte="code-compte-secret")
+    assert app.insert_user("Destinataire", destinataire, "x")
+    body = {"num_envoyeur": envoyeur, "num_destinataire": destinataire, "montant": 1000,
+            "pass_word": secret, "transaction_type": "envoi", "codeCompte": "code-compte-secret"}
+    headers = {"Idempotency-Key": "cle-rejeu"}
+
+    first = client.post("/transaction", json=body, headers=headers)
+    assert first.status_code == 200
+    replay = client.post("/transaction", json=body, headers=headers)
+    assert replay.status_code == 200
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert replay.json()["code_session"] == first.json()["code_session"]
+
+    # Même clé, autre corps
+    other = client.post("/transaction", json={**body, "montant": 2000}, headers=headers)
+    assert other.status_code == 422
+
+    row = stored_key(app, "cle-rejeu")
+    assert row["status_code"] == 200
+    assert secret not in json.dumps(row, default=str)
+    assert "code-compte-secret" not in json.dumps(row, default=str)
+    # L'empreinte n'est pas un hachage rapide du corps complet (oracle hors ligne du mot de passe)
+    full = app.TransactionRequest(**body).model_dump()
+    assert row["fingerprint"] != hashlib.sha256(json.dumps(full, sort_keys=True, default=str).encode()).hexdigest()
+
+    # Une seule transaction en attente pour les deux appels
+    with app.db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) AS n FROM les_transactions WHERE numero_envoyeur = %s", (envoyeur,))
+        assert cursor.fetchone()["n"] == 1
+
+
+def run_idempotent(app, key, payload, handler, endpoint="/test-idempotence"):
+    request = SimpleNamespace(headers={"Idempotency-Key": key})
+    return app.idempotency.run(request, endpoint, payload, handler)
+
+
+def test_concurrent_duplicates_execute_once(app):
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return {"code_session": "ABC"}
+
+    async def run():
+        return await asyncio.gather(*(run_idempotent(app, "cle-doublons", {"montant": 1}, handler)
+                                      for _ in range(3)))
+
+    responses = asyncio.run(run())
+    assert len(calls) == 1
+    assert [json.loads(response.body) for response in responses] == [{"code_session": "ABC"}] * 3
+    assert sum(response.headers.get("Idempotent-Replayed") == "true" for response in responses) == 2
+
+
+def test_client_errors_are_replayed_and_retryable_ones_released(app):
+    calls = []
+
+    def failing(status_code):
+        async def handler():
+            calls.append(status_code)
+            raise HTTPException(status_code=status_code, detail="refus")
+        return handler
+
+    # 409 : la clé est libérée, le rejeu s'exécute de nouveau
+    for _ in range(2):
+        with pytest.raises(HTTPException):
+            asyncio.run(run_idempotent(app, "cle-409", {}, failing(409)))
+    # 400 : réponse enregistrée, rejouée sans nouvelle exécution
+    first = asyncio.run(run_idempotent(app, "cle-400", {}, failing(400)))
+    replay = asyncio.run(run_idempotent(app, "cle-400", {}, failing(400)))
+    assert calls == [409, 409, 400]
+    assert (first.status_code, replay.status_code) == (400, 400)
+    assert replay.headers["Idempotent-Replayed"] == "true"
+
+
+def test_stale_inflight_key_is_taken_over(app):
+    endpoint, key = "/test-idempotence", "cle-orpheline"
+    assert app.claim_idempotency_key(endpoint, key, "empreinte") is None
+    # Original toujours en cours : ni reprise, ni par une autre requête
+    assert app.claim_idempotency_key(endpoint, key, "empreinte")["status_code"] is None
+    with app.db_connection() as conn:
+        conn.cursor().execute("UPDATE idempotency_keys SET created_at = %s WHERE endpoint = %s AND idem_key = %s",
+                              (datetime.now() - timedelta(seconds=app.IDEMPOTENCY_STALE + 1), endpoint, key))
+    # Worker de l'original arrêté : une autre requête ne peut pas le reprendre, un rejeu identique si
+    assert app.claim_idempotency_key(endpoint, key, "autre")["fingerprint"] == "empreinte"
+    assert app.claim_idempotency_key(endpoint, key, "empreinte") is None
+
+
+def test_replay_waits_for_the_original_on_another_worker(app):
+    # L'original (autre worker) a réservé la clé puis répond pendant que le rejeu attend
+    endpoint, key = "/test-idempotence", "cle-distante"
+    fingerprint = hashlib.sha256(json.dumps({"montant": 5}, sort_keys=True).encode()).hexdigest()
+    assert app.claim_idempotency_key(endpoint, key, fingerprint) is None
+
+    async def handler():
+        raise AssertionError("le rejeu ne doit pas s'exécuter")
+
+    async def run():
+        replay = asyncio.create_task(run_idempotent(app, key, {"montant": 5}, handler, endpoint))
+        await asyncio.sleep(0.2)
+        await app.run_db(app.complete_idempotency_key, endpoint, key, 200, json.dumps({"code_session": "XYZ"}))
+        return await replay
+
+    response = asyncio.run(run())
+    assert json.loads(response.body) == {"code_session": "XYZ"}
+    assert response.headers["Idempotent-Replayed"] == "true"
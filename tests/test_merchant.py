@@ -0,0 +1,88 @@
+import uuid
+from datetime import date, timedelta
+
+import pytest
+
+# (client, produit, percepteur, montant)
+PAYMENTS = [
+    ("c1", "eau", "caisse-a", 1000),
+    ("c2", "eau", "caisse-a", 2000),
+    ("c1", "courant", "caisse-b", 3000),
+    ("c3", "courant", "caisse-c", 4000),
+]
+
+
+@pytest.fixture
+def merchant(app, client, numero):
+    marchand, payeur = numero(), numero()
+    assert app.insert_user("Marchand", marchand, "secret", type_compte="premium", codeCompte="cc-m")
+    assert app.insert_user("Payeur", payeur, "secret", solde=100000.0)
+    # Un paiement confirmé seul, les autres en lot
+    client_, produit, percepteur, montant = PAYMENTS[0]
+    code = uuid.uuid4().hex
+    app.insert_transaction(payeur, f"{marchand};{client_};{produit};{percepteur}", montant, "liquider", code)
+    app.confirm_pending_transaction(code)
+    response = client.post("/transaction_batch", json={"num_envoyeur": payeur, "pass_word": "secret", "items": [
+        {"num_destinataire": f"{marchand};{c};{p};{k}", "montant": m, "transaction_type": "facturer"}
+        for c, p, k, m in PAYMENTS[1:]
+    ]})
+    assert response.json()["completed"] == 3
+    return marchand
+
+
+def post(client, path, marchand, **body):
+    response = client.post(path, json={"numero": marchand, "pass_word": "secret", "codeCompte": "cc-m", **body})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_rollups_match_payment_detail(app, merchant):
+    with app.db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        totals = app.merchant_totals(cursor, merchant)
+        cursor.execute("""
+            SELECT percepteur, produit, client, SUM(paiements) AS paiements, SUM(montant) AS montant
+            FROM merchant_rollups WHERE marchand = %s GROUP BY percepteur, produit, client
+        """, (merchant,))
+        rollups = {(r["percepteur"], r["produit"], r["client"]): (r["paiements"], r["montant"])
+                   for r in cursor.fetchall()}
+    assert (totals["paiements"], totals["montant"]) == (4, 10000)
+    assert rollups == {(k, p, c): (1, m) for c, p, k, m in PAYMENTS}
+
+
+def test_summary_groups_and_pages(client, merchant):
+    body = post(client, "/merchant/summary", merchant, group_by="percepteur")
+    assert (body["totaux"]["paiements"], body["totaux"]["montant"]) == (4, 10000)
+    assert [(g["cle"], g["paiements"], g["montant"]) for g in body["groupes"]] == [
+        ("caisse-a", 2, 3000), ("caisse-b", 1, 3000), ("caisse-c", 1, 4000),
+    ]
+
+    keys, after = [], None
+    while True:
+        page = post(client, "/merchant/summary", merchant, group_by="client", limit=1,
+                    **({"after": after} if after else {}))
+        keys += [g["cle"] for g in page["groupes"]]
+        after = page["next_after"]
+        if after is None:
+            break
+    assert keys == ["c1", "c2", "c3"]
+
+    today = date.today()
+    by_day = post(client, "/merchant/summary", merchant, group_by="jour")["groupes"]
+    assert by_day == [{"cle": today.isoformat(), "paiements": 4, "montant": 10000}]
+    past = post(client, "/merchant/summary", merchant, group_by="jour",
+                date_to=(today - timedelta(days=1)).isoformat())
+    assert (past["totaux"]["paiements"], past["groupes"]) == (0, [])
+
+
+def test_payments_detail_of_one_group(client, merchant):
+    body = post(client, "/merchant/payments", merchant, percepteur="caisse-a", limit=1)
+    assert [p["client"] for p in body["premium_services"]] == ["c2"]
+    rest = post(client, "/merchant/payments", merchant, percepteur="caisse-a", before_id=body["next_before_id"])
+    assert [p["client"] for p in rest["premium_services"]] == ["c1"]
+    assert rest["next_before_id"] is None
+
+
+def test_summary_requires_the_merchant_credentials(client, merchant):
+    response = client.post("/merchant/summary", json={"numero": merchant, "pass_word": "faux", "codeCompte": "cc-m"})
+    assert response.status_code == 400
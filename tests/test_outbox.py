@@ -0,0 +1,134 @@
+import asyncio
+import json
+import time
+import uuid
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def outbox(app, monkeypatch, tmp_path):
+    # Outbox vide, bail et délais de réessai courts, destination locale dans un fichier NDJSON
+    with app.db_connection() as conn:
+        conn.cursor().execute("DELETE FROM outbox_events")
+    monkeypatch.setattr(app, "OUTBOX_LEASE", 0.3)
+    monkeypatch.setattr(app, "OUTBOX_RETRY_BASE", 0.2)
+    monkeypatch.setattr(app, "OUTBOX_MAX_ATTEMPTS", 3)
+    sink = app.LocalSink(str(tmp_path / "sink.ndjson"))
+    monkeypatch.setattr(app, "outbox_sink", sink)
+    return sink
+
+
+def enqueue(app, count):
+    hashes = [str(uuid.uuid4()) for _ in range(count)]
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        for transaction_hash in hashes:
+            app.enqueue_events(cursor, app.transaction_events(
+                transaction_hash, "envoi", "0810000001", "0820000001", 1000, 0
+            ))
+    return hashes
+
+
+def deliver(app, events):
+    async def run():
+        semaphore = asyncio.Semaphore(app.OUTBOX_CONCURRENCY)
+        return await asyncio.gather(*(app.deliver_event(event, semaphore) for event in events))
+    return asyncio.run(run())
+
+
+def dispatch(app):
+    return asyncio.run(app.dispatch_outbox_batch(asyncio.Semaphore(app.OUTBOX_CONCURRENCY)))
+
+
+def rows(app):
+    with app.db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT transaction_hash, status, attempts, last_error FROM outbox_events ORDER BY id")
+        return cursor.fetchall()
+
+
+def delivered(sink):
+    with open(sink.path, encoding="utf-8") as sink_file:
+        return [json.loads(line) for line in sink_file]
+
+
+def test_claimed_events_are_leased_until_acked(app, outbox):
+    hashes = enqueue(app, 3)
+
+    events = app.claim_outbox_batch()
+    assert [event["transaction_hash"] for event in events] == hashes
+    assert all(event["attempts"] == 1 for event in events)
+    # Pendant le bail, un autre dispatcher ne voit rien
+    assert app.claim_outbox_batch() == []
+
+    app.complete_outbox_batch(deliver(app, events))
+    assert [row["status"] for row in rows(app)] == ["delivered"] * 3
+    assert [line["transaction_hash"] for line in delivered(outbox)] == hashes
+    assert delivered(outbox)[0]["payload"]["montant"] == 1000
+
+    # Acquittés : plus jamais réservés, même après le bail
+    time.sleep(0.4)
+    assert app.claim_outbox_batch() == []
+
+
+def test_expired_lease_redelivers_unacked_events(app, outbox):
+    hashes = enqueue(app, 2)
+
+    # Le dispatcher « tombe » après la livraison, sans acquitter
+    first = app.claim_outbox_batch()
+    deliver(app, first)
+    assert app.claim_outbox_batch() == []
+
+    time.sleep(0.4)
+    second = app.claim_outbox_batch()
+    assert [event["id"] for event in second] == [event["id"] for event in first]
+    assert all(event["attempts"] == 2 for event in second)
+    app.complete_outbox_batch(deliver(app, second))
+
+    # Au moins une fois : chaque événement a été livré deux fois, sous le même id
+    lines = delivered(outbox)
+    assert sorted(line["transaction_hash"] for line in lines) == sorted(hashes * 2)
+    assert len({line["id"] for line in lines}) == 2
+
+    # L'échec tardif du premier dispatcher ne défait pas l'acquittement du second
+    app.complete_outbox_batch([(event, "ConnectionError: trop tard") for event in first])
+    assert [(row["status"], row["last_error"]) for row in rows(app)] == [("delivered", None)] * 2
+
+
+def test_failed_deliveries_are_retried_then_abandoned(app, monkeypatch, tmp_path, outbox):
+    enqueue(app, 1)
+    monkeypatch.setattr(app, "outbox_sink", app.LocalSink(outbox.path, failure_rate=1.0))
+
+    assert dispatch(app) == 1
+    row, = rows(app)
+    assert (row["status"], row["attempts"]) == ("pending", 1)
+    assert row["last_error"].startswith("ConnectionError")
+    # Réessai différé de OUTBOX_RETRY_BASE s
+    assert dispatch(app) == 0
+
+    time.sleep(0.3)
+    assert dispatch(app) == 1
+    time.sleep(0.5)
+    assert dispatch(app) == 1
+    row, = rows(app)
+    assert (row["status"], row["attempts"]) == ("failed", 3)
+
+    # Abandonné : la destination rétablie ne le reçoit plus
+    monkeypatch.setattr(app, "outbox_sink", outbox)
+    assert dispatch(app) == 0
+    assert not (tmp_path / "sink.ndjson").exists()
+
+
+def test_retried_event_is_delivered_once_sink_recovers(app, monkeypatch, outbox):
+    hashes = enqueue(app, 1)
+    monkeypatch.setattr(app, "outbox_sink", app.LocalSink(outbox.path, failure_rate=1.0))
+    assert dispatch(app) == 1
+
+    monkeypatch.setattr(app, "outbox_sink", outbox)
+    time.sleep(0.3)
+    assert dispatch(app) == 1
+    row, = rows(app)
+    assert (row["status"], row["attempts"], row["last_error"]) == ("delivered", 2, None)
+    line, = delivered(outbox)
+    assert (line["transaction_hash"], line["attempts"]) == (hashes[0], 2)
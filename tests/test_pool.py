@@ -0,0 +1,104 @@
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+import storage
+
+
+class FakeConnection:
+    # Connexion psycopg2 factice : `broken` fait échouer (lentement) le test de santé
+    def __init__(self, server):
+        self.server = server
+        self.closed = 0
+        self.broken = False
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        if self.broken:
+            time.sleep(0.2)
+            raise psycopg2.OperationalError("connexion perdue")
+
+    def rollback(self):
+        pass
+
+    def get_transaction_status(self):
+        return TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        if not self.closed:
+            self.closed = 1
+            self.server.closed()
+
+
+class FakeServer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.max_open = 0
+
+    def connect(self, dsn, **kwargs):
+        with self.lock:
+            self.open += 1
+            self.max_open = max(self.max_open, self.open)
+        return FakeConnection(self)
+
+    def closed(self):
+        with self.lock:
+            self.open -= 1
+
+
+def test_unhealthy_idle_connection_is_replaced_within_maxconn(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(storage.psycopg2, "connect", server.connect)
+    # check_idle=0 : chaque emprunt teste la connexion
+    pool = storage.ConnectionPool("fake", minconn=2, maxconn=2, timeout=5.0, check_idle=0)
+    broken, _ = pool._idle[0]
+    broken.broken = True
+    held = pool.getconn()
+    assert held is not broken
+
+    # Une place rendue au pool pendant le remplacement serait prise par un thread en attente :
+    # on laisse à ce thread le temps de la prendre
+    discard = pool._discard
+
+    def slow_discard(conn):
+        discard(conn)
+        time.sleep(0.1)
+    monkeypatch.setattr(pool, "_discard", slow_discard)
+
+    errors = []
+
+    def borrow(hold):
+        try:
+            conn = pool.getconn()
+            time.sleep(hold)
+            pool.putconn(conn)
+        except Exception as e:
+            errors.append(e)
+
+    # Un thread tombe sur la connexion cassée ; pendant son test de santé, d'autres attendent une place
+    replacing = threading.Thread(target=borrow, args=(0.1,))
+    replacing.start()
+    time.sleep(0.05)
+    waiters = [threading.Thread(target=borrow, args=(0.02,)) for _ in range(4)]
+    for thread in waiters:
+        thread.start()
+    time.sleep(0.3)
+    pool.putconn(held)
+    for thread in [replacing, *waiters]:
+        thread.join()
+
+    assert errors == []
+    assert server.max_open == 2
+    stats = pool.stats()
+    assert (stats["size"], stats["idle"], stats["discarded"]) == (2, 2, 1)
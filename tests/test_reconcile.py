@@ -0,0 +1,62 @@
+import uuid
+
+import reconcile
+
+
+def reconcile_account(app, numero):
+    # Tranche [numero, numero~) : ce seul compte
+    return reconcile.reconcile_range("sqlite", None, app.SQLITE_PATH, numero, numero + "~", 1000, 1.0)
+
+
+def test_recipient_written_with_spaces_is_not_reported_as_drift(app, numero):
+    envoyeur, destinataire = numero(), numero()
+    assert app.insert_user("Envoyeur", envoyeur, "x", solde=5000.0)
+    assert app.insert_user("Destinataire", destinataire, "x")
+    code = uuid.uuid4().hex
+    app.insert_transaction(envoyeur, f"{destinataire} ", 1000, "envoi", code)
+    app.confirm_pending_transaction(code)
+
+    result = reconcile_account(app, destinataire)
+    assert (result["accounts"], result["differences"]) == (1, [])
+    assert reconcile_account(app, envoyeur)["differences"] == []
+
+
+def test_tampered_balance_is_reported(app, numero):
+    compte = numero()
+    assert app.insert_user("Compte", compte, "x", solde=5000.0)
+    assert reconcile_account(app, compte)["differences"] == []
+    with app.db_connection() as conn:
+        conn.cursor().execute("UPDATE users SET solde = solde + 500 WHERE numero = %s", (compte,))
+
+    assert reconcile_account(app, compte)["differences"] == [(compte, 5500.0, 5000.0, 500.0)]
+
+
+def test_payment_without_premium_detail_is_reported(app, numero):
+    payeur, marchand = numero(), numero()
+    assert app.insert_user("Payeur", payeur, "x", solde=5000.0)
+    assert app.insert_user("Marchand", marchand, "x", type_compte="premium")
+    code = uuid.uuid4().hex
+    app.insert_transaction(payeur, f"{marchand};client;produit;caisse", 1000, "liquider", code)
+    app.confirm_pending_transaction(code)
+    assert reconcile_account(app, payeur)["missing_premium"] == []
+
+    with app.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, transaction_hash FROM les_transactions WHERE code_session = %s", (code,))
+        transaction = cursor.fetchone()
+        cursor.execute("DELETE FROM premium_services WHERE transaction_hash = %s", (transaction["transaction_hash"],))
+
+    result = reconcile_account(app, payeur)
+    assert (result["differences"], result["missing_premium"]) == ([], [transaction["id"]])
+
+
+def test_main_exits_with_1_and_writes_the_drift(app, numero, tmp_path):
+    compte = numero()
+    assert app.insert_user("Compte", compte, "x", solde=5000.0)
+    with app.db_connection() as conn:
+        conn.cursor().execute("UPDATE users SET solde = solde - 250 WHERE numero = %s", (compte,))
+
+    output = tmp_path / "ecarts.csv"
+    assert reconcile.main(["--backend", "sqlite", "--sqlite-path", app.SQLITE_PATH, "--workers", "1",
+                           "--output", str(output)]) == 1
+    assert f"{compte},4750.0,5000.0,-250.0" in output.read_text(encoding="utf-8").splitlines()
@@ -0,0 +1,28 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+
+def test_expired_session_cannot_be_confirmed_before_the_sweep(app, numero):
+    envoyeur, destinataire = numero(), numero()
+    assert app.insert_user("Envoyeur", envoyeur, "x", solde=5000.0)
+    assert app.insert_user("Destinataire", destinataire, "x")
+    code = uuid.uuid4().hex
+    app.insert_transaction(envoyeur, destinataire, 1000, "envoi", code)
+    # Plus vieille que SESSION_TTL_MINUTES, pas encore balayée
+    with app.db_connection() as conn:
+        conn.cursor().execute("UPDATE les_transactions SET timestamp = %s WHERE code_session = %s",
+                              (datetime.now() - timedelta(minutes=app.SESSION_TTL_MINUTES + 1), code))
+
+    with pytest.raises(HTTPException) as refused:
+        app.confirm_pending_transaction(code)
+    assert (refused.value.status_code, refused.value.detail) == (400, "Code session expiré")
+
+    with app.db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT etat, transaction_hash FROM les_transactions WHERE code_session = %s", (code,))
+        assert dict(cursor.fetchone()) == {"etat": "expired", "transaction_hash": None}
+    assert app.ledger_balance(envoyeur)["solde_compte"] == 5000.0
+    assert app.ledger_balance(destinataire)["solde_compte"] == 0.0
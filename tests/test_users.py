@@ -0,0 +1,16 @@
+def test_users_pages_report_their_own_count(app, client, numero):
+    with app.db_connection(write=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COALESCE(MAX(id), 0) AS id FROM users")
+        after_id = cursor.fetchone()["id"]
+    for i in range(3):
+        assert app.insert_user(f"Agent {i}", numero(), "x", type_compte="agent")
+
+    body = {"company_pass": "adminpassword", "type_compte": "agent", "limit": 2, "after_id": after_id}
+    first = client.post("/users", json=body).json()
+    assert "total_users" not in first
+    assert first["count"] == len(first["users"]) == 2
+    assert first["next_after_id"] == first["users"][-1]["id"]
+
+    last = client.post("/users", json={**body, "after_id": first["next_after_id"]}).json()
+    assert (last["count"], last["next_after_id"]) == (1, None)